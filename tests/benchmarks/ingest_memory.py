@@ -0,0 +1,106 @@
+"""Peak RSS of the webhook ingest path, by attachment size.
+
+Compares the previous whole-body path (json.loads, b64decode, BytesIO copy)
+with the chunked decode_attachment path. Each measurement runs in a fresh
+interpreter so ru_maxrss only reflects that run. S3 is replaced by draining
+the upload file object in 8 MiB reads, the way s3transfer consumes it.
+
+    python -m tests.benchmarks.ingest_memory [size_mb ...]
+"""
+
+import base64
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from io import BytesIO
+
+from trustbill.extract.extract import BufferReader, decode_attachment
+
+SIZES_MB = (1, 5, 10, 20, 40)
+READ_SIZE = 8 * 1024 * 1024
+
+
+def drain(fileobj):
+    while fileobj.read(READ_SIZE):
+        pass
+
+
+def whole_body(raw_body):
+    body = json.loads(raw_body)
+    document = base64.b64decode(body["Attachments"][0]["Content"])
+    hashlib.sha256(document).hexdigest()
+    drain(BytesIO(document))
+    return len(document)
+
+
+def chunked(raw_body):
+    body = json.loads(raw_body)
+    content = body["Attachments"][0].pop("Content")
+    document, _ = decode_attachment(content)
+    del content
+    drain(BufferReader(document))
+    return len(document)
+
+
+PATHS = {"whole_body": whole_body, "chunked": chunked}
+
+
+def rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def child(path, event_file):
+    with open(event_file, encoding="ascii") as f:
+        raw_body = f.read()
+    before = rss_mb()
+    PATHS[path](raw_body)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"before_mb": round(before, 1), "peak_mb": round(peak, 1)}))
+
+
+def main(sizes):
+    print(f"{'size MB':>8} {'path':>11} {'RSS before':>11} {'peak RSS':>9} {'x size':>7}")
+    for size in sizes:
+        body = json.dumps(
+            {
+                "TextBody": "From: Vendor <vendor@example.com>",
+                "Attachments": [
+                    {
+                        "Content": base64.b64encode(os.urandom(size * 2**20)).decode(),
+                        "ContentType": "application/pdf",
+                        "Name": "invoice.pdf",
+                    }
+                ],
+            }
+        )
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            f.write(body)
+        del body
+        try:
+            for path in PATHS:
+                output = subprocess.run(
+                    [sys.executable, "-m", __spec__.name, "--child", path, f.name],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                result = json.loads(output)
+                growth = (result["peak_mb"] - result["before_mb"]) / size
+                print(
+                    f"{size:>8} {path:>11} {result['before_mb']:>11} "
+                    f"{result['peak_mb']:>9} {growth:>7.2f}"
+                )
+        finally:
+            os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        child(sys.argv[2], sys.argv[3])
+    else:
+        main([int(size) for size in sys.argv[1:]] or SIZES_MB)
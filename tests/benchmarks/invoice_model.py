@@ -0,0 +1,138 @@
+"""Time to turn an InvoiceExtracted detail into a stored item, by line items.
+
+Compares the previous verify path (rewriting the detail's amounts to strings
+in place, then copying its fields into the item) with Invoice.from_extracted
+and to_item, which leave the detail as it was. The previous path modified its
+input, so both are given a fresh copy of the detail for every call, made
+before timing starts.
+
+    python -m tests.benchmarks.invoice_model [line_items ...]
+"""
+
+import copy
+import gc
+import random
+import sys
+import time
+import uuid
+
+from trustbill.common import model
+
+LINE_ITEMS = (1, 10, 50, 200)
+# Best of, to ride out a noisy machine
+REPEATS = 15
+VENDOR_FIELDS = (
+    "VendorEmail",
+    "VendorName",
+    "VendorAddress",
+    "VendorGSTIN",
+    "VendorBankName",
+    "VendorBankAccount",
+    "VendorIFSCCode",
+    "VendorBankRoutingNumber",
+)
+
+
+def detail(line_items, rng):
+    items = []
+    for _ in range(line_items):
+        quantity = rng.randint(1, 20)
+        unit_price = rng.randint(100, 500000) / 100
+        items.append(
+            {
+                "Description": "Toner cartridge, black, high yield",
+                "Quantity": quantity,
+                "UnitPrice": unit_price,
+                "Amount": round(quantity * unit_price, 2),
+            }
+        )
+    return {
+        "InvoiceId": str(uuid.uuid4()),
+        "VendorEmail": "billing@acme-traders.example.com",
+        "InvoiceNumber": "INV-2024-000417",
+        "InvoiceDate": "2024-06-07",
+        "DueDate": "2024-07-07",
+        "Currency": "INR",
+        "TotalAmount": round(sum(item["Amount"] for item in items), 2),
+        "TaxAmount": 180.0,
+        "VendorName": "Acme Traders Pvt. Ltd.",
+        "VendorAddress": "14 Industrial Estate, Peenya, Bengaluru 560058",
+        "VendorGSTIN": "29ABCDE1234F1Z5",
+        "VendorBankName": "State Bank of India",
+        "VendorBankAccount": "30012345678",
+        "VendorIFSCCode": "SBIN0001234",
+        "VendorBankRoutingNumber": None,
+        "LineItems": items,
+        "Notes": None,
+        "TermsAndConditions": None,
+        "FileURL": "https://bucket.s3.us-east-1.amazonaws.com/invoices/invoice.pdf",
+    }
+
+
+def previous_item(data):
+    vendor_info = {"vendorId": str(uuid.uuid4())}
+    vendor_info.update((field, data.get(field)) for field in VENDOR_FIELDS)
+    data["TotalAmount"] = str(data.get("TotalAmount", "-"))
+    data["TaxAmount"] = str(data.get("TaxAmount", "-"))
+    for item in data.get("LineItems", []):
+        for k, v in item.items():
+            if isinstance(v, (int, float)):
+                item[k] = str(v)
+            elif v is None:
+                item[k] = "-"
+    return {
+        "invoiceId": data.get("InvoiceId") or str(uuid.uuid4()),
+        "VendorEmail": data.get("VendorEmail"),
+        "InvoiceNumber": data.get("InvoiceNumber"),
+        "InvoiceDate": data.get("InvoiceDate"),
+        "DueDate": data.get("DueDate"),
+        "Currency": data.get("Currency"),
+        "TotalAmount": data.get("TotalAmount"),
+        "TaxAmount": data.get("TaxAmount"),
+        "Items": data.get("LineItems", []),
+        "Notes": data.get("Notes"),
+        "TermsAndConditions": data.get("TermsAndConditions"),
+        "FileURL": data.get("FileURL"),
+        "Flags": {},
+        "VendorInfo": vendor_info,
+    }
+
+
+def model_item(data):
+    return model.Invoice.from_extracted(data, {}).to_item()
+
+
+def elapsed(fn, inputs):
+    batch = [copy.deepcopy(data) for data in inputs]
+    # As timeit does, so a collection triggered by the copies is not timed
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        for data in batch:
+            fn(data)
+        return time.perf_counter() - started
+    finally:
+        gc.enable()
+
+
+def per_call_us(fns, inputs):
+    """Best time per call of each fn, taking turns so drift affects all alike."""
+    best = [None] * len(fns)
+    for _ in range(REPEATS):
+        for i, fn in enumerate(fns):
+            took = elapsed(fn, inputs)
+            best[i] = took if best[i] is None else min(best[i], took)
+    return [took / len(inputs) * 1e6 for took in best]
+
+
+def main(sizes):
+    rng = random.Random(417)
+    print(f"{'items':>6} {'previous us':>12} {'model us':>9} {'ratio':>6}")
+    for size in sizes:
+        inputs = [detail(size, rng)] * max(20, 5000 // size)
+        previous, current = per_call_us([previous_item, model_item], inputs)
+        print(f"{size:>6} {previous:>12.1f} {current:>9.1f} {current / previous:>6.2f}")
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or LINE_ITEMS)
@@ -0,0 +1,89 @@
+"""Stored size and capacity units of an invoice row, by number of line items.
+
+Compares the previous row layout (Items as a list of maps, VendorInfo as a
+map) with the packed layout written when PackInvoiceDetails is true. Sizes
+follow DynamoDB's item size rules (attribute names plus values), so units
+are what a PutItem and a strongly consistent GetItem of the row consume.
+
+    python -m tests.benchmarks.invoice_storage [line_items ...]
+"""
+
+import random
+import sys
+from decimal import Decimal
+
+from trustbill.common import invoicecodec
+
+LINE_ITEMS = (1, 10, 50, 200)
+PRODUCTS = (
+    "Printer paper A4 80gsm, box of 5 reams",
+    "Toner cartridge, black, high yield",
+    "Office chair, ergonomic mesh back",
+    "Cloud hosting, monthly subscription",
+    "On-site support visit, per hour",
+    "Network switch, 24 port gigabit",
+)
+
+
+def invoice(line_items, rng):
+    items = []
+    total = Decimal(0)
+    for _ in range(line_items):
+        quantity = rng.randint(1, 20)
+        unit_price = Decimal(rng.randint(100, 500000)) / 100
+        amount = unit_price * quantity
+        total += amount
+        items.append(
+            {
+                "Description": rng.choice(PRODUCTS),
+                "Quantity": str(quantity),
+                "UnitPrice": str(unit_price),
+                "Amount": str(amount),
+            }
+        )
+    return {
+        "invoiceId": "0f8fad5b-d9cb-469f-a165-70867728950e",
+        "VendorEmail": "billing@acme-traders.example.com",
+        "InvoiceNumber": "INV-2024-000417",
+        "InvoiceDate": "2024-06-07",
+        "TotalAmount": str(total),
+        "Currency": "INR",
+        "Items": items,
+        "VendorInfo": {
+            "vendorId": "5d3c4b7e-2a1f-4e6b-9c8d-7a6b5c4d3e2f",
+            "VendorEmail": "billing@acme-traders.example.com",
+            "VendorName": "Acme Traders Pvt. Ltd.",
+            "VendorAddress": "14 Industrial Estate, Peenya, Bengaluru 560058",
+            "VendorGSTIN": "29ABCDE1234F1Z5",
+            "VendorBankName": "State Bank of India",
+            "VendorBankAccount": "30012345678",
+            "VendorIFSCCode": "SBIN0001234",
+            "VendorBankRoutingNumber": None,
+        },
+        "Flags": {
+            "IncorrectVendorInfo": False,
+            "DuplicateInvoice": False,
+            "UnusualAmounts": False,
+            "ItemizedInvoice": False,
+        },
+        "createdAt": "2024-06-07T10:15:00.000000",
+    }
+
+
+def main(sizes):
+    rng = random.Random(417)
+    print(f"{'items':>6} {'layout':>8} {'bytes':>8} {'WCU':>5} {'RCU':>5} {'x smaller':>10}")
+    for size in sizes:
+        row = invoice(size, rng)
+        before = invoicecodec.capacity(row)
+        after = invoicecodec.capacity(invoicecodec.pack(row))
+        for layout, result in (("plain", before), ("packed", after)):
+            ratio = before["Bytes"] / result["Bytes"]
+            print(
+                f"{size:>6} {layout:>8} {result['Bytes']:>8} "
+                f"{result['WriteUnits']:>5} {result['ReadUnits']:>5} {ratio:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or LINE_ITEMS)
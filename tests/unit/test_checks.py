@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+
+from trustbill.common import checks
+
+
+def _registry(calls):
+    registry = checks.CheckRegistry()
+
+    @registry.loader("Records")
+    def load_records(data, context):
+        calls.append("load")
+        return context["records"]
+
+    @registry.check("Unknown", needs=["Records"], cost=1)
+    def unknown(data, context):
+        calls.append("Unknown")
+        return data["sender"] not in context["records"]
+
+    @registry.check("Expensive", needs=["Records"], cost=5, requires={"Unknown": False})
+    def expensive(data, context):
+        calls.append("Expensive")
+        return data["amount"] > 100
+
+    @registry.check("Cheap", cost=0, requires={"Unknown": False}, skipped="n/a")
+    def cheap(data, context):
+        calls.append("Cheap")
+        return data["amount"] < 0
+
+    return registry
+
+
+def test_checks_run_cheapest_first_and_share_loaders():
+    calls = []
+    registry = _registry(calls)
+    registry.max_workers = 1
+
+    flags, timings, skipped = registry.evaluate({"sender": "a", "amount": 500}, {"records": ["a"]})
+
+    assert flags == {"Unknown": False, "Expensive": True, "Cheap": False}
+    assert calls == ["load", "Unknown", "Cheap", "Expensive"]
+    assert set(timings) == {"load:Records", "Unknown", "Cheap", "Expensive"}
+    assert skipped == []
+
+
+def test_gated_checks_are_skipped():
+    calls = []
+    flags, timings, skipped = _registry(calls).evaluate({"sender": "b", "amount": 500}, {"records": ["a"]})
+
+    assert flags == {"Unknown": True, "Expensive": None, "Cheap": "n/a"}
+    assert calls == ["load", "Unknown"]
+    assert skipped == ["Cheap", "Expensive"]
+    assert "Expensive" not in timings
+
+
+def test_independent_checks_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    registry = checks.CheckRegistry()
+    # Each check waits for the other; run one after the other they would time out
+    registry.check("A")(lambda data, context: barrier.wait() is not None)
+    registry.check("B")(lambda data, context: barrier.wait() is not None)
+
+    flags, _, _ = registry.evaluate({}, None)
+
+    assert flags == {"A": True, "B": True}
+
+
+def test_check_errors_propagate():
+    registry = checks.CheckRegistry()
+    registry.check("Broken")(lambda data, context: 1 / 0)
+    registry.check("Fine")(lambda data, context: False)
+
+    with pytest.raises(ZeroDivisionError):
+        registry.evaluate({}, None)
+
+
+def test_requires_must_name_registered_check():
+    with pytest.raises(ValueError, match="unregistered"):
+        checks.CheckRegistry().check("Late", requires={"Missing": False})(lambda data, context: False)
+
+
+def test_evaluations_reuse_the_worker_threads():
+    threads = set()
+    registry = checks.CheckRegistry(max_workers=2)
+
+    def record(data, context):
+        threads.add(threading.get_ident())
+        return False
+
+    registry.loader("First")(record)
+    registry.loader("Second")(record)
+    registry.check("A", needs=["First"])(record)
+    registry.check("B", needs=["Second"])(record)
+
+    for _ in range(10):
+        registry.evaluate({}, None)
+
+    assert len(threads) <= 2
+    assert threading.get_ident() not in threads
@@ -0,0 +1,88 @@
+import gzip
+import json
+import os
+
+import boto3
+import pytest
+from moto import mock_s3
+
+from trustbill.common import claimcheck, clients
+
+BUCKET = "test-claim-check"
+DETAIL = {
+    "InvoiceId": "inv-1",
+    "VendorEmail": "vendor@example.com",
+    "InvoiceNumber": "INV-1",
+    "TotalAmount": 125.5,
+    "Currency": "INR",
+    "TextBody": "From: Vendor <vendor@example.com>\n" + "> quoted reply\n" * 2000,
+    "LineItems": [{"Description": f"Item {i}", "Amount": 1} for i in range(300)],
+}
+
+
+@pytest.fixture(autouse=True)
+def s3():
+    """Mocked credentials and an empty bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    clients.reset()
+    with mock_s3():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+    clients.reset()
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_check_in_round_trip(s3, compress):
+    event_detail = claimcheck.check_in(s3, DETAIL, BUCKET, "extractions/inv-1.json", compress)
+
+    assert "TextBody" not in event_detail and "LineItems" not in event_detail
+    assert event_detail["InvoiceNumber"] == "INV-1"
+    assert event_detail["TotalAmount"] == 125.5
+    assert len(json.dumps(event_detail)) < 1024
+    pointer = event_detail["ClaimCheck"]
+    assert pointer["Encoding"] == ("gzip" if compress else "identity")
+    assert pointer["Sha256"] == claimcheck.encode(DETAIL, compress=False)[1]
+    assert claimcheck.DetailCache().resolve(event_detail) == DETAIL
+
+
+def test_compression_shrinks_stored_detail(s3):
+    compressed = claimcheck.check_in(s3, DETAIL, BUCKET, "a.json")["ClaimCheck"]["Bytes"]
+    plain = claimcheck.check_in(s3, DETAIL, BUCKET, "b.json", compress=False)["ClaimCheck"]["Bytes"]
+
+    assert compressed < plain / 10
+    stored = s3.get_object(Bucket=BUCKET, Key="a.json")
+    assert json.loads(gzip.decompress(stored["Body"].read())) == DETAIL
+
+
+def test_inline_detail_passes_through():
+    cache = claimcheck.DetailCache()
+
+    assert cache.resolve({"InvoiceNumber": "INV-1"}) == {"InvoiceNumber": "INV-1"}
+    assert cache.stats == {"hits": 0, "misses": 0}
+
+
+def test_resolved_details_are_cached(s3):
+    event_detail = claimcheck.check_in(s3, DETAIL, BUCKET, "extractions/inv-1.json")
+    cache = claimcheck.DetailCache(max_entries=1)
+
+    first = cache.resolve(event_detail)
+    first["TextBody"] = "changed by the caller"
+    s3.delete_object(Bucket=BUCKET, Key="extractions/inv-1.json")
+
+    assert cache.resolve(event_detail) == DETAIL
+    assert cache.stats == {"hits": 1, "misses": 1}
+
+
+def test_tampered_or_missing_detail_raises(s3):
+    event_detail = claimcheck.check_in(s3, DETAIL, BUCKET, "extractions/inv-1.json")
+    s3.put_object(Bucket=BUCKET, Key="extractions/inv-1.json", Body=gzip.compress(b"{}"))
+
+    with pytest.raises(claimcheck.ClaimCheckError, match="does not match"):
+        claimcheck.DetailCache().resolve(event_detail)
+
+    s3.delete_object(Bucket=BUCKET, Key="extractions/inv-1.json")
+    with pytest.raises(claimcheck.ClaimCheckError, match="Cannot read"):
+        claimcheck.DetailCache().resolve(event_detail)
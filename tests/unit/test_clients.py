@@ -0,0 +1,63 @@
+import os
+import threading
+import pytest
+
+from trustbill.common import clients
+
+
+@pytest.fixture(autouse=True)
+def aws_environment():
+    """Mocked AWS Credentials and a clean registry."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    clients.reset()
+    yield
+    clients.reset()
+
+
+def test_client_is_reused():
+    """Warm invocations get the same client instance back."""
+    assert clients.client("s3") is clients.client("s3")
+    assert clients.client("s3") is not clients.client("events")
+    assert clients.client("s3", "eu-west-1") is not clients.client("s3")
+
+
+def test_client_config():
+    """Clients use the tuned connection, retry and timeout settings."""
+    config = clients.client("s3").meta.config
+    assert config.max_pool_connections == clients.MAX_POOL_CONNECTIONS
+    assert config.tcp_keepalive is True
+    assert config.retries["mode"] == "adaptive"
+    assert config.connect_timeout == clients.CONNECT_TIMEOUT
+    assert config.read_timeout == clients.READ_TIMEOUT
+
+
+def test_bedrock_read_timeout_override():
+    config = clients.client("bedrock-runtime", "us-east-1").meta.config
+    assert config.read_timeout == clients.SERVICE_CONFIG["bedrock-runtime"].read_timeout
+    # Throttles are retried behind the shared rate limiter instead
+    assert config.retries == {"mode": "standard", "total_max_attempts": 1}
+
+
+def test_reset_rebuilds_clients_and_tables():
+    s3 = clients.client("s3")
+    table = clients.table("invoices")
+
+    clients.reset()
+
+    assert clients.client("s3") is not s3
+    assert clients.table("invoices") is not table
+
+
+def test_tables_are_per_thread():
+    """Resources are not thread-safe, so each thread gets its own."""
+    main = clients.table("invoices")
+    assert clients.table("invoices") is main
+    other = []
+    worker = threading.Thread(target=lambda: other.append(clients.table("invoices")))
+    worker.start()
+    worker.join()
+
+    assert other[0] is not main
+    assert other[0].name == "invoices"
@@ -10,6 +10,8 @@ os.environ["InvoicesTable"] = "test-invoices-table"
 
 # Import the functions to test
 from trustbill.data.data import lambda_handler, get_all_data, unflag_invoice
+from trustbill.common import clients, invoicecodec, vendorcache, vendorindex
+from trustbill.data import data
 
 
 @pytest.fixture
@@ -22,6 +24,14 @@ def aws_credentials():
     os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
 
 
+@pytest.fixture(autouse=True)
+def reset_clients():
+    """Rebuild AWS clients inside each test's moto mock."""
+    clients.reset()
+    yield
+    clients.reset()
+
+
 @pytest.fixture
 def dynamodb_tables(aws_credentials):
     """Create mock DynamoDB tables for testing."""
@@ -261,3 +271,83 @@ def test_lambda_handler_not_found(dynamodb_tables):
     assert response["statusCode"] == 404
     body = json.loads(response["body"])
     assert "Not found" in body["message"]
+
+
+def test_add_vendor_bumps_cache_version(dynamodb_tables, monkeypatch):
+    boto3.client("dynamodb").create_table(
+        TableName="test-cache-versions",
+        KeySchema=[{"AttributeName": "cacheName", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "cacheName", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    monkeypatch.setattr(data, "CACHE_VERSIONS_TABLE", "test-cache-versions")
+    event = {
+        "httpMethod": "POST",
+        "path": "/invoices/vendors/add",
+        "body": json.dumps({"vendorId": "v-2", "VendorEmail": "new@example.com"}),
+    }
+
+    assert lambda_handler(event, {})["statusCode"] == 201
+    assert lambda_handler(event, {})["statusCode"] == 201
+    assert vendorcache.read_version("test-cache-versions") == 2
+
+
+def test_add_vendor_reindexes_lookup_keys(dynamodb_tables, monkeypatch):
+    boto3.client("dynamodb").create_table(
+        TableName="test-vendor-keys",
+        KeySchema=[{"AttributeName": "lookupKey", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "lookupKey", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    monkeypatch.setattr(data, "VENDOR_KEYS_TABLE", "test-vendor-keys")
+    vendor = {"vendorId": "v-2", "VendorEmail": "new@example.com", "VendorBankAccount": "111", "VendorIFSCCode": "IFSC1"}
+
+    def add(body):
+        event = {"httpMethod": "POST", "path": "/invoices/vendors/add", "body": json.dumps(body)}
+        assert lambda_handler(event, {})["statusCode"] == 201
+
+    add(vendor)
+    assert vendorindex.resolve("test-vendor-keys", vendor).bank_owners == {"v-2"}
+
+    # The bank account changes: the old account no longer points at v-2
+    add(dict(vendor, VendorBankAccount="222"))
+    assert vendorindex.resolve("test-vendor-keys", vendor).bank_owners == set()
+    assert vendorindex.resolve("test-vendor-keys", dict(vendor, VendorBankAccount="222")).bank_owners == {"v-2"}
+
+
+def test_get_invoices_decodes_packed_rows_only_when_asked(dynamodb_tables, monkeypatch):
+    packed = invoicecodec.pack(
+        {
+            "invoiceId": "packed-1",
+            "InvoiceNumber": "INV-9",
+            "Items": [{"Description": "Widget", "Quantity": "1", "UnitPrice": "5", "Amount": "5"}],
+            "Flags": {"DuplicateInvoice": False},
+            "VendorInfo": {"VendorEmail": "v@example.com"},
+        }
+    )
+    dynamodb_tables["invoices_table"].put_item(Item=packed)
+
+    invoices = {i["invoiceId"]: i for i in get_all_data()["invoices"]}
+    assert invoices["packed-1"]["Items"][0]["Description"] == "Widget"
+    assert invoices["packed-1"]["VendorInfo"]["VendorEmail"] == "v@example.com"
+    assert "Packed" not in invoices["packed-1"]
+
+    # moto cannot project items holding binary attributes, so record the scan
+    # and answer it the way DynamoDB would
+    scans = []
+    projected = {"invoiceId": "packed-1", "InvoiceNumber": "INV-9", "Flags": {"DuplicateInvoice": False}}
+
+    class Invoices:
+        def scan(self, **kwargs):
+            scans.append(kwargs)
+            return {"Items": [dict(projected)]}
+
+    monkeypatch.setattr(data, "get_tables", lambda: {"vendors": dynamodb_tables["vendors_table"], "invoices": Invoices()})
+    monkeypatch.setattr(invoicecodec, "decode", lambda blob: pytest.fail("decoded unrequested fields"))
+    event = {"httpMethod": "GET", "path": "/invoices", "queryStringParameters": {"fields": "InvoiceNumber,Flags"}}
+    body = json.loads(lambda_handler(event, {})["body"])
+    assert body["invoices"] == [projected]
+    assert sorted(scans[0]["ExpressionAttributeNames"].values()) == ["Flags", "InvoiceNumber", "invoiceId"]
+
+    get_all_data(fields=["InvoiceNumber", "Items"])
+    assert "Packed" in scans[1]["ExpressionAttributeNames"].values()
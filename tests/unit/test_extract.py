@@ -1,14 +1,21 @@
 import base64
+import binascii
+import hashlib
 import json
 import os
+import time
+import tracemalloc
 from io import BytesIO
 import boto3
 import pytest
-from moto import mock_s3, mock_events
+from moto import mock_s3, mock_events, mock_dynamodb, mock_sqs
 from unittest.mock import patch, MagicMock
+from botocore.exceptions import ClientError
 
 # Import the function to test
-from trustbill.extract.extract import lambda_handler
+from trustbill.common import claimcheck, clients, vendorcache
+from trustbill.extract import extract
+from trustbill.extract.extract import lambda_handler, ExtractionCache, extraction_cache_key
 
 
 @pytest.fixture
@@ -21,6 +28,22 @@ def aws_credentials():
     os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
 
 
+@pytest.fixture(autouse=True)
+def clear_extraction_cache():
+    """Each test starts with cold caches, zeroed counters and fresh clients."""
+    extract.extraction_cache.clear()
+    extract.repair_stats.clear()
+    extract.template_store.clear()
+    extract.vendor_cache.clear()
+    clients.reset()
+    yield
+    extract.extraction_cache.clear()
+    extract.repair_stats.clear()
+    extract.template_store.clear()
+    extract.vendor_cache.clear()
+    clients.reset()
+
+
 @pytest.fixture
 def s3_bucket(aws_credentials):
     """Create mock S3 bucket."""
@@ -118,7 +141,9 @@ def test_lambda_handler_success(mock_boto3_client, s3_bucket, eventbridge):
     
     # Verify response
     assert response["statusCode"] == 200
-    assert response["body"] == "file processed"
+    body = json.loads(response["body"])
+    assert body["message"] == "file processed"
+    assert body["attachments"][0]["status"] == "processed"
     
     # Verify Bedrock was called
     mock_bedrock.converse.assert_called_once()
@@ -194,3 +219,1292 @@ def test_lambda_handler_bedrock_error(mock_boto3_client, s3_bucket):
     # Verify error response
     assert response["statusCode"] == 500
     assert "Error processing file" in json.loads(response["body"])["message"]
+
+
+def _invoice_output(**overrides):
+    """A complete, schema-valid model answer."""
+    fields = {
+        field: ([{"Description": "Widget", "Quantity": 1, "UnitPrice": 5, "Amount": 5}]
+                if field == "LineItems" else (100 if field.endswith("Amount") else f"{field} value"))
+        for field in extract.INVOICE_SCHEMA["required"]
+    }
+    fields.update({"InvoiceDate": "2023-06-01", "DueDate": "2023-07-01", **overrides})
+    return json.dumps(fields)
+
+
+INVOICE_JSON = _invoice_output()
+
+
+def _invoice_event(*pdf_contents):
+    return {
+        "body": json.dumps({
+            "TextBody": "From: Test User <test@example.com>\nSubject: Invoice",
+            "Attachments": [
+                {
+                    "Content": base64.b64encode(pdf_content).decode(),
+                    "ContentType": "application/pdf",
+                    "Name": f"invoice-{i}.pdf"
+                }
+                for i, pdf_content in enumerate(pdf_contents)
+            ]
+        })
+    }
+
+
+def _mock_clients(mock_boto3_client, output_text):
+    """Wire boto3.client to Bedrock/S3/EventBridge mocks and return them."""
+    mocks = {
+        "bedrock-runtime": MagicMock(),
+        "s3": MagicMock(),
+        "events": MagicMock(),
+    }
+    mocks["bedrock-runtime"].converse.return_value = {
+        "output": {"message": {"content": [{"text": output_text}]}}
+    }
+    mocks["events"].put_events.return_value = {"FailedEntryCount": 0}
+    mock_boto3_client.side_effect = lambda service, *args, **kwargs: mocks.get(service, MagicMock())
+    return mocks
+
+
+@patch('boto3.client')
+def test_lambda_handler_cache_hit_skips_bedrock(mock_boto3_client):
+    """A re-sent PDF is served from the cache and still emits its event."""
+    mocks = _mock_clients(mock_boto3_client, _invoice_output(InvoiceNumber="INV-123"))
+    event = _invoice_event(b"Same PDF content")
+
+    assert lambda_handler(event, {})["statusCode"] == 200
+    assert lambda_handler(event, {})["statusCode"] == 200
+
+    mocks["bedrock-runtime"].converse.assert_called_once()
+    assert mocks["events"].put_events.call_count == 2
+    detail = json.loads(mocks["events"].put_events.call_args.kwargs["Entries"][0]["Detail"])
+    assert detail["InvoiceNumber"] == "INV-123"
+    assert extract.extraction_cache.stats == {"memory_hits": 1, "table_hits": 0, "misses": 1}
+
+
+@patch('boto3.client')
+def test_lambda_handler_unparseable_output_not_cached(mock_boto3_client):
+    """Failed parses must not be cached, so the next delivery retries Bedrock."""
+    mocks = _mock_clients(mock_boto3_client, "not json")
+    event = _invoice_event(b"Broken PDF content")
+
+    lambda_handler(event, {})
+    calls_per_delivery = mocks["bedrock-runtime"].converse.call_count
+    lambda_handler(event, {})
+
+    assert mocks["bedrock-runtime"].converse.call_count == 2 * calls_per_delivery
+
+
+def test_extraction_cache_key_depends_on_content():
+    assert extraction_cache_key(b"a") == extraction_cache_key(b"a")
+    assert extraction_cache_key(b"a") != extraction_cache_key(b"b")
+    assert extract.MODEL_ID in extraction_cache_key(b"a")
+
+
+def test_extraction_cache_lru_eviction():
+    cache = ExtractionCache(max_entries=2)
+    cache.put("a", {"n": 1})
+    cache.put("b", {"n": 2})
+    cache.get("a")
+    cache.put("c", {"n": 3})
+
+    assert cache.get("b") is None
+    assert cache.get("a") == {"n": 1}
+    assert cache.get("c") == {"n": 3}
+
+
+def test_extraction_cache_dynamodb_shared_across_containers(aws_credentials):
+    """A cold container finds extractions written by another one."""
+    with mock_dynamodb():
+        boto3.resource("dynamodb").create_table(
+            TableName="test-extraction-cache",
+            KeySchema=[{"AttributeName": "cacheKey", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "cacheKey", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        ExtractionCache("test-extraction-cache").put("key", {"InvoiceNumber": "INV-9"})
+
+        cold = ExtractionCache("test-extraction-cache")
+        assert cold.get("key") == {"InvoiceNumber": "INV-9"}
+        assert cold.get("missing") is None
+        assert cold.stats == {"memory_hits": 0, "table_hits": 1, "misses": 1}
+
+
+@patch('boto3.client')
+def test_lambda_handler_processes_every_pdf_attachment(mock_boto3_client):
+    """All PDF attachments are extracted and published in one batch."""
+    mocks = _mock_clients(mock_boto3_client, _invoice_output(InvoiceNumber="INV-1"))
+    event = _invoice_event(b"PDF one", b"PDF two", b"PDF three")
+    body = json.loads(event["body"])
+    body["Attachments"].append({"Content": "aGk=", "ContentType": "image/png", "Name": "logo.png"})
+    event["body"] = json.dumps(body)
+
+    response = lambda_handler(event, {})
+
+    assert response["statusCode"] == 200
+    results = json.loads(response["body"])["attachments"]
+    assert [r["Name"] for r in results] == ["invoice-0.pdf", "invoice-1.pdf", "invoice-2.pdf"]
+    assert all(r["status"] == "processed" and r["InvoiceId"] for r in results)
+    assert mocks["bedrock-runtime"].converse.call_count == 3
+    assert mocks["s3"].upload_fileobj.call_count == 3
+    mocks["events"].put_events.assert_called_once()
+    assert len(mocks["events"].put_events.call_args.kwargs["Entries"]) == 3
+
+
+@patch('boto3.client')
+def test_lambda_handler_batches_put_events(mock_boto3_client):
+    """PutEvents is called with at most 10 entries per request."""
+    mocks = _mock_clients(mock_boto3_client, _invoice_output(InvoiceNumber="INV-1"))
+
+    response = lambda_handler(_invoice_event(*[f"PDF {i}".encode() for i in range(12)]), {})
+
+    assert response["statusCode"] == 200
+    batch_sizes = [len(c.kwargs["Entries"]) for c in mocks["events"].put_events.call_args_list]
+    assert batch_sizes == [10, 2]
+
+
+@patch('boto3.client')
+def test_lambda_handler_reports_partial_failure(mock_boto3_client):
+    """One failing attachment does not sink the rest of the email."""
+    mocks = _mock_clients(mock_boto3_client, _invoice_output(InvoiceNumber="INV-1"))
+    ok = mocks["bedrock-runtime"].converse.return_value
+
+    def converse(**kwargs):
+        document = kwargs["messages"][0]["content"][0]["document"]["source"]["bytes"]
+        if document == b"bad PDF":
+            raise Exception("ThrottlingException")
+        return ok
+
+    mocks["bedrock-runtime"].converse.side_effect = converse
+
+    response = lambda_handler(_invoice_event(b"good PDF", b"bad PDF"), {})
+
+    assert response["statusCode"] == 207
+    good, bad = json.loads(response["body"])["attachments"]
+    assert good["status"] == "processed"
+    assert bad["status"] == "failed"
+    assert "ThrottlingException" in bad["error"]
+    assert len(mocks["events"].put_events.call_args.kwargs["Entries"]) == 1
+
+
+@patch('boto3.client')
+def test_lambda_handler_reports_failed_event_entries(mock_boto3_client):
+    """Entries rejected by EventBridge are reported against their attachment."""
+    mocks = _mock_clients(mock_boto3_client, _invoice_output(InvoiceNumber="INV-1"))
+    mocks["events"].put_events.return_value = {
+        "FailedEntryCount": 1,
+        "Entries": [{"EventId": "1"}, {"ErrorCode": "InternalFailure", "ErrorMessage": "boom"}],
+    }
+
+    response = lambda_handler(_invoice_event(b"PDF a", b"PDF b"), {})
+
+    assert response["statusCode"] == 207
+    first, second = json.loads(response["body"])["attachments"]
+    assert first["status"] == "processed"
+    assert "InternalFailure" in second["error"]
+
+
+@patch('boto3.client')
+def test_lambda_handler_attachments_run_concurrently(mock_boto3_client):
+    """Wall-clock time tracks the slowest attachment, not the sum."""
+    mocks = _mock_clients(mock_boto3_client, _invoice_output(InvoiceNumber="INV-1"))
+    ok = mocks["bedrock-runtime"].converse.return_value
+
+    def slow_converse(**kwargs):
+        time.sleep(0.2)
+        return ok
+
+    mocks["bedrock-runtime"].converse.side_effect = slow_converse
+
+    started = time.perf_counter()
+    response = lambda_handler(_invoice_event(*[f"PDF {i}".encode() for i in range(5)]), {})
+    elapsed = time.perf_counter() - started
+
+    assert response["statusCode"] == 200
+    assert elapsed < 0.6
+
+
+@patch('boto3.client')
+def test_lambda_handler_overlaps_upload_and_extraction(mock_boto3_client):
+    """The S3 upload runs while Bedrock extracts, and stage timings are reported."""
+    mocks = _mock_clients(mock_boto3_client, _invoice_output(InvoiceNumber="INV-1"))
+    ok = mocks["bedrock-runtime"].converse.return_value
+
+    def slow_converse(**kwargs):
+        time.sleep(0.2)
+        return ok
+
+    mocks["bedrock-runtime"].converse.side_effect = slow_converse
+    mocks["s3"].upload_fileobj.side_effect = lambda *args, **kwargs: time.sleep(0.2)
+
+    started = time.perf_counter()
+    response = lambda_handler(_invoice_event(b"PDF content"), {})
+    elapsed = time.perf_counter() - started
+
+    assert response["statusCode"] == 200
+    assert elapsed < 0.35
+    timings = json.loads(response["body"])["attachments"][0]["timings"]
+    assert {"decode_ms", "upload_ms", "extract_ms", "publish_ms"} <= set(timings)
+    assert timings["upload_ms"] >= 200
+    assert timings["extract_ms"] >= 200
+
+
+@patch('boto3.client')
+def test_lambda_handler_cleans_up_upload_when_extraction_fails(mock_boto3_client):
+    """A failed extraction leaves no orphaned PDF in S3."""
+    mocks = _mock_clients(mock_boto3_client, "")
+
+    def failing_converse(**kwargs):
+        time.sleep(0.05)
+        raise Exception("Bedrock API error")
+
+    mocks["bedrock-runtime"].converse.side_effect = failing_converse
+
+    response = lambda_handler(_invoice_event(b"PDF content"), {})
+
+    assert response["statusCode"] == 500
+    file_key = mocks["s3"].upload_fileobj.call_args.args[2]
+    mocks["s3"].delete_object.assert_called_once_with(
+        Bucket="serverless-trustbill-invoices", Key=file_key
+    )
+    mocks["events"].put_events.assert_not_called()
+
+
+class FakeConverseStream:
+    """Stand-in for the converse_stream EventStream, fed from a string."""
+
+    def __init__(self, text, chunk_size=7):
+        self.events = [{"messageStart": {"role": "assistant"}}]
+        self.events += [
+            {"contentBlockDelta": {"delta": {"text": text[i:i + chunk_size]}, "contentBlockIndex": 0}}
+            for i in range(0, len(text), chunk_size)
+        ]
+        self.events += [
+            {"contentBlockStop": {"contentBlockIndex": 0}},
+            {"messageStop": {"stopReason": "end_turn"}},
+            {"metadata": {"usage": {"inputTokens": 10, "outputTokens": 10}}},
+        ]
+        self.consumed = 0
+        self.closed = False
+
+    def __iter__(self):
+        for event in self.events:
+            self.consumed += 1
+            yield event
+
+    def close(self):
+        self.closed = True
+
+
+
+
+def test_incremental_parser_yields_members_as_they_close():
+    parser = extract.IncrementalJSONParser()
+    text = '```json\n{"InvoiceNumber": "INV-1", "LineItems": [{"Amount": 5}], "Notes": "a, \\"b\\" }"}\n```'
+    completed = []
+    for char in text:
+        completed += parser.feed(char)
+
+    assert completed == [
+        ("InvoiceNumber", "INV-1"),
+        ("LineItems", [{"Amount": 5}]),
+        ("Notes", 'a, "b" }'),
+    ]
+    assert parser.done
+
+
+def test_incremental_parser_aborts_early_on_malformed_output():
+    with pytest.raises(extract.MalformedOutput):
+        extract.IncrementalJSONParser().feed("I'm sorry, I can't read this invoice")
+
+    parser = extract.IncrementalJSONParser()
+    with pytest.raises(extract.MalformedOutput):
+        parser.feed('{"InvoiceNumber": INV-1, "TotalAmount": ')
+
+
+@patch('boto3.client')
+def test_lambda_handler_streaming_stops_once_required_fields_arrive(mock_boto3_client, monkeypatch):
+    """With streaming on, the event goes out without waiting for trailing output."""
+    monkeypatch.setattr(extract, "EXTRACTION_STREAMING", True)
+    mocks = _mock_clients(mock_boto3_client, "")
+    stream = FakeConverseStream(INVOICE_JSON + "\n```\n" + "Trailing commentary. " * 50)
+    mocks["bedrock-runtime"].converse_stream.return_value = {"stream": stream}
+
+    response = lambda_handler(_invoice_event(b"Streamed PDF"), {})
+
+    assert response["statusCode"] == 200
+    mocks["bedrock-runtime"].converse.assert_not_called()
+    assert stream.closed
+    assert stream.consumed < len(stream.events) - 50
+    detail = json.loads(mocks["events"].put_events.call_args.kwargs["Entries"][0]["Detail"])
+    assert detail["InvoiceNumber"] == "InvoiceNumber value"
+    assert detail["LineItems"][0]["Description"] == "Widget"
+    assert "first_field_ms" in json.loads(response["body"])["attachments"][0]["timings"]
+
+
+@patch('boto3.client')
+def test_lambda_handler_streaming_aborts_malformed_output(mock_boto3_client, monkeypatch):
+    monkeypatch.setattr(extract, "EXTRACTION_STREAMING", True)
+    mocks = _mock_clients(mock_boto3_client, "")
+    stream = FakeConverseStream("I cannot process this document. " * 50)
+    mocks["bedrock-runtime"].converse_stream.return_value = {"stream": stream}
+
+    response = lambda_handler(_invoice_event(b"Unreadable PDF"), {})
+
+    # Nothing usable was read, so nothing is published
+    assert response["statusCode"] == 500
+    assert "Extraction failed validation" in json.loads(response["body"])["message"]
+    mocks["events"].put_events.assert_not_called()
+    assert stream.consumed == 2
+    assert stream.closed
+
+
+def test_repair_json_syntax_fixes_trivial_damage():
+    damaged = 'Here is the invoice:\n```json\n{"InvoiceNumber": "INV-1", "LineItems": [{"Amount": 5},],}\n```\nLet me know!'
+    assert json.loads(extract.repair_json_syntax(damaged)) == {
+        "InvoiceNumber": "INV-1",
+        "LineItems": [{"Amount": 5}],
+    }
+
+    # A cut-off answer loses only its incomplete last member
+    truncated = '{"InvoiceNumber": "INV-1", "Notes": "pay by wire", "LineItems": [{"Amount": 5}, {"Am'
+    assert json.loads(extract.repair_json_syntax(truncated)) == {
+        "InvoiceNumber": "INV-1",
+        "Notes": "pay by wire",
+    }
+
+
+def test_coerce_fields_and_validation():
+    fields = extract.coerce_fields({
+        "TotalAmount": "$1,200.50",
+        "TaxAmount": "N/A",
+        "InvoiceDate": "June 1, 2023",
+        "LineItems": [{"Description": "Widget", "Quantity": "2", "UnitPrice": 5, "Amount": 10}],
+    })
+
+    assert fields["TotalAmount"] == 1200.5
+    assert fields["InvoiceDate"] == "2023-06-01"
+    assert fields["LineItems"][0]["Quantity"] == 2
+    problems = extract.invalid_fields(fields)
+    assert problems["TaxAmount"] == "expected number or null"
+    assert problems["DueDate"] == "missing"
+    assert "TotalAmount" not in problems
+    assert "LineItems" not in problems
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        ("Rs. 500", 500),
+        ("Rs. 1,200", 1200),
+        ("INR 1,200.50", 1200.5),
+        ("₹ 75", 75),
+        ("-12.5", -12.5),
+        ("1200", 1200),
+    ],
+)
+def test_coerce_reads_plain_amounts(raw, expected):
+    assert extract.coerce_fields({"TotalAmount": raw})["TotalAmount"] == expected
+
+
+@pytest.mark.parametrize("raw", ["1.200,50", "3 x 4", "12,00", "about 500", "500 USD"])
+def test_coerce_leaves_ambiguous_amounts_for_repair(raw):
+    fields = extract.coerce_fields({"TotalAmount": raw})
+
+    assert fields["TotalAmount"] == raw
+    assert extract.invalid_fields(fields)["TotalAmount"] == "expected number or null"
+
+
+@patch('boto3.client')
+def test_lambda_handler_repairs_locally_without_bedrock(mock_boto3_client):
+    """Syntax damage is fixed in-process, with no second model call."""
+    mocks = _mock_clients(mock_boto3_client, "Sure!\n" + _invoice_output()[:-1] + ",}\nThanks")
+
+    response = lambda_handler(_invoice_event(b"Chatty PDF"), {})
+
+    assert response["statusCode"] == 200
+    mocks["bedrock-runtime"].converse.assert_called_once()
+    assert extract.repair_stats.counts["repaired_locally"] == 1
+
+
+@patch('boto3.client')
+def test_lambda_handler_requests_only_invalid_fields(mock_boto3_client):
+    """Missing or invalid fields get a small follow-up request, not a re-extraction."""
+    answer = json.loads(_invoice_output(InvoiceDate="sometime soon"))
+    del answer["TotalAmount"]
+    mocks = _mock_clients(mock_boto3_client, json.dumps(answer))
+    first = mocks["bedrock-runtime"].converse.return_value
+    fix = {"output": {"message": {"content": [{"text": '{"TotalAmount": 250, "InvoiceDate": "2023-06-01", "Notes": "ignored"}'}]}}}
+    mocks["bedrock-runtime"].converse.side_effect = [first, fix]
+
+    response = lambda_handler(_invoice_event(b"Sloppy PDF"), {})
+
+    assert response["statusCode"] == 200
+    repair_call = mocks["bedrock-runtime"].converse.call_args_list[1].kwargs
+    repair_text = repair_call["messages"][-1]["content"][0]["text"]
+    assert "TotalAmount: missing" in repair_text
+    assert "InvoiceDate: expected a YYYY-MM-DD date" in repair_text
+    assert "VendorName" not in repair_text
+    assert repair_call["inferenceConfig"]["maxTokens"] == extract.REPAIR_MAX_TOKENS
+
+    detail = json.loads(mocks["events"].put_events.call_args.kwargs["Entries"][0]["Detail"])
+    assert detail["TotalAmount"] == 250
+    assert detail["InvoiceDate"] == "2023-06-01"
+    assert detail["Notes"] == "Notes value"
+    assert extract.repair_stats.counts["repaired_remote"] == 1
+
+
+INVOICE_TEXT = """ACME Supplies Ltd
+12 Market Road, Pune
+GSTIN: 27ABCDE1234F1Z5
+Invoice No: {number}        Date: {date}
+Due Date: {due}
+Bill To: Globex Corp
+Billing Address: 5 Harbour Street, Mumbai
+Customer GSTIN: 27GLOBX1234F1Z5
+Description  Qty  Unit Price  Amount
+{rows}
+Subtotal: {subtotal}
+Tax: {tax}
+Total: {total}
+Currency: INR
+Bank: State Bank
+Account No: {account}
+IFSC: SBIN0001234
+Routing No: 021000021
+Payment Terms: Net 30
+Payment Method: Bank Transfer
+Notes: Thank you for your business
+Conditions: Goods once sold are not returned
+"""
+
+
+def _text_invoice(number, date, due, items, tax, account="1234567890"):
+    """Render a text layer and the matching model answer for the ACME layout."""
+    subtotal = sum(qty * price for _, qty, price in items)
+    text = INVOICE_TEXT.format(
+        number=number,
+        date=date.strftime("%d/%m/%Y"),
+        due=due.strftime("%d/%m/%Y"),
+        rows="\n".join(f"{d}  {q}  {p:.2f}  {q * p:.2f}" for d, q, p in items),
+        subtotal=f"{subtotal:.2f}",
+        tax=f"{tax:.2f}",
+        total=f"{subtotal + tax:,.2f}",
+        account=account,
+    )
+    fields = {name: None for name in extract.INVOICE_SCHEMA["required"]}
+    fields.update({
+        "InvoiceNumber": number,
+        "InvoiceDate": date.isoformat(),
+        "DueDate": due.isoformat(),
+        "Currency": "INR",
+        "TotalAmount": round(subtotal + tax, 2),
+        "TaxAmount": tax,
+        "VendorName": "ACME Supplies Ltd",
+        "VendorAddress": "12 Market Road, Pune",
+        "VendorGSTIN": "27ABCDE1234F1Z5",
+        "VendorBankName": "State Bank",
+        "VendorBankAccount": account,
+        "VendorIFSCCode": "SBIN0001234",
+        "VendorBankRoutingNumber": "021000021",
+        "CustomerName": "Globex Corp",
+        "CustomerAddress": "5 Harbour Street, Mumbai",
+        "CustomerGSTIN": "27GLOBX1234F1Z5",
+        "PaymentTerms": "Net 30",
+        "PaymentMethod": "Bank Transfer",
+        "Notes": "Thank you for your business",
+        "TermsAndConditions": "Goods once sold are not returned",
+        "LineItems": [
+            {"Description": d, "Quantity": q, "UnitPrice": p, "Amount": round(q * p, 2)}
+            for d, q, p in items
+        ],
+    })
+    return text, fields
+
+
+def test_learned_template_reads_next_invoice():
+    from datetime import date
+
+    text, fields = _text_invoice(
+        "INV-1001", date(2023, 6, 1), date(2023, 7, 1), [("Widget", 2, 50.0), ("Gadget", 1, 25.5)], 22.59
+    )
+    template = extract.learn_template(text, fields)
+    assert template is not None
+    assert template["VendorBankAccount"]["kind"] == "pattern"
+    assert template["VendorName"]["kind"] == "constant"
+
+    text, expected = _text_invoice(
+        "INV-1002", date(2023, 8, 3), date(2023, 9, 2), [("Bolt", 100, 0.25), ("Nut", 40, 0.1), ("Gear", 3, 1200.0)], 650.0
+    )
+    fields, confidence = extract.apply_template(template, text)
+    assert confidence == 1.0
+    assert extract.coerce_fields(fields) == expected
+    assert extract.line_items_add_up(fields)
+
+
+def test_no_template_from_null_bank_details():
+    from datetime import date
+
+    text, fields = _text_invoice(
+        "INV-1001", date(2023, 6, 1), date(2023, 7, 1), [("Widget", 2, 50.0)], 18.0
+    )
+    fields["VendorBankRoutingNumber"] = None
+
+    # Bank details are always read from the document, never assumed null
+    assert extract.learn_template(text.replace("Routing No: 021000021\n", ""), fields) is None
+
+
+def test_no_template_from_null_fields():
+    """A field read as null is unknown, not always null, so no template assumes it."""
+    from datetime import date
+
+    text, fields = _text_invoice(
+        "INV-1001", date(2023, 6, 1), date(2023, 7, 1), [("Widget", 2, 50.0)], 18.0
+    )
+    fields["Notes"] = None
+
+    assert extract.learn_template(text.replace("Notes: Thank you for your business\n", ""), fields) is None
+
+
+def test_legacy_null_rule_is_a_template_miss():
+    from datetime import date
+
+    text, fields = _text_invoice(
+        "INV-1001", date(2023, 6, 1), date(2023, 7, 1), [("Widget", 2, 50.0)], 18.0
+    )
+    template = extract.learn_template(text, fields)
+    template["Notes"] = {"kind": "null"}
+
+    fields, confidence = extract.apply_template(template, text)
+    assert "Notes" not in fields
+    assert confidence < 1.0
+
+
+def test_template_rejects_other_layouts():
+    from datetime import date
+
+    text, fields = _text_invoice(
+        "INV-1001", date(2023, 6, 1), date(2023, 7, 1), [("Widget", 2, 50.0)], 18.0
+    )
+    template = extract.learn_template(text, fields)
+    other = text.replace("Invoice No:", "Bill #").replace("ACME Supplies Ltd", "Acme Holdings")
+
+    fields, confidence = extract.apply_template(template, other)
+    assert confidence < 1.0
+    assert "InvoiceNumber" not in fields
+    assert "VendorName" not in fields
+
+
+@patch('boto3.client')
+def test_lambda_handler_template_fast_path(mock_boto3_client, monkeypatch):
+    """After one Bedrock extraction, the vendor's next invoices skip Bedrock."""
+    from datetime import date
+
+    first_text, first_fields = _text_invoice(
+        "INV-1001", date(2023, 6, 1), date(2023, 7, 1), [("Widget", 2, 50.0), ("Gadget", 1, 25.5)], 22.59
+    )
+    second_text, second_fields = _text_invoice(
+        "INV-1002", date(2023, 8, 3), date(2023, 9, 2), [("Bolt", 100, 0.25)], 4.5, account="9999999999"
+    )
+    texts = {b"first PDF": first_text, b"second PDF": second_text}
+    monkeypatch.setattr(extract, "pdf_text", lambda document_bytes: texts.get(bytes(document_bytes)))
+    mocks = _mock_clients(mock_boto3_client, json.dumps(first_fields))
+
+    assert lambda_handler(_invoice_event(b"first PDF"), {})["statusCode"] == 200
+    response = lambda_handler(_invoice_event(b"second PDF"), {})
+
+    assert response["statusCode"] == 200
+    mocks["bedrock-runtime"].converse.assert_called_once()
+    detail = json.loads(mocks["events"].put_events.call_args.kwargs["Entries"][0]["Detail"])
+    assert detail["InvoiceNumber"] == "INV-1002"
+    assert detail["TotalAmount"] == 29.5
+    # Changed bank details are read from the document, not the template
+    assert detail["VendorBankAccount"] == "9999999999"
+    assert "template_ms" in json.loads(response["body"])["attachments"][0]["timings"]
+
+
+@patch('boto3.client')
+def test_lambda_handler_template_falls_back_on_mismatch(mock_boto3_client, monkeypatch):
+    """Line items that do not add up send the invoice to Bedrock."""
+    from datetime import date
+
+    first_text, first_fields = _text_invoice(
+        "INV-1001", date(2023, 6, 1), date(2023, 7, 1), [("Widget", 2, 50.0)], 18.0
+    )
+    second_text, _ = _text_invoice(
+        "INV-1002", date(2023, 8, 3), date(2023, 9, 2), [("Bolt", 100, 0.25)], 4.5
+    )
+    second_text = second_text.replace("Total: 29.50", "Total: 2,950.00")
+    texts = {b"first PDF": first_text, b"second PDF": second_text}
+    monkeypatch.setattr(extract, "pdf_text", lambda document_bytes: texts.get(bytes(document_bytes)))
+    mocks = _mock_clients(mock_boto3_client, json.dumps(first_fields))
+
+    lambda_handler(_invoice_event(b"first PDF"), {})
+    lambda_handler(_invoice_event(b"second PDF"), {})
+
+    assert mocks["bedrock-runtime"].converse.call_count == 2
+
+
+def test_system_blocks_cache_point(monkeypatch):
+    """The static system prompt is followed by a cache point where supported."""
+    assert extract.system_blocks("us.amazon.nova-premier-v1:0")[-1] == {"cachePoint": {"type": "default"}}
+    assert len(extract.system_blocks("meta.llama3-70b-instruct-v1:0")) == 1
+
+    monkeypatch.setattr(extract, "PROMPT_CACHING", False)
+    assert extract.system_blocks("us.amazon.nova-premier-v1:0") == [{"text": extract.SYSTEM_PROMPT}]
+
+
+def test_compact_system_prompt_lists_every_field():
+    compact = extract.compact_system_prompt(extract.INVOICE_SCHEMA)
+
+    assert len(compact) < len(extract.system_prompt) / 2
+    for field in extract.INVOICE_SCHEMA["properties"]:
+        assert f"- {field}:" in compact
+    assert "InvoiceDate: YYYY-MM-DD" in compact
+    assert "TotalAmount: number" in compact
+    assert "LineItems: list of {Description, Quantity, UnitPrice, Amount}" in compact
+
+
+@patch('boto3.client')
+def test_lambda_handler_records_token_usage(mock_boto3_client, capsys):
+    """Token counts and latency of each Bedrock call are emitted as metrics."""
+    mocks = _mock_clients(mock_boto3_client, _invoice_output())
+    mocks["bedrock-runtime"].converse.return_value.update({
+        "usage": {"inputTokens": 2400, "outputTokens": 310, "cacheReadInputTokens": 1100},
+        "metrics": {"latencyMs": 4210},
+    })
+
+    lambda_handler(_invoice_event(b"Metered PDF"), {})
+
+    assert mocks["bedrock-runtime"].converse.call_args.kwargs["system"] == extract.system_blocks()
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+    usage = next(r for r in records if r.get("metric") == "BedrockUsage")
+    assert usage["Call"] == "extract"
+    assert usage["InputTokens"] == 2400
+    assert usage["OutputTokens"] == 310
+    assert usage["CacheReadInputTokens"] == 1100
+    assert usage["CacheWriteInputTokens"] == 0
+    assert usage["latency_ms"] == 4210
+
+
+def _pdf_with_pages(texts):
+    """A minimal PDF with one line of Helvetica text per page."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in texts:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>"
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    pdf, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n{body}\nendobj\n".encode()
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return pdf
+
+
+class _FakePage:
+    def __init__(self, text):
+        self.text = text
+
+    def extract_text(self):
+        return self.text
+
+
+def test_select_pages_keeps_invoice_pages():
+    pages = [_FakePage(t) for t in [
+        "Cover letter",
+        "Terms and conditions",
+        "INVOICE  Bill To  Qty  Unit Price  Amount",
+        "Marketing",
+        "Total  Tax  Due  Bank account  IFSC",
+        "",
+    ]]
+
+    assert extract.select_pages(pages, 3) == [0, 2, 4]
+    # Scans without a text layer fall back to page order
+    assert extract.select_pages([_FakePage("")] * 6, 2) == [0, 1]
+
+
+def test_preprocess_document_without_pypdf_is_passthrough(monkeypatch):
+    monkeypatch.setattr(extract, "PdfReader", None)
+    document, stats = extract.preprocess_document(b"%PDF-1.4 anything")
+
+    assert document == b"%PDF-1.4 anything"
+    assert stats == {"OriginalBytes": 17, "SentBytes": 17}
+
+
+@patch('boto3.client')
+def test_lambda_handler_sends_trimmed_pdf_and_uploads_original(mock_boto3_client, monkeypatch):
+    """Bedrock gets only the invoice pages; S3 keeps the original for audit."""
+    pypdf = pytest.importorskip("pypdf")
+    monkeypatch.setattr(extract, "PREPROCESS_MAX_PAGES", 2)
+    texts = ["Cover letter"] + [f"Brochure page {i} " + "x" * 400 for i in range(6)]
+    texts.insert(4, "INVOICE Total Amount Tax Due Bank Account IFSC")
+    original = _pdf_with_pages(texts)
+    mocks = _mock_clients(mock_boto3_client, _invoice_output())
+    uploaded = []
+    mocks["s3"].upload_fileobj.side_effect = lambda fileobj, *args, **kwargs: uploaded.append(fileobj.read())
+
+    response = lambda_handler(_invoice_event(original), {})
+
+    assert response["statusCode"] == 200
+    assert uploaded == [original]
+    sent = mocks["bedrock-runtime"].converse.call_args.kwargs["messages"][0]["content"][0]["document"]["source"]["bytes"]
+    assert len(sent) < len(original)
+    pages = pypdf.PdfReader(BytesIO(sent)).pages
+    assert [p.extract_text() for p in pages] == ["Cover letter", "INVOICE Total Amount Tax Due Bank Account IFSC"]
+    assert "preprocess_ms" in json.loads(response["body"])["attachments"][0]["timings"]
+
+
+@pytest.fixture
+def async_ingest(aws_credentials, monkeypatch):
+    """Moto-backed bucket, queue and jobs table with async ingest switched on."""
+    with mock_s3(), mock_sqs(), mock_dynamodb(), mock_events():
+        boto3.client("s3").create_bucket(Bucket="serverless-trustbill-invoices")
+        queue_url = boto3.client("sqs").create_queue(QueueName="ingest")["QueueUrl"]
+        boto3.resource("dynamodb").create_table(
+            TableName="test-ingest-jobs",
+            KeySchema=[{"AttributeName": "trackingId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "trackingId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        monkeypatch.setattr(extract, "INGEST_MODE", "async")
+        monkeypatch.setattr(extract, "INGEST_QUEUE_URL", queue_url)
+        monkeypatch.setattr(extract, "INGEST_JOBS_TABLE", "test-ingest-jobs")
+        bedrock = MagicMock()
+        bedrock.converse.return_value = {
+            "output": {"message": {"content": [{"text": _invoice_output()}]}}
+        }
+        real_client = boto3.client
+        with patch("boto3.client") as mock_boto3_client:
+            mock_boto3_client.side_effect = lambda service, *args, **kwargs: (
+                bedrock if service == "bedrock-runtime" else real_client(service, *args, **kwargs)
+            )
+            yield {"queue_url": queue_url, "bedrock": bedrock}
+
+
+def _receive_jobs(queue_url):
+    messages = boto3.client("sqs").receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)
+    return {
+        "Records": [
+            {"messageId": m["MessageId"], "body": m["Body"]} for m in messages.get("Messages", [])
+        ]
+    }
+
+
+def _job_status(tracking_id):
+    response = lambda_handler(
+        {
+            "httpMethod": "GET",
+            "resource": "/webhook/jobs/{trackingId}",
+            "pathParameters": {"trackingId": tracking_id},
+        },
+        {},
+    )
+    return response["statusCode"], json.loads(response["body"])
+
+
+def test_async_webhook_returns_202_and_queues_job(async_ingest):
+    response = lambda_handler(_invoice_event(b"Queued PDF"), {})
+
+    assert response["statusCode"] == 202
+    tracking_id = json.loads(response["body"])["trackingId"]
+    async_ingest["bedrock"].converse.assert_not_called()
+    status_code, job = _job_status(tracking_id)
+    assert status_code == 200
+    assert job["status"] == "queued"
+    records = _receive_jobs(async_ingest["queue_url"])["Records"]
+    assert json.loads(records[0]["body"])["trackingId"] == tracking_id
+
+
+def test_queue_handler_processes_batch(async_ingest):
+    """The worker extracts queued jobs and records their results."""
+    tracking_ids = [
+        json.loads(lambda_handler(_invoice_event(f"PDF {i}".encode()), {})["body"])["trackingId"]
+        for i in range(3)
+    ]
+
+    result = extract.queue_handler(_receive_jobs(async_ingest["queue_url"]), {})
+
+    assert result == {"batchItemFailures": []}
+    assert async_ingest["bedrock"].converse.call_count == 3
+    for tracking_id in tracking_ids:
+        status_code, job = _job_status(tracking_id)
+        assert status_code == 200
+        assert job["status"] == "completed"
+        assert job["result"]["attachments"][0]["status"] == "processed"
+
+
+def test_redelivered_job_keeps_invoice_ids(async_ingest):
+    """A job run twice publishes the same InvoiceIds, so verify treats the second run as a replay."""
+    tracking_id = json.loads(lambda_handler(_invoice_event(b"Retried PDF"), {})["body"])["trackingId"]
+    batch = _receive_jobs(async_ingest["queue_url"])
+
+    invoice_ids = []
+    for _ in range(2):
+        assert extract.queue_handler(batch, {}) == {"batchItemFailures": []}
+        invoice_ids.append(_job_status(tracking_id)[1]["result"]["attachments"][0]["InvoiceId"])
+
+    assert invoice_ids[0] == invoice_ids[1] == extract.job_invoice_id(tracking_id, 0)
+    pdfs = boto3.client("s3").list_objects_v2(Bucket="serverless-trustbill-invoices", Prefix="invoice-")
+    assert [o["Key"] for o in pdfs["Contents"]] == [f"invoice-{invoice_ids[0]}.pdf"]
+
+
+def test_queue_handler_reports_partial_batch_failure(async_ingest):
+    """Only jobs that failed outright are handed back to SQS for retry."""
+    ok = async_ingest["bedrock"].converse.return_value
+
+    def converse(**kwargs):
+        document = kwargs["messages"][0]["content"][0]["document"]["source"]["bytes"]
+        if document == b"bad PDF":
+            raise Exception("ThrottlingException")
+        return ok
+
+    async_ingest["bedrock"].converse.side_effect = converse
+    good = json.loads(lambda_handler(_invoice_event(b"good PDF"), {})["body"])["trackingId"]
+    bad = json.loads(lambda_handler(_invoice_event(b"bad PDF"), {})["body"])["trackingId"]
+    batch = _receive_jobs(async_ingest["queue_url"])
+    bad_message = next(r["messageId"] for r in batch["Records"] if bad in r["body"])
+
+    result = extract.queue_handler(batch, {})
+
+    assert result == {"batchItemFailures": [{"itemIdentifier": bad_message}]}
+    assert _job_status(good)[1]["status"] == "completed"
+    assert _job_status(bad)[1]["status"] == "failed"
+
+
+def test_job_with_unrepairable_output_fails(async_ingest):
+    """An answer still invalid after its repair fails the job instead of publishing an empty invoice."""
+    async_ingest["bedrock"].converse.return_value = {
+        "output": {"message": {"content": [{"text": "I cannot read this document."}]}}
+    }
+    tracking_id = json.loads(lambda_handler(_invoice_event(b"Blank PDF"), {})["body"])["trackingId"]
+    batch = _receive_jobs(async_ingest["queue_url"])
+
+    result = extract.queue_handler(batch, {})
+
+    assert result == {"batchItemFailures": [{"itemIdentifier": batch["Records"][0]["messageId"]}]}
+    job = _job_status(tracking_id)[1]
+    assert job["status"] == "failed"
+    assert job["result"]["attachments"][0]["status"] == "failed"
+    assert "Extraction failed validation" in job["result"]["attachments"][0]["error"]
+    pdfs = boto3.client("s3").list_objects_v2(Bucket="serverless-trustbill-invoices", Prefix="invoice-")
+    assert pdfs.get("KeyCount") == 0
+
+
+def test_job_status_unknown_tracking_id(async_ingest):
+    assert _job_status("does-not-exist")[0] == 404
+
+
+def test_decode_attachment_in_chunks(monkeypatch):
+    """Chunked decoding matches b64decode, including line-wrapped content."""
+    monkeypatch.setattr(extract, "DECODE_CHUNK_CHARS", 12)
+    document = os.urandom(1000)
+    encoded = base64.encodebytes(document).decode()  # wrapped every 76 chars
+
+    decoded, digest = extract.decode_attachment(encoded)
+
+    assert decoded == document
+    assert digest == hashlib.sha256(document).hexdigest()
+    assert extract.decoded_size(encoded) == len(document)
+    with pytest.raises(binascii.Error):
+        extract.decode_attachment(base64.b64encode(document).decode()[:-1])
+
+
+def test_decode_attachment_peak_memory():
+    """Decoding allocates the document once plus a few bounded chunks."""
+    document = os.urandom(24 * 1024 * 1024)
+    encoded = base64.b64encode(document).decode()
+
+    tracemalloc.start()
+    decoded, _ = extract.decode_attachment(encoded)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert decoded == document
+    assert peak < len(document) + 3 * extract.DECODE_CHUNK_CHARS
+
+
+def _large_pdf_upload(mock_boto3_client, monkeypatch, output_text):
+    """Mocks with a real moto S3 client and an 11 MiB attachment split into 5 MiB parts."""
+    monkeypatch.setattr(extract, "MULTIPART_UPLOAD_THRESHOLD", 6 * 1024 * 1024)
+    monkeypatch.setattr(extract, "UPLOAD_PART_SIZE", 5 * 1024 * 1024)
+    monkeypatch.setattr(extract, "PREPROCESS_DOCUMENTS", False)
+    mocks = _mock_clients(mock_boto3_client, output_text)
+    mocks["s3"] = s3 = boto3.session.Session().client("s3")
+    return mocks, s3, b"%PDF-1.7" + os.urandom(11 * 1024 * 1024)
+
+
+@patch('boto3.client')
+def test_large_attachment_streams_into_multipart_upload(mock_boto3_client, s3_bucket, monkeypatch):
+    mocks, s3, document = _large_pdf_upload(mock_boto3_client, monkeypatch, _invoice_output())
+
+    response = lambda_handler(_invoice_event(document), {})
+
+    assert response["statusCode"] == 200
+    key = json.loads(mocks["events"].put_events.call_args.kwargs["Entries"][0]["Detail"])["FileURL"].rsplit("/", 1)[1]
+    stored = s3.get_object(Bucket=s3_bucket, Key=key)
+    assert stored["Body"].read() == document
+    assert stored["ETag"].strip('"').endswith("-3")
+    sent = mocks["bedrock-runtime"].converse.call_args.kwargs["messages"][0]["content"][0]
+    assert sent["document"]["source"]["bytes"] == document
+
+
+@patch('boto3.client')
+def test_large_attachment_upload_aborted_when_extraction_fails(mock_boto3_client, s3_bucket, monkeypatch):
+    mocks, s3, document = _large_pdf_upload(mock_boto3_client, monkeypatch, _invoice_output())
+    mocks["bedrock-runtime"].converse.side_effect = Exception("ValidationException")
+
+    response = lambda_handler(_invoice_event(document), {})
+
+    assert response["statusCode"] == 500
+    assert s3.list_multipart_uploads(Bucket=s3_bucket).get("Uploads", []) == []
+    assert s3.list_objects_v2(Bucket=s3_bucket).get("KeyCount") == 0
+
+
+@patch('boto3.client')
+def test_large_attachment_deleted_when_claim_check_fails(mock_boto3_client, s3_bucket, monkeypatch):
+    """The completed multipart upload is deleted, not just aborted."""
+    mocks, s3, document = _large_pdf_upload(mock_boto3_client, monkeypatch, _invoice_output())
+    monkeypatch.setattr(extract, "CLAIM_CHECK_EVENTS", True)
+    monkeypatch.setattr(extract, "check_in_detail", MagicMock(side_effect=Exception("AccessDenied")))
+
+    response = lambda_handler(_invoice_event(document), {})
+
+    assert response["statusCode"] == 500
+    assert "Error storing extraction in S3" in json.loads(response["body"])["message"]
+    mocks["events"].put_events.assert_not_called()
+    assert s3.list_multipart_uploads(Bucket=s3_bucket).get("Uploads", []) == []
+    assert s3.list_objects_v2(Bucket=s3_bucket).get("KeyCount") == 0
+
+
+@patch('boto3.client')
+def test_uploaded_attachment_deleted_when_extraction_fails(mock_boto3_client, s3_bucket):
+    """An upload that finished before Bedrock failed is not left orphaned in S3."""
+    mocks = _mock_clients(mock_boto3_client, "")
+    mocks["s3"] = s3 = boto3.session.Session().client("s3")
+
+    def converse(**kwargs):
+        # Fail only once the upload running alongside has landed
+        deadline = time.monotonic() + 5
+        while not s3.list_objects_v2(Bucket=s3_bucket).get("KeyCount") and time.monotonic() < deadline:
+            time.sleep(0.01)
+        raise Exception("ValidationException")
+
+    mocks["bedrock-runtime"].converse.side_effect = converse
+
+    response = lambda_handler(_invoice_event(b"Small PDF"), {})
+
+    assert response["statusCode"] == 500
+    assert mocks["bedrock-runtime"].converse.called
+    assert s3.list_objects_v2(Bucket=s3_bucket).get("KeyCount") == 0
+
+
+def _throttled(operation="Converse"):
+    return ClientError({"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}}, operation)
+
+
+@patch('boto3.client')
+def test_bedrock_throttling_is_retried_with_backoff(mock_boto3_client, monkeypatch, capsys):
+    """A throttled Converse call is retried instead of failing the invoice."""
+    monkeypatch.setattr(extract, "BEDROCK_BACKOFF_BASE_SECONDS", 0)
+    mocks = _mock_clients(mock_boto3_client, _invoice_output())
+    ok = mocks["bedrock-runtime"].converse.return_value
+    mocks["bedrock-runtime"].converse.side_effect = [_throttled(), _throttled(), ok]
+
+    response = lambda_handler(_invoice_event(b"Throttled PDF"), {})
+
+    assert response["statusCode"] == 200
+    assert mocks["bedrock-runtime"].converse.call_count == 3
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+    throttling = next(r for r in records if r.get("metric") == "BedrockThrottling")
+    assert throttling["Throttles"] == 2
+    assert throttling["Call"] == "extract"
+
+
+@patch('boto3.client')
+def test_bedrock_throttling_gives_up_after_max_attempts(mock_boto3_client, monkeypatch):
+    monkeypatch.setattr(extract, "BEDROCK_BACKOFF_BASE_SECONDS", 0)
+    monkeypatch.setattr(extract, "BEDROCK_MAX_ATTEMPTS", 3)
+    mocks = _mock_clients(mock_boto3_client, _invoice_output())
+    mocks["bedrock-runtime"].converse.side_effect = _throttled()
+
+    response = lambda_handler(_invoice_event(b"Throttled PDF"), {})
+
+    assert response["statusCode"] == 500
+    assert "ThrottlingException" in json.loads(response["body"])["message"]
+    assert mocks["bedrock-runtime"].converse.call_count == 3
+
+
+@patch('boto3.client')
+def test_bedrock_throttling_stops_at_invocation_deadline(mock_boto3_client, monkeypatch):
+    """A backoff that would outlast the Lambda's remaining time fails the attachment instead."""
+    monkeypatch.setattr(extract.ratelimit, "backoff_delay", lambda attempt, base_delay, max_delay: 30)
+    monkeypatch.setattr(extract, "BEDROCK_DEADLINE_MARGIN_SECONDS", 10)
+    mocks = _mock_clients(mock_boto3_client, _invoice_output())
+    mocks["bedrock-runtime"].converse.side_effect = _throttled()
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 30000
+
+    started = time.monotonic()
+    response = lambda_handler(_invoice_event(b"Throttled PDF"), context)
+
+    assert response["statusCode"] == 500
+    assert "ThrottlingException" in json.loads(response["body"])["message"]
+    assert mocks["bedrock-runtime"].converse.call_count == 1
+    assert time.monotonic() - started < 5
+
+
+def test_stream_throttling_event_raises_throttling_error():
+    bedrock = MagicMock()
+    bedrock.converse_stream.return_value = {"stream": [{"throttlingException": {"message": "slow down"}}]}
+
+    with pytest.raises(ClientError) as raised:
+        extract.extract_invoice_streaming(bedrock, b"%PDF")
+
+    assert raised.value.response["Error"]["Code"] == "ThrottlingException"
+
+
+@patch('boto3.client')
+def test_bedrock_calls_charge_shared_rate_limit(mock_boto3_client, aws_credentials, monkeypatch):
+    """Each call takes capacity from the DynamoDB bucket and settles real usage.
+
+    The throttled first attempt is refunded, so only the real usage is charged.
+    """
+    with mock_dynamodb():
+        real_client = boto3.session.Session().client("dynamodb")
+        real_client.create_table(
+            TableName="test-rate-limit",
+            KeySchema=[{"AttributeName": "bucketKey", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "bucketKey", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        mocks = _mock_clients(mock_boto3_client, _invoice_output())
+        mocks["dynamodb"] = real_client
+        ok = mocks["bedrock-runtime"].converse.return_value
+        ok["usage"] = {"inputTokens": 1200, "outputTokens": 300}
+        mocks["bedrock-runtime"].converse.side_effect = [_throttled(), ok]
+        monkeypatch.setattr(extract, "BEDROCK_BACKOFF_BASE_SECONDS", 0)
+        monkeypatch.setattr(extract, "RATE_LIMIT_TABLE", "test-rate-limit")
+        monkeypatch.setattr(extract, "BEDROCK_TOKENS_PER_MINUTE", 600000)
+        monkeypatch.setattr(extract, "bedrock_limiters", {})
+
+        assert lambda_handler(_invoice_event(b"Limited PDF"), {})["statusCode"] == 200
+
+        items = real_client.scan(TableName="test-rate-limit")["Items"]
+    assert len(items) == 1
+    assert items[0]["bucketKey"]["S"].startswith(f"bedrock#{extract.MODEL_ID}#")
+    assert items[0]["requests"] == {"N": "2"}
+    assert items[0]["tokens"] == {"N": "1500"}
+
+
+CHEAP_MODEL = "us.amazon.nova-lite-v1:0"
+
+
+def _routed_answer(**overrides):
+    """A model answer that passes every routing check."""
+    fields = {
+        "TotalAmount": 5,
+        "VendorName": "Acme Supplies",
+        "VendorBankAccount": "1234567890",
+        "VendorIFSCCode": "HDFC0001234",
+        "VendorBankRoutingNumber": "011000015",
+    }
+    fields.update(overrides)
+    return _invoice_output(**fields)
+
+
+def _tiered_bedrock(mock_boto3_client, monkeypatch, answers):
+    """Two model tiers; answers maps model id to output text or an exception."""
+    monkeypatch.setattr(extract, "MODEL_TIERS", [CHEAP_MODEL, extract.MODEL_ID])
+    # No trusted vendor records unless a test provides them
+    monkeypatch.setattr(extract, "vendor_profile", lambda vendor_email: None)
+    mocks = _mock_clients(mock_boto3_client, "")
+
+    def converse(**kwargs):
+        answer = answers[kwargs["modelId"]]
+        if isinstance(answer, Exception):
+            raise answer
+        return {"output": {"message": {"content": [{"text": answer}]}}}
+
+    mocks["bedrock-runtime"].converse.side_effect = converse
+    return mocks
+
+
+def _called_models(mocks):
+    return [call.kwargs["modelId"] for call in mocks["bedrock-runtime"].converse.call_args_list]
+
+
+def _published(mocks):
+    return json.loads(mocks["events"].put_events.call_args.kwargs["Entries"][0]["Detail"])
+
+
+@patch('boto3.client')
+def test_routing_keeps_confident_cheap_answer(mock_boto3_client, monkeypatch, capsys):
+    mocks = _tiered_bedrock(
+        mock_boto3_client, monkeypatch, {CHEAP_MODEL: _routed_answer(), extract.MODEL_ID: "{}"}
+    )
+
+    assert lambda_handler(_invoice_event(b"Simple PDF"), {})["statusCode"] == 200
+
+    assert _called_models(mocks) == [CHEAP_MODEL]
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+    routing = next(r for r in records if r.get("metric") == "ModelRouting")
+    assert routing["Escalations"] == 0
+    assert routing["ModelId"] == CHEAP_MODEL
+    assert routing["decisions"][0]["confidence"] == 1.0
+
+
+@pytest.mark.parametrize("bad_read", [
+    {"TotalAmount": 50},  # line items no longer add up
+    {"VendorIFSCCode": "HDFC001234"},
+    {"VendorBankRoutingNumber": "011000016"},
+    {"InvoiceDate": "sometime in June"},
+    {"InvoiceNumber": None, "Currency": None, "VendorName": None},
+])
+@patch('boto3.client')
+def test_routing_escalates_failing_cheap_answer(mock_boto3_client, monkeypatch, bad_read):
+    premium = _routed_answer(InvoiceNumber="INV-PREMIUM")
+    mocks = _tiered_bedrock(
+        mock_boto3_client, monkeypatch, {CHEAP_MODEL: _routed_answer(**bad_read), extract.MODEL_ID: premium}
+    )
+
+    assert lambda_handler(_invoice_event(b"Tricky PDF"), {})["statusCode"] == 200
+
+    assert _called_models(mocks) == [CHEAP_MODEL, extract.MODEL_ID]
+    assert _published(mocks)["InvoiceNumber"] == "INV-PREMIUM"
+
+
+@patch('boto3.client')
+def test_routing_escalates_when_cheap_model_fails(mock_boto3_client, monkeypatch):
+    mocks = _tiered_bedrock(
+        mock_boto3_client,
+        monkeypatch,
+        {CHEAP_MODEL: Exception("ModelErrorException"), extract.MODEL_ID: _routed_answer()},
+    )
+
+    assert lambda_handler(_invoice_event(b"Any PDF"), {})["statusCode"] == 200
+    assert _called_models(mocks) == [CHEAP_MODEL, extract.MODEL_ID]
+
+
+@patch('boto3.client')
+def test_routing_checks_vendor_profile(mock_boto3_client, monkeypatch):
+    """A cheap read whose bank details differ from the trusted record gets a second read."""
+    mocks = _tiered_bedrock(
+        mock_boto3_client, monkeypatch, {CHEAP_MODEL: _routed_answer(), extract.MODEL_ID: _routed_answer()}
+    )
+    profile = [
+        {"VendorName": "ACME  Supplies", "VendorBankAccount": "9999999999", "VendorIFSCCode": "HDFC0001234"},
+    ]
+    monkeypatch.setattr(extract, "vendor_profile", lambda vendor_email: profile)
+
+    assert lambda_handler(_invoice_event(b"Bank PDF"), {})["statusCode"] == 200
+    assert _called_models(mocks) == [CHEAP_MODEL, extract.MODEL_ID]
+
+    profile[0]["VendorBankAccount"] = "12345 67890"
+    mocks["bedrock-runtime"].converse.reset_mock()
+    assert lambda_handler(_invoice_event(b"Second bank PDF"), {})["statusCode"] == 200
+    assert _called_models(mocks) == [CHEAP_MODEL]
+
+
+def test_vendor_profile_follows_cache_versions(aws_credentials, monkeypatch):
+    """Routing reads trusted vendors through the vendor cache, which a data API change invalidates."""
+    with mock_dynamodb():
+        dynamodb = boto3.resource("dynamodb")
+        table = dynamodb.create_table(
+            TableName="test-vendors",
+            KeySchema=[{"AttributeName": "vendorId", "KeyType": "HASH"}],
+            AttributeDefinitions=[
+                {"AttributeName": "vendorId", "AttributeType": "S"},
+                {"AttributeName": "VendorEmail", "AttributeType": "S"},
+            ],
+            GlobalSecondaryIndexes=[{
+                "IndexName": "VendorEmailIndex",
+                "KeySchema": [{"AttributeName": "VendorEmail", "KeyType": "HASH"}],
+                "Projection": {"ProjectionType": "ALL"},
+            }],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        dynamodb.create_table(
+            TableName="test-cache-versions",
+            KeySchema=[{"AttributeName": "cacheName", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "cacheName", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        table.put_item(Item={"vendorId": "v1", "VendorEmail": "a@example.com", "VendorName": "A"})
+        monkeypatch.setattr(extract, "TRUSTED_VENDORS_TABLE", "test-vendors")
+        monkeypatch.setattr(
+            extract,
+            "vendor_cache",
+            vendorcache.VendorCache(version_table="test-cache-versions", version_check_seconds=0),
+        )
+
+        assert extract.vendor_profile("a@example.com")[0]["VendorName"] == "A"
+        assert extract.vendor_profile("b@example.com") == []
+        table.put_item(Item={"vendorId": "v1", "VendorEmail": "a@example.com", "VendorName": "B"})
+        # Served from the container cache until the version changes
+        assert extract.vendor_profile("a@example.com")[0]["VendorName"] == "A"
+        vendorcache.bump_version("test-cache-versions")
+        assert extract.vendor_profile("a@example.com")[0]["VendorName"] == "B"
+
+
+def test_vendor_profile_without_table(monkeypatch):
+    monkeypatch.setattr(extract, "TRUSTED_VENDORS_TABLE", None)
+    assert extract.vendor_profile("a@example.com") is None
+
+
+def test_routing_number_checksum():
+    assert extract.routing_number_valid("011000015")
+    assert extract.routing_number_valid("021000021")
+    assert not extract.routing_number_valid("021000022")
+    assert not extract.routing_number_valid("12345678")
+
+
+@patch('boto3.client')
+def test_claim_check_event_points_at_stored_detail(mock_boto3_client, s3_bucket, monkeypatch):
+    """Long threads and many line items stay in S3; the event carries a pointer."""
+    monkeypatch.setattr(extract, "CLAIM_CHECK_EVENTS", True)
+    line_items = [{"Description": f"Item {i}", "Quantity": 1, "UnitPrice": 1, "Amount": 1} for i in range(300)]
+    mocks = _mock_clients(mock_boto3_client, _invoice_output(TotalAmount=300, LineItems=line_items))
+    mocks["s3"] = boto3.session.Session().client("s3")
+    event = _invoice_event(b"Long PDF")
+    body = json.loads(event["body"])
+    body["TextBody"] += "\n> earlier message in the thread" * 10000
+    event["body"] = json.dumps(body)
+
+    response = lambda_handler(event, {})
+
+    assert response["statusCode"] == 200
+    entry = mocks["events"].put_events.call_args.kwargs["Entries"][0]
+    assert len(entry["Detail"]) < 1024
+    detail = json.loads(entry["Detail"])
+    assert detail["InvoiceId"] == json.loads(response["body"])["attachments"][0]["InvoiceId"]
+    assert detail["VendorEmail"] == "test@example.com"
+    assert detail["ClaimCheck"]["Key"] == f"extractions/{detail['InvoiceId']}.json"
+    stored = claimcheck.DetailCache().resolve(detail)
+    assert len(stored["LineItems"]) == 300
+    assert stored["TextBody"] == body["TextBody"]
+
+
+@patch('boto3.client')
+def test_claim_check_failure_discards_upload(mock_boto3_client, monkeypatch):
+    monkeypatch.setattr(extract, "CLAIM_CHECK_EVENTS", True)
+    mocks = _mock_clients(mock_boto3_client, _invoice_output())
+    mocks["s3"].put_object.side_effect = Exception("AccessDenied")
+
+    response = lambda_handler(_invoice_event(b"Any PDF"), {})
+
+    assert response["statusCode"] == 500
+    assert "Error storing extraction in S3" in json.loads(response["body"])["message"]
+    mocks["events"].put_events.assert_not_called()
+    mocks["s3"].delete_object.assert_called_once()
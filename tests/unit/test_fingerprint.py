@@ -0,0 +1,162 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_dynamodb
+
+from trustbill.common import clients, fingerprint
+
+FINGERPRINTS = "test-invoice-fingerprints"
+INVOICES = "test-invoices"
+INVOICE = {
+    "InvoiceNumber": "INV-1",
+    "InvoiceDate": "2024-05-02",
+    "Currency": "INR",
+    "TotalAmount": 1680,
+    "TaxAmount": 180,
+    "VendorBankAccount": "1234 5678",
+    "VendorIFSCCode": "TEST0001",
+    "LineItems": [
+        {"Description": "Annual support contract", "Amount": 1000},
+        {"Description": "On-site visit (2 days)", "Amount": 500},
+    ],
+}
+
+
+@pytest.fixture(autouse=True)
+def tables():
+    """Mocked credentials, an empty fingerprints table and an invoices table."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    clients.reset()
+    with mock_dynamodb():
+        dynamodb = boto3.resource("dynamodb")
+        dynamodb.create_table(
+            TableName=FINGERPRINTS,
+            KeySchema=[
+                {"AttributeName": "bandKey", "KeyType": "HASH"},
+                {"AttributeName": "invoiceId", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "bandKey", "AttributeType": "S"},
+                {"AttributeName": "invoiceId", "AttributeType": "S"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        invoices = dynamodb.create_table(
+            TableName=INVOICES,
+            KeySchema=[{"AttributeName": "invoiceId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "invoiceId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield invoices
+    clients.reset()
+
+
+def test_signature_ignores_number_sender_and_formatting():
+    variant = dict(
+        INVOICE,
+        InvoiceNumber="INV-2",
+        VendorEmail="other@example.com",
+        TotalAmount="1,680.00",
+        VendorBankAccount="12345678",
+        LineItems=[
+            {"Description": "ANNUAL SUPPORT CONTRACT", "Amount": "1000"},
+            {"Description": "On-site visit, 2 days", "Amount": 500.0},
+        ],
+    )
+
+    assert fingerprint.signature(variant) == fingerprint.signature(INVOICE)
+
+
+def test_similarity_tracks_shared_content():
+    shifted = dict(INVOICE, InvoiceDate="2024-06-01")
+    different = dict(
+        INVOICE,
+        TotalAmount=99,
+        TaxAmount=9,
+        VendorBankAccount="999",
+        VendorIFSCCode="OTHER",
+        LineItems=[{"Description": "Printer toner", "Amount": 90}],
+    )
+    sig = fingerprint.signature(INVOICE)
+
+    assert fingerprint.similarity(sig, fingerprint.signature(shifted)) > 0.7
+    assert fingerprint.similarity(sig, fingerprint.signature(different)) < 0.3
+    assert fingerprint.signature({"TotalAmount": 5}) is None
+    assert len(set(fingerprint.band_keys(sig))) == fingerprint.BANDS
+
+
+def test_index_and_find_similar():
+    sig = fingerprint.signature(INVOICE)
+    fingerprint.index(FINGERPRINTS, "inv-1", sig, "a@example.com", "INV-1")
+    fingerprint.index(FINGERPRINTS, "inv-2", fingerprint.signature(dict(INVOICE, TotalAmount=1)))
+    fingerprint.index(FINGERPRINTS, "inv-3", fingerprint.signature({"TotalAmount": 7, "TaxAmount": 1, "Currency": "USD", "VendorIFSCCode": "X"}))
+
+    matches = fingerprint.find_similar(FINGERPRINTS, sig, 0.8)
+
+    assert [invoice_id for invoice_id, _ in matches] == ["inv-1", "inv-2"]
+    assert matches[0][1] == 1.0
+    assert fingerprint.find_similar(FINGERPRINTS, sig, 0.8, exclude={"inv-1"})[0][0] == "inv-2"
+
+
+def test_find_similar_leaves_out_bills_of_the_same_series():
+    sig = fingerprint.signature(INVOICE)
+    fingerprint.index(FINGERPRINTS, "inv-1", sig, "a@example.com", "INV-1", INVOICE["InvoiceDate"])
+    next_month = dict(INVOICE, VendorEmail="A@example.com", InvoiceNumber="INV-2", InvoiceDate="2024-06-02")
+
+    assert fingerprint.find_similar(FINGERPRINTS, sig, 0.5, data=next_month) == []
+    # Another sender, the same number or the same month is still a match
+    for data in (
+        dict(next_month, VendorEmail="b@example.com"),
+        dict(next_month, InvoiceNumber="inv 1"),
+        dict(next_month, InvoiceDate="2024-05-20"),
+    ):
+        assert [match[0] for match in fingerprint.find_similar(FINGERPRINTS, sig, 0.5, data=data)] == ["inv-1"]
+
+
+def test_series_is_filtered_by_the_band_queries(monkeypatch):
+    sig = fingerprint.signature(INVOICE)
+    fingerprint.index(FINGERPRINTS, "inv-1", sig, "a@example.com", "INV-1", INVOICE["InvoiceDate"])
+    next_month = dict(INVOICE, VendorEmail="A@example.com", InvoiceNumber="INV-2", InvoiceDate="2024-06-02")
+    # Only the query can leave it out now
+    monkeypatch.setattr(fingerprint, "recurring", lambda data, candidate: False)
+
+    assert fingerprint.find_similar(FINGERPRINTS, sig, 0.5, data=next_month) == []
+    assert [match[0] for match in fingerprint.find_similar(FINGERPRINTS, sig, 0.5)] == ["inv-1"]
+
+
+def test_band_queries_read_a_bounded_bucket(monkeypatch):
+    monkeypatch.setattr(fingerprint, "BUCKET_READ_LIMIT", 3)
+    sig = fingerprint.signature(INVOICE)
+    for i in range(5):
+        fingerprint.index(FINGERPRINTS, f"inv-{i}", sig)
+
+    assert len(fingerprint.find_similar(FINGERPRINTS, sig, 0.5)) == 3
+
+
+def test_band_queries_share_one_pool():
+    fingerprint.find_similar(FINGERPRINTS, fingerprint.signature(INVOICE), 0.5)
+
+    assert fingerprint.executor() is fingerprint.executor()
+
+
+def test_backfill_indexes_stored_invoices(tables):
+    tables.put_item(
+        Item={
+            "invoiceId": "inv-1",
+            "VendorEmail": "a@example.com",
+            "InvoiceNumber": "INV-1",
+            "InvoiceDate": INVOICE["InvoiceDate"],
+            "Currency": "INR",
+            "TotalAmount": "1680",
+            "TaxAmount": "180",
+            "Items": [{"Description": i["Description"], "Amount": str(i["Amount"])} for i in INVOICE["LineItems"]],
+            "VendorInfo": {"VendorBankAccount": "12345678", "VendorIFSCCode": "TEST0001"},
+        }
+    )
+    tables.put_item(Item={"invoiceId": "inv-2", "TotalAmount": "-"})
+
+    assert fingerprint.backfill(INVOICES, FINGERPRINTS) == 1
+    assert fingerprint.find_similar(FINGERPRINTS, fingerprint.signature(INVOICE), 0.99) == [("inv-1", 1.0)]
@@ -0,0 +1,23 @@
+from trustbill.common import idempotency
+
+
+def test_result_cache_is_a_bounded_lru():
+    cache = idempotency.ResultCache(max_entries=2)
+    cache.put("a", {"DuplicateInvoice": False})
+    cache.put("b", {"DuplicateInvoice": True})
+    assert cache.get("a") == {"DuplicateInvoice": False}
+    cache.put("c", {})
+
+    assert cache.get("b") is None
+    assert cache.get("c") == {}
+    assert cache.stats == {"hits": 2, "misses": 1}
+
+
+def test_result_cache_returns_copies():
+    cache = idempotency.ResultCache()
+    flags = {"UnusualAmounts": False}
+    cache.put("a", flags)
+    flags["UnusualAmounts"] = True
+    cache.get("a")["UnusualAmounts"] = True
+
+    assert cache.get("a") == {"UnusualAmounts": False}
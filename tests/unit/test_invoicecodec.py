@@ -0,0 +1,81 @@
+import zlib
+from decimal import Decimal
+
+import pytest
+from boto3.dynamodb.types import Binary
+
+from trustbill.common import invoicecodec
+
+VENDOR = {
+    "vendorId": "6f1c",
+    "VendorEmail": "vendor@example.com",
+    "VendorName": "Vendor",
+    "VendorAddress": None,
+    "VendorGSTIN": "29ABCDE1234F1Z5",
+    "VendorBankName": "Bank",
+    "VendorBankAccount": "12345678",
+    "VendorIFSCCode": "BANK0001",
+    "VendorBankRoutingNumber": None,
+}
+
+
+def _invoice(lines):
+    return {
+        "invoiceId": "inv-1",
+        "VendorEmail": "vendor@example.com",
+        "TotalAmount": "1000",
+        "Items": [
+            {"Description": f"Widget {i}", "Quantity": "2", "UnitPrice": "12.5", "Amount": "25"}
+            for i in range(lines)
+        ],
+        "Flags": {"DuplicateInvoice": False},
+        "VendorInfo": VENDOR,
+    }
+
+
+def test_pack_round_trip():
+    invoice = _invoice(3)
+    invoice["Items"][0]["HSNCode"] = "8471"
+
+    packed = invoicecodec.pack(invoice)
+
+    assert set(packed) == {"invoiceId", "VendorEmail", "TotalAmount", "Flags", "Packed"}
+    assert packed["Packed"][0] == invoicecodec.SCHEMA_VERSION
+    # As read back from DynamoDB
+    assert invoicecodec.unpack(dict(packed, Packed=Binary(packed["Packed"]))) == invoice
+
+
+def test_unpack_decodes_only_requested_fields():
+    packed = invoicecodec.pack(_invoice(2))
+
+    only_items = invoicecodec.unpack(packed, ["Items"])
+    neither = invoicecodec.unpack(packed, ["Flags"])
+
+    assert len(only_items["Items"]) == 2 and "VendorInfo" not in only_items
+    assert "Items" not in neither and "Packed" not in neither
+    assert invoicecodec.unpack({"invoiceId": "plain", "Items": []}) == {"invoiceId": "plain", "Items": []}
+
+
+def test_decimals_and_missing_snapshot():
+    items, vendor = invoicecodec.decode(invoicecodec.encode([{"Amount": Decimal("10.50")}], None))
+
+    assert items == [{"Amount": "10.50"}]
+    assert vendor is None
+
+
+def test_rejects_unknown_or_corrupt_blobs():
+    with pytest.raises(invoicecodec.CodecError, match="schema"):
+        invoicecodec.decode(bytes([99]) + zlib.compress(b"{}"))
+    with pytest.raises(invoicecodec.CodecError, match="Corrupt"):
+        invoicecodec.decode(bytes([1]) + b"not zlib")
+
+
+def test_packing_cuts_capacity_of_large_invoices():
+    invoice = _invoice(200)
+
+    before = invoicecodec.capacity(invoice)
+    after = invoicecodec.capacity(invoicecodec.pack(invoice))
+
+    assert after["Bytes"] < before["Bytes"] / 5
+    assert after["WriteUnits"] < before["WriteUnits"]
+    assert invoicecodec.item_size({"a": "xy", "n": 100, "b": True}) == (1 + 2) + (1 + 3) + (1 + 1)
@@ -0,0 +1,26 @@
+import json
+
+from trustbill.common import metrics
+
+
+def test_emit_embedded_metric_format(capsys):
+    """Records follow the CloudWatch Embedded Metric Format."""
+    metrics.emit(
+        "BedrockUsage",
+        {"InputTokens": 1200, "latency_ms": 850.5},
+        dimensions={"ModelId": "model"},
+        outcome="valid",
+    )
+
+    record = json.loads(capsys.readouterr().out)
+    directive = record["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == metrics.NAMESPACE
+    assert directive["Dimensions"] == [["metric", "ModelId"]]
+    assert directive["Metrics"] == [
+        {"Name": "InputTokens", "Unit": "Count"},
+        {"Name": "latency_ms", "Unit": "Milliseconds"},
+    ]
+    assert record["metric"] == "BedrockUsage"
+    assert record["ModelId"] == "model"
+    assert record["InputTokens"] == 1200
+    assert record["outcome"] == "valid"
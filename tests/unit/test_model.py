@@ -0,0 +1,115 @@
+import copy
+import json
+from decimal import Decimal
+
+from trustbill.common import invoicecodec, model
+
+DETAIL = {
+    "InvoiceId": "inv-1",
+    "VendorEmail": "vendor@example.com",
+    "InvoiceNumber": "INV-1",
+    "InvoiceDate": "2024-05-02",
+    "DueDate": None,
+    "Currency": "INR",
+    "TotalAmount": 1180.1,
+    "TaxAmount": 180,
+    "VendorName": "Vendor",
+    "VendorGSTIN": "29ABCDE1234F1Z5",
+    "VendorBankAccount": "12345678",
+    "VendorIFSCCode": "BANK0001",
+    "LineItems": [
+        {"Description": "Widget", "Quantity": 2, "UnitPrice": 500.05, "Amount": 1000.1, "HSNCode": 8471},
+        {"Description": None, "Quantity": None, "UnitPrice": "N/A", "Amount": "0.10"},
+        {"Description": "Freight", "Amount": 0.1},
+    ],
+    "Notes": "Thanks",
+    "CustomerName": "Buyer Ltd",
+    "FileURL": "https://bucket/invoice.pdf",
+}
+
+
+def test_amounts_are_decimals():
+    assert model.amount(0.1) == Decimal("0.1")
+    assert model.amount(180) == Decimal(180)
+    assert model.amount("12.50") == Decimal("12.50")
+    assert model.amount("-") is None
+    assert model.amount("1,200") == "1,200"
+    assert model.amount("NaN") == "NaN"
+
+    invoice = model.Invoice.from_extracted(DETAIL)
+    assert invoice.total_amount == Decimal("1180.1")
+    assert invoice.items[0].unit_price == Decimal("500.05")
+    assert invoice.items[1].description is None
+    stored = model.Invoice.from_item(invoice.to_item())
+    assert stored.total_amount == Decimal("1180.1")
+    assert stored.items[0].amount == Decimal("1000.1")
+    assert stored.items[1].quantity is None
+
+
+def test_stored_item_keeps_existing_layout():
+    item = model.Invoice.from_extracted(DETAIL, {"DuplicateInvoice": False}).to_item()
+
+    assert item["invoiceId"] == "inv-1"
+    assert item["TotalAmount"] == "1180.1"
+    assert item["TaxAmount"] == "180"
+    assert item["Items"] == [
+        {"Description": "Widget", "Quantity": "2", "UnitPrice": "500.05", "Amount": "1000.1", "HSNCode": "8471"},
+        {"Description": "-", "Quantity": "-", "UnitPrice": "N/A", "Amount": "0.10"},
+        # Fields the extraction left out stay out
+        {"Description": "Freight", "Amount": "0.1"},
+    ]
+    assert item["Flags"] == {"DuplicateInvoice": False}
+    assert item["VendorInfo"]["VendorGSTIN"] == "29ABCDE1234F1Z5"
+    assert item["VendorInfo"]["VendorAddress"] is None
+    assert item["VendorInfo"]["vendorId"]
+    assert "VendorResolution" not in item
+    assert "CustomerName" not in item
+
+
+def test_converters_leave_their_input_unchanged():
+    detail = copy.deepcopy(DETAIL)
+
+    invoice = model.Invoice.from_extracted(detail)
+    invoice.to_item()
+    invoice.to_detail()
+
+    assert detail == DETAIL
+
+
+def test_detail_without_id_or_amounts():
+    item = model.Invoice.from_extracted({"VendorEmail": "vendor@example.com", "TotalAmount": None}).to_item()
+
+    assert item["invoiceId"]
+    assert item["TotalAmount"] == "-"
+    assert item["TaxAmount"] == "-"
+    assert item["Items"] == []
+
+
+def test_item_round_trip_packed_or_not():
+    item = model.Invoice.from_extracted(DETAIL, {"DuplicateInvoice": False}).to_item()
+    item["VendorResolution"] = {"vendorId": "v-1", "score": "0.75"}
+    item["NearDuplicateOf"] = ["inv-0"]
+
+    assert model.Invoice.from_item(item).to_item() == item
+    assert model.Invoice.from_item(invoicecodec.pack(item)).to_item() == item
+
+
+def test_detail_round_trip():
+    detail = model.Invoice.from_extracted(DETAIL).to_detail()
+
+    assert detail == DETAIL | {"TermsAndConditions": None, "VendorAddress": None, "VendorBankName": None,
+                               "VendorBankRoutingNumber": None}
+    # From the stored item, amounts are JSON numbers again
+    stored = model.Invoice.from_item(model.Invoice.from_extracted(DETAIL).to_item()).to_detail()
+    assert stored["TotalAmount"] == 1180.1
+    assert stored["TaxAmount"] == 180
+    assert stored["LineItems"][0] == DETAIL["LineItems"][0] | {"HSNCode": "8471"}
+    assert stored["LineItems"][1] == {"Description": None, "Quantity": None, "UnitPrice": "N/A", "Amount": 0.1}
+    assert stored["VendorBankAccount"] == "12345678"
+    assert "vendorId" not in stored
+
+
+def test_dumps_handles_dynamodb_types():
+    body = json.loads(model.dumps({"total": Decimal("12.50"), "vendorIds": {"b", "a"}, "flags": None}))
+
+    assert body == {"total": "12.50", "vendorIds": ["a", "b"], "flags": None}
@@ -0,0 +1,231 @@
+import os
+import threading
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_dynamodb
+
+from trustbill.common import clients, ratelimit
+
+TABLE = "test-rate-limit"
+
+
+@pytest.fixture(autouse=True)
+def rate_limit_table():
+    """Mocked credentials and an empty counter table."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    clients.reset()
+    with mock_dynamodb():
+        boto3.client("dynamodb").create_table(
+            TableName=TABLE,
+            KeySchema=[{"AttributeName": "bucketKey", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "bucketKey", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield
+    clients.reset()
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def _bucket(clock, requests_per_minute=60, tokens_per_minute=600, **kwargs):
+    # 10 second windows: 10 requests and 100 tokens each
+    return ratelimit.TokenBucket(
+        TABLE,
+        "bedrock#test",
+        requests_per_minute,
+        tokens_per_minute,
+        window_seconds=10,
+        clock=clock.time,
+        sleep=clock.sleep,
+        **kwargs,
+    )
+
+
+def _throttle(operation="Converse"):
+    return ClientError({"Error": {"Code": "ThrottlingException", "Message": "slow down"}}, operation)
+
+
+def test_acquire_waits_for_next_window_when_requests_run_out():
+    clock = FakeClock()
+    bucket = _bucket(clock)
+
+    for _ in range(10):
+        assert bucket.acquire(5)["wait_ms"] == 0
+
+    reservation = bucket.acquire(5)
+
+    assert reservation["denied"] == 1
+    assert reservation["window"] == 1010
+    assert 10 <= clock.now - 1000 <= 12.5
+    assert reservation["wait_ms"] == round((clock.now - 1000) * 1000, 2)
+
+
+def test_acquire_respects_token_budget_and_settle_returns_tokens():
+    clock = FakeClock()
+    bucket = _bucket(clock)
+
+    first = bucket.acquire(80)
+    # Reported usage was lower than the estimate, which frees room
+    bucket.settle(first, 30)
+    second = bucket.acquire(60)
+
+    assert second["denied"] == 0
+    assert second["window"] == first["window"]
+    item = boto3.client("dynamodb").get_item(
+        TableName=TABLE, Key={"bucketKey": {"S": f"bedrock#test#{first['window']}"}}
+    )["Item"]
+    assert item["requests"] == {"N": "2"}
+    assert item["tokens"] == {"N": "90"}
+
+    third = bucket.acquire(60)
+    assert third["denied"] == 1 and third["window"] == first["window"] + 10
+
+
+def test_acquire_gives_up_after_max_wait():
+    clock = FakeClock()
+    bucket = _bucket(clock, max_wait_seconds=5)
+    for _ in range(10):
+        bucket.acquire(1)
+
+    with pytest.raises(ratelimit.RateLimited):
+        bucket.acquire(1)
+    assert clock.slept == []
+
+
+def test_acquire_stops_at_deadline():
+    """A wait that would outlast the caller's deadline fails at once."""
+    clock = FakeClock()
+    bucket = _bucket(clock)
+    for _ in range(10):
+        bucket.acquire(1)
+
+    with pytest.raises(ratelimit.DeadlineExceeded):
+        bucket.acquire(1, deadline=clock.now + 5)
+    assert clock.slept == []
+
+
+def test_acquire_fails_open_without_table():
+    bucket = ratelimit.TokenBucket("missing-table", "bedrock#test", 60, 600)
+
+    assert bucket.acquire(5) == {"window": None, "tokens": 5, "wait_ms": 0, "denied": 0}
+
+
+def test_concurrent_acquires_never_exceed_capacity():
+    """Callers racing on one window get exactly its capacity, no more."""
+    clock = FakeClock()
+    bucket = _bucket(clock, max_wait_seconds=0)
+    granted = []
+    limited = []
+
+    def worker():
+        try:
+            granted.append(bucket.acquire(1))
+        except ratelimit.RateLimited:
+            limited.append(True)
+
+    threads = [threading.Thread(target=worker) for _ in range(25)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(granted) == 10
+    assert len(limited) == 15
+
+
+def test_retry_throttled_backs_off_then_succeeds():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _throttle()
+        return "ok"
+
+    stats = {}
+    assert ratelimit.retry_throttled(flaky, stats, base_delay=0) == "ok"
+    assert stats["throttles"] == 2
+    assert len(calls) == 3
+
+
+def test_retry_throttled_raises_other_errors_and_last_throttle():
+    def invalid():
+        raise ClientError({"Error": {"Code": "ValidationException"}}, "Converse")
+
+    stats = {}
+    with pytest.raises(ClientError):
+        ratelimit.retry_throttled(invalid, stats, base_delay=0)
+    assert stats == {}
+
+    def always_throttled():
+        raise _throttle()
+
+    with pytest.raises(ClientError):
+        ratelimit.retry_throttled(always_throttled, stats, max_attempts=3, base_delay=0)
+    assert stats["throttles"] == 2
+
+
+def test_retry_throttled_does_not_sleep_past_deadline(monkeypatch):
+    monkeypatch.setattr(ratelimit, "backoff_delay", lambda attempt, base_delay, max_delay: 30)
+    monkeypatch.setattr(ratelimit.time, "sleep", lambda seconds: pytest.fail("slept past the deadline"))
+    calls = []
+
+    def throttled():
+        calls.append(1)
+        raise _throttle()
+
+    stats = {}
+    with pytest.raises(ClientError):
+        ratelimit.retry_throttled(throttled, stats, deadline=ratelimit.time.time() + 10)
+    assert len(calls) == 1
+    assert stats == {"deadline_exceeded": 1}
+
+
+def test_backoff_delay_is_capped_full_jitter():
+    delays = [ratelimit.backoff_delay(attempt, 1.0, 8.0) for attempt in range(10) for _ in range(20)]
+
+    assert all(0 <= delay <= 8.0 for delay in delays)
+    assert max(delays) > 4.0
+
+
+def test_limiter_keeps_goodput_at_quota():
+    """A burst against a quota-enforcing fake Bedrock completes without throttles.
+
+    Every call gets through in the fewest windows the quota allows, instead
+    of most of the burst being rejected and retried.
+    """
+    clock = FakeClock()
+    bucket = _bucket(clock)
+    served = {}
+
+    def fake_converse():
+        window = int(clock.now // 10)
+        served[window] = served.get(window, 0) + 1
+        if served[window] > 10:
+            raise _throttle()
+        return "ok"
+
+    stats = {}
+    for _ in range(35):
+        assert ratelimit.retry_throttled(
+            lambda: bucket.acquire(1) and fake_converse(), stats, base_delay=0
+        ) == "ok"
+
+    assert stats == {}
+    assert len(served) == 4
+    assert clock.now - 1000 < 40
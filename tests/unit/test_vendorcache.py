@@ -0,0 +1,108 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_dynamodb
+
+from trustbill.common import clients, vendorcache
+
+TABLE = "test-cache-versions"
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(autouse=True)
+def versions_table():
+    """Mocked credentials and an empty version table."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    clients.reset()
+    with mock_dynamodb():
+        boto3.client("dynamodb").create_table(
+            TableName=TABLE,
+            KeySchema=[{"AttributeName": "cacheName", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "cacheName", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield
+    clients.reset()
+
+
+def _loader(records):
+    calls = []
+
+    def load():
+        calls.append(True)
+        return records
+
+    return load, calls
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = vendorcache.VendorCache(ttl_seconds=300, clock=clock)
+    load, calls = _loader([{"VendorEmail": "a@example.com"}])
+
+    assert cache.get("a@example.com", load) == ([{"VendorEmail": "a@example.com"}], None)
+    clock.now += 299
+    assert cache.get("a@example.com", load)[1] == 299
+    clock.now += 1
+    cache.get("a@example.com", load)
+
+    assert len(calls) == 2
+    assert cache.stats["hits"] == 1
+    assert cache.hit_rate == pytest.approx(1 / 3, rel=1e-3)
+
+
+def test_unknown_senders_are_cached_briefly():
+    clock = FakeClock()
+    cache = vendorcache.VendorCache(negative_ttl_seconds=60, clock=clock)
+    load, calls = _loader([])
+
+    cache.get("stranger@example.com", load)
+    clock.now += 59
+    assert cache.get("stranger@example.com", load) == ([], 59)
+    clock.now += 1
+    cache.get("stranger@example.com", load)
+
+    assert len(calls) == 2
+    assert cache.stats["negative_hits"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = vendorcache.VendorCache(max_entries=2, clock=FakeClock())
+    load, calls = _loader([{"VendorName": "V"}])
+
+    cache.get("a", load)
+    cache.get("b", load)
+    cache.get("a", load)
+    cache.get("c", load)
+    cache.get("a", load)
+    cache.get("b", load)
+
+    assert len(calls) == 4
+    assert cache.stats["evictions"] == 2
+
+
+def test_version_bump_invalidates_within_check_interval():
+    clock = FakeClock()
+    cache = vendorcache.VendorCache(version_table=TABLE, version_check_seconds=30, clock=clock)
+    load, calls = _loader([{"VendorBankAccount": "1"}])
+    cache.get("a@example.com", load)
+
+    assert vendorcache.bump_version(TABLE) == 1
+    clock.now += 29
+    assert cache.get("a@example.com", load)[1] == 29  # bounded stale read
+    clock.now += 1
+    assert cache.get("a@example.com", load)[1] is None
+
+    assert len(calls) == 2
+    assert cache.stats["invalidations"] == 1
+    assert vendorcache.bump_version(TABLE) == 2
@@ -0,0 +1,99 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_dynamodb
+
+from trustbill.common import clients, vendorindex
+
+KEYS = "test-vendor-keys"
+VENDORS = "test-vendors"
+ACME = {
+    "vendorId": "acme",
+    "VendorEmail": "billing@acme.example",
+    "VendorName": "Acme Traders Pvt. Ltd.",
+    "VendorGSTIN": "29abcde1234f1z5",
+    "VendorBankAccount": "0001 2345 6789",
+    "VendorIFSCCode": "HDFC0000001",
+}
+GLOBEX = {
+    "vendorId": "globex",
+    "VendorEmail": "ap@globex.example",
+    "VendorName": "Globex Corporation",
+    "VendorBankAccount": "999888777",
+    "VendorBankRoutingNumber": "021000021",
+}
+
+
+@pytest.fixture(autouse=True)
+def tables():
+    """Mocked credentials, an empty lookup keys table and a vendors table."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    clients.reset()
+    with mock_dynamodb():
+        dynamodb = boto3.resource("dynamodb")
+        dynamodb.create_table(
+            TableName=KEYS,
+            KeySchema=[{"AttributeName": "lookupKey", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "lookupKey", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        vendors = dynamodb.create_table(
+            TableName=VENDORS,
+            KeySchema=[{"AttributeName": "vendorId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "vendorId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        for vendor in (ACME, GLOBEX):
+            vendors.put_item(Item=vendor)
+        yield vendors
+    clients.reset()
+
+
+def test_lookup_keys_are_normalized():
+    keys = dict((kind, key) for kind, key in vendorindex.lookup_keys(ACME))
+
+    assert keys["email"] == "email:billing@acme.example"
+    assert keys["gstin"] == "gstin:29ABCDE1234F1Z5"
+    assert keys["name"] == "name:acme traders"
+    assert keys["bank"] == vendorindex.bank_key("000123456789", "hdfc0000001")
+    assert vendorindex.normalize_name("The ACME traders, Ltd") == "acme traders"
+    assert vendorindex.bank_key("123", None) is None
+
+
+def test_resolves_new_sender_by_gstin_and_bank():
+    assert vendorindex.backfill(VENDORS, KEYS) == 2
+    invoice = dict(ACME, VendorEmail="accounts@acme-mail.example", VendorName="ACME Traders")
+
+    resolution = vendorindex.resolve(KEYS, invoice)
+
+    assert resolution.vendor_id == "acme"
+    assert resolution.matches["acme"] == {"gstin", "bank", "name"}
+    assert resolution.score == 0.8
+    assert resolution.bank_conflict is False
+
+
+def test_reports_bank_account_of_other_vendor():
+    vendorindex.backfill(VENDORS, KEYS)
+    # Acme's sender and GSTIN, Globex's bank account
+    invoice = dict(ACME, VendorBankAccount=GLOBEX["VendorBankAccount"], VendorIFSCCode=None,
+                   VendorBankRoutingNumber=GLOBEX["VendorBankRoutingNumber"])
+
+    resolution = vendorindex.resolve(KEYS, invoice)
+
+    assert resolution.vendor_id == "acme"
+    assert resolution.bank_owners == {"globex"}
+    assert resolution.bank_conflict is True
+    assert resolution.to_item()["bankOwners"] == ["globex"]
+
+
+def test_unknown_invoice_resolves_to_nothing():
+    vendorindex.backfill(VENDORS, KEYS)
+
+    resolution = vendorindex.resolve(KEYS, {"VendorEmail": "x@example.com", "VendorName": "Initech"})
+
+    assert resolution.vendor_id is None
+    assert resolution.bank_conflict is False
+    assert vendorindex.resolve(KEYS, {}).matches == {}
@@ -0,0 +1,162 @@
+import os
+import threading
+from decimal import Decimal
+
+import boto3
+import pytest
+from moto import mock_dynamodb
+from moto.dynamodb.models import DynamoDBBackend
+
+from trustbill.common import clients, vendorstats
+
+STATS = "test-vendor-stats"
+INVOICES = "test-invoices"
+
+
+@pytest.fixture(autouse=True)
+def tables():
+    """Mocked credentials, an empty statistics table and an invoices table."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    clients.reset()
+    with mock_dynamodb():
+        dynamodb = boto3.resource("dynamodb")
+        dynamodb.create_table(
+            TableName=STATS,
+            KeySchema=[
+                {"AttributeName": "VendorEmail", "KeyType": "HASH"},
+                {"AttributeName": "Currency", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "VendorEmail", "AttributeType": "S"},
+                {"AttributeName": "Currency", "AttributeType": "S"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        invoices = dynamodb.create_table(
+            TableName=INVOICES,
+            KeySchema=[{"AttributeName": "invoiceId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "invoiceId", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield invoices
+    clients.reset()
+
+
+def test_record_keeps_running_statistics():
+    for amount in ["1000", "1200", "800.50"]:
+        vendorstats.record(STATS, "a@example.com", "inr", amount)
+    vendorstats.record(STATS, "a@example.com", "USD", 10)
+    vendorstats.record(STATS, "a@example.com", "INR", "-")
+
+    stats = vendorstats.get(STATS, "a@example.com", "INR")
+    assert stats.count == 3
+    assert stats.total == Decimal("3000.50")
+    assert stats.sum_squares == Decimal("3080800.25")
+    assert stats.mean == pytest.approx(1000.1667, rel=1e-4)
+    assert stats.stddev == pytest.approx(199.75, rel=1e-3)
+    assert float(stats.ewma) == pytest.approx(1000 + 0.1 * 200 + 0.1 * (800.5 - 1020))
+    assert stats.version == 3
+    assert vendorstats.get(STATS, "a@example.com", "USD").count == 1
+    assert vendorstats.get(STATS, "b@example.com", "INR") is None
+
+
+@pytest.fixture
+def atomic_writes(monkeypatch):
+    """Apply moto's item writes one at a time, as DynamoDB does per item."""
+    lock = threading.Lock()
+    for name in ("put_item", "update_item"):
+        write = getattr(DynamoDBBackend, name)
+
+        def locked(self, *args, _write=write, **kwargs):
+            with lock:
+                return _write(self, *args, **kwargs)
+
+        monkeypatch.setattr(DynamoDBBackend, name, locked)
+
+
+def test_concurrent_records_are_not_lost(atomic_writes):
+    threads = [
+        threading.Thread(target=vendorstats.record, args=(STATS, "a@example.com", "INR", 100))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = vendorstats.get(STATS, "a@example.com", "INR")
+    assert stats.count == 8
+    assert stats.total == 800
+
+
+def test_contended_records_keep_exact_sums(monkeypatch, capsys):
+    """A writer that keeps losing the estimate race still has its amounts counted."""
+    vendorstats.record(STATS, "a@example.com", "INR", 100)
+    read = vendorstats.get
+
+    def get_then_lose_race(table_name, vendor_email, currency):
+        stats = read(table_name, vendor_email, currency)
+        # Another writer updates the estimates between this read and the write
+        clients.table(STATS).update_item(
+            Key={"VendorEmail": vendor_email, "Currency": currency},
+            UpdateExpression="ADD #version :one",
+            ExpressionAttributeNames={"#version": "version"},
+            ExpressionAttributeValues={":one": 1},
+        )
+        return stats
+
+    monkeypatch.setattr(vendorstats, "get", get_then_lose_race)
+    monkeypatch.setattr(vendorstats, "MAX_UPDATE_ATTEMPTS", 2)
+    vendorstats.record_many(STATS, "a@example.com", "INR", [50, "x", 150])
+    monkeypatch.setattr(vendorstats, "get", read)
+
+    stats = vendorstats.get(STATS, "a@example.com", "INR")
+    assert (stats.count, stats.total, stats.sum_squares) == (3, 300, 100 * 100 + 50 * 50 + 150 * 150)
+    assert stats.ewma == 100
+    assert "Could not update the amount estimates" in capsys.readouterr().out
+
+
+def test_sketch_quantiles_within_relative_accuracy():
+    sketch = vendorstats.QuantileSketch()
+    for amount in range(1, 10001):
+        sketch.add(amount)
+    sketch.add(0)
+
+    for q in (0.5, 0.9, 0.99):
+        assert sketch.quantile(q) == pytest.approx(q * 10000, rel=0.03)
+    assert sketch.quantile(0) == 0.0
+    assert len(sketch.to_item()) <= vendorstats.SKETCH_MAX_BUCKETS + 1
+    restored = vendorstats.QuantileSketch(sketch.to_item())
+    assert restored.quantile(0.5) == sketch.quantile(0.5)
+
+
+def test_sketch_merges_lowest_buckets_when_full():
+    sketch = vendorstats.QuantileSketch(max_buckets=4)
+    for amount in (1, 10, 100, 1000, 10000):
+        sketch.add(amount)
+
+    assert len(sketch.buckets) == 4
+    assert sum(sketch.buckets.values()) == 5
+    assert sketch.quantile(1) == pytest.approx(10000, rel=0.03)
+
+
+def test_backfill_builds_records_from_invoices(tables):
+    amounts = [("a@example.com", "INR", "1000"), ("a@example.com", "INR", "2000"),
+               ("a@example.com", None, "5"), ("b@example.com", "USD", "-")]
+    for i, (email, currency, amount) in enumerate(amounts):
+        item = {"invoiceId": f"inv-{i}", "VendorEmail": email, "TotalAmount": amount}
+        if currency:
+            item["Currency"] = currency
+        tables.put_item(Item=item)
+    vendorstats.record(STATS, "a@example.com", "INR", 99999)
+
+    assert vendorstats.backfill(INVOICES, STATS) == 2
+
+    stats = vendorstats.get(STATS, "a@example.com", "INR")
+    assert (stats.count, stats.total) == (2, 3000)
+    assert vendorstats.get(STATS, "a@example.com", None).count == 1
+    # Later updates continue from the backfilled record
+    vendorstats.record(STATS, "a@example.com", "INR", 3000)
+    assert vendorstats.get(STATS, "a@example.com", "INR").count == 3
@@ -1,9 +1,13 @@
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 import pytest
-from moto import mock_dynamodb
+from moto import mock_dynamodb, mock_s3
 from boto3.dynamodb.conditions import Key
+from unittest.mock import MagicMock
 
 # Set environment variables before importing the module
 os.environ["TrustedVendorsTable"] = "test-vendors-table"
@@ -15,8 +19,12 @@ from trustbill.verify.verify import (
     incorrect_vendor_info,
     changed_bank_details, 
     duplicate_invoice, 
-    unusual_amounts
+    unusual_amounts,
+    VerificationContext,
+    get_tables,
 )
+from trustbill.common import claimcheck, clients, dedup, invoicecodec, vendorindex, vendorstats
+from trustbill.verify import verify
 
 
 @pytest.fixture
@@ -29,6 +37,18 @@ def aws_credentials():
     os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
 
 
+@pytest.fixture(autouse=True)
+def reset_clients():
+    """Rebuild AWS clients inside each test's moto mock, with cold vendor and result caches."""
+    clients.reset()
+    verify.vendor_cache.clear()
+    verify.result_cache.clear()
+    yield
+    clients.reset()
+    verify.vendor_cache.clear()
+    verify.result_cache.clear()
+
+
 @pytest.fixture
 def dynamodb_tables(aws_credentials):
     """Create mock DynamoDB tables for testing."""
@@ -223,6 +243,16 @@ def test_unusual_amounts(dynamodb_tables):
     assert unusual_amounts(invoice_data) is True
 
 
+def test_unusual_amounts_skips_null_totals(dynamodb_tables):
+    for invoice_id, total in (("null-new", "-"), ("null-old", "None")):
+        dynamodb_tables["invoices_table"].put_item(
+            Item={"invoiceId": invoice_id, "VendorEmail": "test@example.com", "TotalAmount": total}
+        )
+
+    assert unusual_amounts({"VendorEmail": "test@example.com", "TotalAmount": "1100"}) is False
+    assert unusual_amounts({"VendorEmail": "test@example.com", "TotalAmount": "2500"}) is True
+
+
 def test_lambda_handler(dynamodb_tables):
     """Test lambda_handler function."""
     # Create a mock EventBridge event
@@ -268,3 +298,536 @@ def test_lambda_handler(dynamodb_tables):
     flags = new_invoice["Flags"]
     assert flags["IncorrectVendorInfo"] is True
     assert flags["ItemizedInvoice"] is True
+
+
+def test_lambda_handler_resolves_claim_check(dynamodb_tables):
+    """A pointer event is verified against the full detail stored in S3."""
+    detail = {
+        "InvoiceId": "inv-1",
+        "VendorEmail": "new@example.com",
+        "InvoiceNumber": "INV-200",
+        "TotalAmount": "2000",
+        "LineItems": [{"Description": "Widget", "Amount": 2000}],
+        "FileURL": "https://example.com/invoice.pdf",
+    }
+    with mock_s3():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="test-invoices")
+        event = {"detail": claimcheck.check_in(s3, detail, "test-invoices", "extractions/inv-1.json")}
+
+        response = lambda_handler(event, {})
+
+    assert response["statusCode"] == 200
+    assert json.loads(response["body"])["flags"]["ItemizedInvoice"] is False
+    invoices = dynamodb_tables["invoices_table"].scan()["Items"]
+    stored = next(i for i in invoices if i["InvoiceNumber"] == "INV-200")
+    assert stored["Items"][0]["Description"] == "Widget"
+
+
+def test_verification_context_reads_each_partition_once(dynamodb_tables):
+    """Duplicate and amount checks share one read of the vendor's invoices."""
+    tables = {name: MagicMock(wraps=table) for name, table in get_tables().items()}
+    context = VerificationContext("test@example.com", tables)
+    invoice_data = {
+        "VendorEmail": "test@example.com",
+        "VendorBankName": "Test Bank",
+        "VendorBankAccount": "12345678",
+        "VendorIFSCCode": "TESTCODE",
+        "VendorBankRoutingNumber": "987654",
+        "InvoiceNumber": "INV-002",
+        "TotalAmount": "1000",
+    }
+
+    assert incorrect_vendor_info(invoice_data, context) is False
+    assert duplicate_invoice("test@example.com", invoice_data, context) is False
+    assert unusual_amounts(invoice_data, context) is False
+    assert tables["vendors"].query.call_count == 1
+    assert tables["invoices"].query.call_count == 1
+
+
+def test_verification_context_follows_pagination():
+    table = MagicMock()
+    table.query.side_effect = [
+        {"Items": [{"InvoiceNumber": "INV-1"}], "LastEvaluatedKey": {"invoiceId": "a"}},
+        {"Items": [{"InvoiceNumber": "INV-2"}]},
+    ]
+    context = VerificationContext("test@example.com", {"vendors": MagicMock(), "invoices": table})
+
+    assert duplicate_invoice("test@example.com", {"InvoiceNumber": "INV-2"}, context) is True
+    assert context.pages == 2
+    assert table.query.call_args_list[1].kwargs["ExclusiveStartKey"] == {"invoiceId": "a"}
+
+
+def test_verification_context_reads_a_key_once_across_threads(monkeypatch):
+    """Checks on several threads asking for the same dedup key share one lookup."""
+    started = threading.Event()
+    release = threading.Event()
+    lookups = []
+
+    def lookup(table_name, key):
+        lookups.append(key)
+        started.set()
+        release.wait(5)
+        return {"dedupKey": key, "invoiceId": "inv-1"}
+
+    monkeypatch.setattr(verify.dedup, "lookup", lookup)
+    context = VerificationContext("test@example.com", {"vendors": MagicMock(), "invoices": MagicMock()})
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(context.dedup_claim, "key") for _ in range(4)]
+        started.wait(5)
+        # Let the other threads reach the key while the first read is running
+        time.sleep(0.1)
+        release.set()
+        claims = [future.result() for future in futures]
+
+    assert lookups == ["key"]
+    assert all(claim["invoiceId"] == "inv-1" for claim in claims)
+
+
+def test_verification_context_retries_a_failed_read(monkeypatch):
+    lookup = MagicMock(side_effect=[Exception("throttled"), None])
+    monkeypatch.setattr(verify.dedup, "lookup", lookup)
+    context = VerificationContext("test@example.com", {"vendors": MagicMock(), "invoices": MagicMock()})
+
+    with pytest.raises(Exception):
+        context.dedup_claim("key")
+    assert context.dedup_claim("key") is None
+    assert context.dedup_claim("key") is None
+    assert lookup.call_count == 2
+
+
+@pytest.fixture
+def vendor_stats_table(dynamodb_tables, monkeypatch):
+    boto3.resource("dynamodb").create_table(
+        TableName="test-vendor-stats",
+        KeySchema=[
+            {"AttributeName": "VendorEmail", "KeyType": "HASH"},
+            {"AttributeName": "Currency", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "VendorEmail", "AttributeType": "S"},
+            {"AttributeName": "Currency", "AttributeType": "S"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    monkeypatch.setattr(verify, "VENDOR_STATS_TABLE", "test-vendor-stats")
+    return "test-vendor-stats"
+
+
+def test_unusual_amounts_reads_only_vendor_stats(vendor_stats_table):
+    for amount in ("100", "120", "80"):
+        vendorstats.record(vendor_stats_table, "test@example.com", "USD", amount)
+    tables = {name: MagicMock(wraps=table) for name, table in get_tables().items()}
+    context = VerificationContext("test@example.com", tables)
+    invoice_data = {"VendorEmail": "test@example.com", "Currency": "USD", "TotalAmount": "110"}
+
+    # The invoices table holds a 1000 invoice, but only the USD statistics count
+    assert unusual_amounts(invoice_data, context) is False
+    invoice_data["TotalAmount"] = "1000"
+    assert unusual_amounts(invoice_data, context) is True
+    tables["invoices"].query.assert_not_called()
+
+
+def test_lambda_handler_updates_vendor_stats(vendor_stats_table):
+    event = {
+        "detail": {
+            "VendorEmail": "new@example.com",
+            "InvoiceNumber": "INV-300",
+            "Currency": "INR",
+            "TotalAmount": 2000,
+            "LineItems": [],
+        }
+    }
+
+    lambda_handler(event, {})
+    lambda_handler({"detail": dict(event["detail"], TotalAmount=3000)}, {})
+
+    stats = vendorstats.get(vendor_stats_table, "new@example.com", "INR")
+    assert (stats.count, stats.total) == (2, 5000)
+
+
+@pytest.fixture
+def dedup_table(dynamodb_tables, monkeypatch):
+    boto3.resource("dynamodb").create_table(
+        TableName="test-invoice-dedup",
+        KeySchema=[{"AttributeName": "dedupKey", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "dedupKey", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    monkeypatch.setattr(verify, "INVOICE_DEDUP_TABLE", "test-invoice-dedup")
+    return "test-invoice-dedup"
+
+
+def _known_vendor_invoice(invoice_number):
+    return {
+        "VendorEmail": "test@example.com",
+        "VendorBankName": "Test Bank",
+        "VendorBankAccount": "12345678",
+        "VendorIFSCCode": "TESTCODE",
+        "VendorBankRoutingNumber": "987654",
+        "InvoiceNumber": invoice_number,
+        "TotalAmount": "1000",
+        "LineItems": [],
+    }
+
+
+def test_duplicate_invoice_uses_dedup_key(dedup_table, dynamodb_tables):
+    tables = {name: MagicMock(wraps=table) for name, table in get_tables().items()}
+    context = VerificationContext("test@example.com", tables)
+
+    first = lambda_handler({"detail": _known_vendor_invoice("INV-777")}, {})
+    second = lambda_handler({"detail": _known_vendor_invoice("inv 777")}, {})
+
+    assert json.loads(first["body"])["flags"]["DuplicateInvoice"] is False
+    assert json.loads(second["body"])["flags"]["DuplicateInvoice"] is True
+    assert duplicate_invoice("test@example.com", {"InvoiceNumber": "INV777"}, context) is True
+    assert duplicate_invoice("test@example.com", {"InvoiceNumber": "INV-778"}, context) is False
+    tables["invoices"].query.assert_not_called()
+    stored = [i for i in dynamodb_tables["invoices_table"].scan()["Items"] if i["InvoiceNumber"] in ("INV-777", "inv 777")]
+    assert len(stored) == 2
+
+
+def test_racing_duplicate_loses_the_claim(dedup_table, monkeypatch):
+    """Both copies pass the lookup; only the first to store claims the key."""
+    monkeypatch.setattr(verify, "duplicate_invoice", lambda *args, **kwargs: False)
+
+    first = lambda_handler({"detail": _known_vendor_invoice("INV-900")}, {})
+    second = lambda_handler({"detail": _known_vendor_invoice("INV-900")}, {})
+
+    assert json.loads(first["body"])["flags"]["DuplicateInvoice"] is False
+    assert json.loads(second["body"])["flags"]["DuplicateInvoice"] is True
+    claim = dedup.lookup(dedup_table, "test@example.com#INV900")
+    invoices = get_tables()["invoices"].scan()["Items"]
+    winner = next(i for i in invoices if i["invoiceId"] == claim["invoiceId"])
+    assert winner["Flags"]["DuplicateInvoice"] is False
+
+
+def test_dedup_backfill_claims_existing_invoices(dedup_table):
+    assert dedup.backfill("test-invoices-table", dedup_table) == 1
+    assert duplicate_invoice("test@example.com", {"InvoiceNumber": "INV-001"}) is True
+    assert dedup.backfill("test-invoices-table", dedup_table) == 0
+
+
+def test_lambda_handler_caches_vendor_records(dynamodb_tables, capsys):
+    lambda_handler({"detail": _known_vendor_invoice("INV-501")}, {})
+    dynamodb_tables["vendors_table"].delete_item(Key={"vendorId": "vendor123"})
+
+    # Still trusted: the record is served from the container cache
+    response = lambda_handler({"detail": _known_vendor_invoice("INV-502")}, {})
+
+    assert json.loads(response["body"])["flags"]["IncorrectVendorInfo"] is False
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    cache_metrics = [r for r in records if r.get("metric") == "VendorCache"]
+    assert [r["CacheHit"] for r in cache_metrics] == [0, 1]
+    assert cache_metrics[-1]["HitRate"] == 0.5
+
+
+def _queue_message(message_id, detail):
+    return {
+        "messageId": message_id,
+        "body": json.dumps({"detail-type": "InvoiceExtracted", "detail": detail}),
+    }
+
+
+def test_queue_handler_verifies_batch_per_vendor(dedup_table, vendor_stats_table, monkeypatch):
+    vendorstats.record(vendor_stats_table, "test@example.com", None, "1000")
+    tables = {name: MagicMock(wraps=table) for name, table in get_tables().items()}
+    monkeypatch.setattr(verify, "get_tables", lambda: tables)
+    new_vendor = {"VendorEmail": "new@example.com", "InvoiceNumber": "N-1", "TotalAmount": 50, "LineItems": []}
+    event = {
+        "Records": [
+            _queue_message("m1", _known_vendor_invoice("INV-10")),
+            _queue_message("m2", new_vendor),
+            _queue_message("m3", _known_vendor_invoice("inv 10")),
+            _queue_message("m4", _known_vendor_invoice("INV-11")),
+            {"messageId": "m5", "body": "not json"},
+        ]
+    }
+
+    response = verify.queue_handler(event, {})
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "m5"}]}
+    # One vendor-records query per vendor; history comes from the dedup and stats tables
+    assert tables["vendors"].query.call_count == 2
+    tables["invoices"].query.assert_not_called()
+    stored = {i["InvoiceNumber"]: i["Flags"] for i in tables["invoices"].scan()["Items"] if "Flags" in i}
+    assert stored["INV-10"]["DuplicateInvoice"] is False
+    assert stored["inv 10"]["DuplicateInvoice"] is True
+    assert stored["INV-11"]["DuplicateInvoice"] is False
+    assert stored["N-1"]["IncorrectVendorInfo"] is True
+    stats = vendorstats.get(vendor_stats_table, "test@example.com", None)
+    assert (stats.count, stats.total, stats.version) == (4, 4000, 2)
+
+
+def test_queue_handler_reports_unwritten_invoices(dedup_table, monkeypatch):
+    monkeypatch.setattr(verify, "BATCH_BACKOFF_SECONDS", 0)
+    dynamodb = clients.resource("dynamodb")
+    real_batch_write = dynamodb.batch_write_item
+
+    def batch_write_item(RequestItems):
+        # INV-21 is never written; the rest go through
+        request = {
+            table: [e for e in entries if e["PutRequest"]["Item"]["InvoiceNumber"] != "INV-21"]
+            for table, entries in RequestItems.items()
+        }
+        real_batch_write(RequestItems=request)
+        unprocessed = {
+            table: [e for e in entries if e["PutRequest"]["Item"]["InvoiceNumber"] == "INV-21"]
+            for table, entries in RequestItems.items()
+        }
+        return {"UnprocessedItems": {t: e for t, e in unprocessed.items() if e}}
+
+    monkeypatch.setattr(dynamodb, "batch_write_item", MagicMock(side_effect=batch_write_item))
+    event = {
+        "Records": [
+            _queue_message("m1", _known_vendor_invoice("INV-20")),
+            _queue_message("m2", _known_vendor_invoice("INV-21")),
+        ]
+    }
+
+    response = verify.queue_handler(event, {})
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "m2"}]}
+    assert dynamodb.batch_write_item.call_count == verify.BATCH_MAX_ATTEMPTS
+    assert dedup.lookup(dedup_table, "test@example.com#INV20") is not None
+    # The key is free again, so the redelivered message is not its own duplicate
+    assert dedup.lookup(dedup_table, "test@example.com#INV21") is None
+    dynamodb.batch_write_item.side_effect = real_batch_write
+    assert verify.queue_handler({"Records": [event["Records"][1]]}, {}) == {"batchItemFailures": []}
+    stored = [i for i in get_tables()["invoices"].scan()["Items"] if i.get("InvoiceNumber") == "INV-21"]
+    assert [i["Flags"]["DuplicateInvoice"] for i in stored] == [False]
+
+
+def test_checks_record_timings_and_skip_for_unknown_vendor(dynamodb_tables, capsys):
+    response = lambda_handler({"detail": {"VendorEmail": "new@example.com", "InvoiceNumber": "X", "LineItems": []}}, {})
+
+    flags = json.loads(response["body"])["flags"]
+    assert list(flags)[:4] == ["IncorrectVendorInfo", "DuplicateInvoice", "UnusualAmounts", "ItemizedInvoice"]
+    assert flags == {
+        "IncorrectVendorInfo": True,
+        "DuplicateInvoice": None,
+        "UnusualAmounts": None,
+        "ItemizedInvoice": True,
+        "BankAccountOfOtherVendor": None,
+        "NearDuplicate": None,
+    }
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    record = next(r for r in records if r.get("metric") == "FraudChecks")
+    assert record["Skipped"] == ["DuplicateInvoice", "UnusualAmounts"]
+    assert {"LoadVendorRecordsMs", "IncorrectVendorInfoMs", "ItemizedInvoiceMs"} <= set(record)
+    assert "LoadDuplicateHistoryMs" not in record
+
+
+@pytest.fixture
+def fingerprints_table(dynamodb_tables, monkeypatch):
+    boto3.resource("dynamodb").create_table(
+        TableName="test-invoice-fingerprints",
+        KeySchema=[
+            {"AttributeName": "bandKey", "KeyType": "HASH"},
+            {"AttributeName": "invoiceId", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "bandKey", "AttributeType": "S"},
+            {"AttributeName": "invoiceId", "AttributeType": "S"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    monkeypatch.setattr(verify, "INVOICE_FINGERPRINTS_TABLE", "test-invoice-fingerprints")
+    return "test-invoice-fingerprints"
+
+
+def test_near_duplicate_from_lookalike_sender(fingerprints_table):
+    original = dict(
+        _known_vendor_invoice("INV-600"),
+        InvoiceDate="2024-05-02",
+        Currency="INR",
+        TaxAmount=180,
+        LineItems=[
+            {"Description": "Annual support contract", "Quantity": 1, "UnitPrice": 1000, "Amount": 1000},
+            {"Description": "On-site visit", "Quantity": 2, "UnitPrice": 250, "Amount": 500},
+        ],
+    )
+    resubmitted = json.loads(json.dumps(original))
+    resubmitted.update(VendorEmail="test@examp1e.com", InvoiceNumber="INV-601", InvoiceDate="2024-05-09")
+
+    first = json.loads(lambda_handler({"detail": original}, {})["body"])["flags"]
+    second = json.loads(lambda_handler({"detail": resubmitted}, {})["body"])["flags"]
+
+    assert first["NearDuplicate"] is False
+    assert second["NearDuplicate"] is True
+    assert second["IncorrectVendorInfo"] is True
+    stored = {i["InvoiceNumber"]: i for i in get_tables()["invoices"].scan()["Items"]}
+    assert "NearDuplicateOf" not in stored["INV-600"]
+    assert stored["INV-601"]["NearDuplicateOf"] == [stored["INV-600"]["invoiceId"]]
+
+
+def test_monthly_bills_are_not_near_duplicates(fingerprints_table):
+    may = dict(
+        _known_vendor_invoice("SUB-05"),
+        InvoiceDate="2024-05-01",
+        Currency="INR",
+        TaxAmount=180,
+        LineItems=[
+            {"Description": "Cloud hosting, monthly subscription", "Amount": 700},
+            {"Description": "Managed backups", "Amount": 120},
+            {"Description": "Support add-on", "Amount": 180},
+        ],
+    )
+    june = dict(may, InvoiceNumber="SUB-06", InvoiceDate="2024-06-01")
+    resent = dict(may, InvoiceNumber="SUB-05-R")
+
+    lambda_handler({"detail": may}, {})
+    flags = [json.loads(lambda_handler({"detail": data}, {})["body"])["flags"] for data in (june, resent)]
+
+    # The next month's bill is not a copy; the same month's bill under a new number is
+    assert [f["NearDuplicate"] for f in flags] == [False, True]
+
+
+def test_near_duplicates_within_a_batch(dedup_table, fingerprints_table):
+    """Near copies in one batch see each other, as exact copies do; their redeliveries need no read."""
+    may = dict(
+        _known_vendor_invoice("SUB-05"),
+        InvoiceDate="2024-05-01",
+        Currency="INR",
+        TaxAmount=180,
+        LineItems=[
+            {"Description": "Cloud hosting, monthly subscription", "Amount": 700},
+            {"Description": "Managed backups", "Amount": 120},
+            {"Description": "Support add-on", "Amount": 180},
+        ],
+    )
+    resent = dict(may, InvoiceNumber="SUB-05-R", InvoiceDate="2024-05-03")
+    june = dict(may, InvoiceNumber="SUB-06", InvoiceDate="2024-06-01")
+    batch = [dict(data, InvoiceId=f"inv-{i}") for i, data in enumerate((may, resent, june))]
+
+    response = verify.queue_handler(
+        {"Records": [_queue_message(f"m{i}", data) for i, data in enumerate(batch)]}, {}
+    )
+
+    assert response == {"batchItemFailures": []}
+    stored = {i["InvoiceNumber"]: i for i in get_tables()["invoices"].scan()["Items"]}
+    assert stored["SUB-05"]["Flags"]["NearDuplicate"] is False
+    assert stored["SUB-05-R"]["Flags"]["NearDuplicate"] is True
+    assert stored["SUB-05-R"]["NearDuplicateOf"] == ["inv-0"]
+    # The next month's bill of the same series is not a copy
+    assert stored["SUB-06"]["Flags"]["NearDuplicate"] is False
+    assert verify.result_cache.get("inv-1")["NearDuplicate"] is True
+
+
+def test_bank_account_of_other_vendor(dynamodb_tables, monkeypatch):
+    boto3.resource("dynamodb").create_table(
+        TableName="test-vendor-keys",
+        KeySchema=[{"AttributeName": "lookupKey", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "lookupKey", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    monkeypatch.setattr(verify, "VENDOR_KEYS_TABLE", "test-vendor-keys")
+    vendorindex.backfill("test-vendors-table", "test-vendor-keys")
+    stranger = dict(_known_vendor_invoice("S-1"), VendorEmail="payments@other.example")
+
+    response = lambda_handler({"detail": stranger}, {})
+
+    assert json.loads(response["body"])["flags"]["BankAccountOfOtherVendor"] is True
+    stored = next(i for i in get_tables()["invoices"].scan()["Items"] if i["InvoiceNumber"] == "S-1")
+    assert stored["VendorResolution"]["bankOwners"] == ["vendor123"]
+    own = json.loads(lambda_handler({"detail": _known_vendor_invoice("S-2")}, {})["body"])["flags"]
+    assert own["BankAccountOfOtherVendor"] is False
+
+
+def test_redelivered_event_is_answered_from_the_stored_invoice(dedup_table, vendor_stats_table, capsys):
+    event = {"detail": dict(_known_vendor_invoice("INV-800"), InvoiceId="extract-id-1")}
+
+    first = json.loads(lambda_handler(json.loads(json.dumps(event)), {})["body"])
+    second = json.loads(lambda_handler(json.loads(json.dumps(event)), {})["body"])
+    verify.result_cache.clear()
+    third = json.loads(lambda_handler(json.loads(json.dumps(event)), {})["body"])
+
+    assert (first["replayed"], second["replayed"], third["replayed"]) == (False, True, True)
+    assert first["flags"]["DuplicateInvoice"] is False
+    assert second["flags"] == third["flags"] == first["flags"]
+    stored = [i for i in get_tables()["invoices"].scan()["Items"] if i.get("InvoiceNumber") == "INV-800"]
+    assert [i["invoiceId"] for i in stored] == ["extract-id-1"]
+    assert vendorstats.get(vendor_stats_table, "test@example.com", None).count == 1
+    # The checks ran once
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len([r for r in records if r.get("metric") == "FraudChecks"]) == 1
+
+
+@pytest.mark.parametrize("with_dedup", [True, False])
+def test_store_invoice_writes_each_invoice_id_once(dynamodb_tables, monkeypatch, with_dedup, request):
+    if with_dedup:
+        request.getfixturevalue("dedup_table")
+    data = dict(_known_vendor_invoice("INV-810"), InvoiceId="extract-id-2")
+    context = VerificationContext("test@example.com")
+    invoice = verify.verify_invoice(json.loads(json.dumps(data)), context)
+    # A second delivery racing the first: both checked before either stored
+    racing = verify.verify_invoice(json.loads(json.dumps(data)), VerificationContext("test@example.com"))
+
+    assert verify.store_invoice(get_tables(), invoice, invoice["Flags"]) is True
+    assert verify.store_invoice(get_tables(), racing, racing["Flags"]) is False
+    assert racing["Flags"]["DuplicateInvoice"] is False
+    assert duplicate_invoice("test@example.com", data, VerificationContext("test@example.com")) is False
+
+
+def test_queue_handler_skips_replayed_messages(dedup_table):
+    stored = dict(_known_vendor_invoice("INV-820"), InvoiceId="id-stored")
+    lambda_handler({"detail": json.loads(json.dumps(stored))}, {})
+    verify.result_cache.clear()
+    fresh = dict(_known_vendor_invoice("INV-821"), InvoiceId="id-fresh")
+    event = {
+        "Records": [
+            _queue_message("m1", stored),
+            _queue_message("m2", fresh),
+            _queue_message("m3", fresh),
+        ]
+    }
+
+    assert verify.queue_handler(event, {}) == {"batchItemFailures": []}
+
+    invoices = [i for i in get_tables()["invoices"].scan()["Items"] if i.get("InvoiceNumber") in ("INV-820", "INV-821")]
+    assert sorted(i["invoiceId"] for i in invoices) == ["id-fresh", "id-stored"]
+    assert all(i["Flags"]["DuplicateInvoice"] is False for i in invoices)
+
+
+def test_racing_batches_store_an_invoice_once(dedup_table, vendor_stats_table, monkeypatch):
+    """Both batches miss the other's invoice in the replay lookup; only one claims its id."""
+    drop_replays = verify.drop_replays
+    monkeypatch.setattr(verify, "drop_replays", lambda pending: (pending, 0))
+    message = _queue_message("m1", dict(_known_vendor_invoice("INV-840"), InvoiceId="id-racing"))
+
+    assert verify.queue_handler({"Records": [message]}, {}) == {"batchItemFailures": []}
+    verify.result_cache.clear()
+    racing = dict(message, messageId="m2")
+    assert verify.queue_handler({"Records": [racing]}, {}) == {"batchItemFailures": [{"itemIdentifier": "m2"}]}
+
+    stats = vendorstats.get(vendor_stats_table, "test@example.com", None)
+    assert (stats.count, stats.total) == (1, 1000)
+    # Redelivered, the message finds the invoice stored and succeeds as a replay
+    monkeypatch.setattr(verify, "drop_replays", drop_replays)
+    assert verify.queue_handler({"Records": [racing]}, {}) == {"batchItemFailures": []}
+    assert vendorstats.get(vendor_stats_table, "test@example.com", None).count == 1
+
+
+def test_lapsed_invoice_claim_is_taken_over(dedup_table):
+    assert dedup.claim_invoice_id(dedup_table, "id-1", "batch-a", -1) is True
+    assert dedup.claim_invoice_id(dedup_table, "id-1", "batch-b", 60) is True
+    assert dedup.claim_invoice_id(dedup_table, "id-1", "batch-c", 60) is False
+
+    # Only the holder can release its claim
+    dedup.release_invoice_id(dedup_table, "id-1", "batch-a")
+    assert dedup.lookup(dedup_table, dedup.invoice_claim_key("id-1"))["owner"] == "batch-b"
+    dedup.release_invoice_id(dedup_table, "id-1", "batch-b")
+    assert dedup.lookup(dedup_table, dedup.invoice_claim_key("id-1")) is None
+
+
+def test_packed_invoice_rows(dynamodb_tables, monkeypatch):
+    monkeypatch.setattr(verify, "PACK_INVOICES", True)
+    data = dict(_known_vendor_invoice("INV-830"), LineItems=[{"Description": "Widget", "Amount": 5}])
+
+    lambda_handler({"detail": data}, {})
+
+    stored = next(i for i in get_tables()["invoices"].scan()["Items"] if i["InvoiceNumber"] == "INV-830")
+    assert "Items" not in stored and "VendorInfo" not in stored
+    unpacked = invoicecodec.unpack(stored)
+    assert unpacked["Items"] == [{"Description": "Widget", "Amount": "5"}]
+    assert unpacked["VendorInfo"]["VendorBankAccount"] == "12345678"
@@ -0,0 +1,131 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# A registry of fraud checks. Each check names the data it reads, an
+# estimated cost and the flags it is gated on, so an evaluator can fetch the
+# shared data once, run independent checks side by side and skip checks
+# gated on a flag that came out otherwise.
+
+
+class Check:
+    """One named check, fn(data, context) -> flag value.
+
+    needs names loaders whose data the check reads; they are fetched before
+    the check runs, once per evaluation however many checks share them.
+    requires maps flag names to the values they must have for the check to
+    run; otherwise its flag is set to skipped without running it.
+    """
+
+    def __init__(self, name, fn, needs=(), cost=1, requires=None, skipped=None):
+        self.name = name
+        self.fn = fn
+        self.needs = tuple(needs)
+        self.cost = cost
+        self.requires = dict(requires or {})
+        self.skipped = skipped
+
+    def should_run(self, results):
+        return all(results.get(flag) == value for flag, value in self.requires.items())
+
+
+class CheckRegistry:
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.checks = {}
+        self.loaders = {}
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def check(self, name, needs=(), cost=1, requires=None, skipped=None):
+        """Decorator registering fn as the check for flag name."""
+
+        def register(fn):
+            for flag in requires or {}:
+                if flag not in self.checks:
+                    raise ValueError(f"Check {name} requires unregistered check {flag}")
+            self.checks[name] = Check(name, fn, needs, cost, requires, skipped)
+            return fn
+
+        return register
+
+    def loader(self, name):
+        """Decorator registering fn(data, context) as the loader for need name."""
+
+        def register(fn):
+            self.loaders[name] = fn
+            return fn
+
+        return register
+
+    def stages(self):
+        """The checks in dependency order, each stage sorted cheapest first.
+
+        A check runs in the stage after the last check it requires.
+        """
+        depth = {}
+        for name, check in self.checks.items():
+            # Checks can only require earlier registrations, so depths are known
+            depth[name] = 1 + max((depth[flag] for flag in check.requires), default=-1)
+        stages = [[] for _ in range(max(depth.values(), default=-1) + 1)]
+        for name, check in self.checks.items():
+            stages[depth[name]].append(check)
+        return [sorted(stage, key=lambda check: check.cost) for stage in stages]
+
+    def evaluate(self, data, context):
+        """Run every check on data. Returns (flags, timings in ms, skipped names).
+
+        Timings hold one "<name>" entry per check that ran and one
+        "load:<need>" entry per loader that ran.
+        """
+        results, timings, skipped = {}, {}, []
+        for stage in self.stages():
+            runnable = []
+            for check in stage:
+                if check.should_run(results):
+                    runnable.append(check)
+                else:
+                    results[check.name] = check.skipped
+                    skipped.append(check.name)
+            needs = []
+            for check in runnable:
+                for need in check.needs:
+                    if need not in needs and f"load:{need}" not in timings:
+                        needs.append(need)
+            loaded = self.run_all([self.loaders[need] for need in needs], data, context)
+            for need, (_, elapsed) in zip(needs, loaded):
+                timings[f"load:{need}"] = elapsed
+            outcomes = self.run_all([check.fn for check in runnable], data, context)
+            for check, (value, elapsed) in zip(runnable, outcomes):
+                results[check.name] = value
+                timings[check.name] = elapsed
+        return results, timings, skipped
+
+    def run_all(self, fns, data, context):
+        """Call each fn(data, context), concurrently when there are several.
+
+        Returns (value, ms) pairs in order; the first exception is raised.
+        """
+        if len(fns) <= 1:
+            return [timed(fn, data, context) for fn in fns]
+        futures = [self.executor().submit(timed, fn, data, context) for fn in fns]
+        return [future.result() for future in futures]
+
+    def executor(self):
+        """The registry's thread pool, started on first use.
+
+        It is kept for the life of the process, so every evaluation reuses
+        its threads and the boto3 clients cached in them.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=max(1, self.max_workers), thread_name_prefix="checks"
+                )
+            return self._executor
+
+
+def timed(fn, data, context):
+    start = time.perf_counter()
+    value = fn(data, context)
+    return value, round((time.perf_counter() - start) * 1000, 2)
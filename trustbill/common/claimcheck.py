@@ -0,0 +1,119 @@
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from trustbill.common import clients as aws
+
+# Claim-check pattern for InvoiceExtracted events: the full extraction is
+# written to S3 and the event only carries a pointer to it, a content hash
+# and the fields EventBridge rules route on. Keeps events far below the
+# 256 KB PutEvents limit however long the email thread or the invoice.
+
+# Copied into the event next to the pointer
+ROUTING_FIELDS = ("InvoiceId", "VendorEmail", "InvoiceNumber", "TotalAmount", "Currency")
+
+
+class ClaimCheckError(Exception):
+    """The stored detail is missing or does not match its hash."""
+
+
+def encode(detail, compress=True):
+    """Compact JSON for detail, gzipped when compress. Returns (body, sha256).
+
+    The hash is of the JSON, so it is the same with or without compression.
+    """
+    serialized = json.dumps(detail, separators=(",", ":"), default=str).encode()
+    digest = hashlib.sha256(serialized).hexdigest()
+    if compress:
+        # mtime=0 keeps the compressed bytes deterministic
+        return gzip.compress(serialized, compresslevel=6, mtime=0), digest
+    return serialized, digest
+
+
+def decode(body, encoding):
+    if encoding == "gzip":
+        body = gzip.decompress(body)
+    return body, hashlib.sha256(body).hexdigest()
+
+
+def check_in(s3, detail, bucket, key, compress=True):
+    """Store detail in S3 and return the slim event detail pointing at it."""
+    body, digest = encode(detail, compress)
+    encoding = "gzip" if compress else "identity"
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=body,
+        ContentType="application/json",
+        ContentEncoding=encoding,
+        Metadata={"sha256": digest},
+    )
+    pointer = {
+        "Bucket": bucket,
+        "Key": key,
+        "Sha256": digest,
+        "Encoding": encoding,
+        "Bytes": len(body),
+    }
+    return {
+        **{name: detail.get(name) for name in ROUTING_FIELDS if name in detail},
+        "ClaimCheck": pointer,
+    }
+
+
+class DetailCache:
+    """Resolved details by content hash, in a small per-container LRU.
+
+    EventBridge delivers at least once, so a redelivered event is served
+    without another S3 read. Safe to use from several threads.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def resolve(self, detail):
+        """Return the full detail for an event detail.
+
+        Details without a ClaimCheck pointer (published inline) are returned
+        as they are. Raises ClaimCheckError when the stored body is missing
+        or its hash does not match the pointer.
+        """
+        pointer = (detail or {}).get("ClaimCheck")
+        if not pointer:
+            return detail
+        digest = pointer["Sha256"]
+        with self._lock:
+            serialized = self._entries.get(digest)
+            if serialized is not None:
+                self._entries.move_to_end(digest)
+                self.stats["hits"] += 1
+                return json.loads(serialized)
+            self.stats["misses"] += 1
+
+        try:
+            response = aws.client("s3").get_object(Bucket=pointer["Bucket"], Key=pointer["Key"])
+        except Exception as e:
+            raise ClaimCheckError(
+                f"Cannot read s3://{pointer['Bucket']}/{pointer['Key']}: {e}"
+            ) from e
+        serialized, actual = decode(response["Body"].read(), pointer.get("Encoding"))
+        if actual != digest:
+            raise ClaimCheckError(
+                f"s3://{pointer['Bucket']}/{pointer['Key']} does not match its event hash"
+            )
+        with self._lock:
+            self._entries[digest] = serialized
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return json.loads(serialized)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats = {"hits": 0, "misses": 0}
@@ -0,0 +1,98 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+# Shared by the extract, verify and data Lambdas (deployed as CommonLayer).
+# Clients are created on first use and kept for the life of the container,
+# so warm invocations reuse pooled, already-handshaken connections.
+
+MAX_POOL_CONNECTIONS = int(os.getenv("AwsMaxPoolConnections", "50"))
+CONNECT_TIMEOUT = int(os.getenv("AwsConnectTimeout", "5"))
+READ_TIMEOUT = int(os.getenv("AwsReadTimeout", "30"))
+MAX_ATTEMPTS = int(os.getenv("AwsMaxAttempts", "5"))
+
+CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT,
+    retries={"mode": "adaptive", "max_attempts": MAX_ATTEMPTS},
+)
+
+# Per-service overrides merged onto CONFIG.
+SERVICE_CONFIG = {
+    "bedrock-runtime": Config(
+        # Long invoices can take well over a minute to generate
+        read_timeout=int(os.getenv("BedrockReadTimeout", "150")),
+        # Throttles are retried by the extract function behind its shared rate
+        # limiter (trustbill.common.ratelimit), so botocore must not retry too.
+        retries={"mode": "standard", "total_max_attempts": 1},
+    ),
+}
+
+_clients = {}
+_lock = threading.Lock()
+# boto3 resources are not thread-safe, so each thread keeps its own. The
+# generation lets reset() invalidate the caches of every thread at once.
+_local = threading.local()
+_generation = 0
+
+
+def config_for(service_name):
+    override = SERVICE_CONFIG.get(service_name)
+    return CONFIG.merge(override) if override else CONFIG
+
+
+def client(service_name, region_name=None):
+    """Return the container-wide client for service_name.
+
+    Low-level clients are thread-safe and may be shared across threads.
+    """
+    key = (service_name, region_name)
+    cached = _clients.get(key)
+    if cached is not None:
+        return cached
+    with _lock:
+        if key not in _clients:
+            _clients[key] = boto3.client(
+                service_name, region_name=region_name, config=config_for(service_name)
+            )
+        return _clients[key]
+
+
+def _thread_cache():
+    cache = getattr(_local, "cache", None)
+    if cache is None or cache["generation"] != _generation:
+        cache = _local.cache = {"generation": _generation, "resources": {}, "tables": {}}
+    return cache
+
+
+def resource(service_name):
+    """Return this thread's boto3 resource for service_name."""
+    resources = _thread_cache()["resources"]
+    if service_name not in resources:
+        resources[service_name] = boto3.resource(
+            service_name, config=config_for(service_name)
+        )
+    return resources[service_name]
+
+
+def table(table_name):
+    """Return this thread's DynamoDB Table object for table_name."""
+    tables = _thread_cache()["tables"]
+    if table_name not in tables:
+        tables[table_name] = resource("dynamodb").Table(table_name)
+    return tables[table_name]
+
+
+def reset():
+    """Drop every cached client, resource and table.
+
+    Tests call this so clients are rebuilt inside each moto mock or patch.
+    """
+    global _generation
+    with _lock:
+        _clients.clear()
+        _generation += 1
@@ -0,0 +1,198 @@
+import re
+import sys
+import time
+from datetime import datetime
+
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+
+from trustbill.common import clients as aws
+
+# One dedup item per vendor and normalized invoice number, claimed in the
+# same transaction that stores the invoice. Duplicate detection is a single
+# key lookup whatever the vendor's history, and of two copies of an invoice
+# racing through verify only one can claim the key.
+
+serializer = TypeSerializer()
+
+
+def normalize_invoice_number(invoice_number):
+    """Upper-case the number and drop spaces and punctuation ("inv 001" is "INV001")."""
+    return re.sub(r"[^0-9A-Z]", "", str(invoice_number).upper())
+
+
+def dedup_key(vendor_email, invoice_number):
+    """The dedup key for an invoice, or None when either part is missing."""
+    if not vendor_email or invoice_number in (None, ""):
+        return None
+    number = normalize_invoice_number(invoice_number)
+    if not number:
+        return None
+    return f"{vendor_email.strip().lower()}#{number}"
+
+
+def lookup(table_name, key):
+    """The dedup item that claimed key, or None."""
+    return aws.table(table_name).get_item(Key={"dedupKey": key}, ConsistentRead=True).get("Item")
+
+
+def dedup_item(key, invoice):
+    return {
+        "dedupKey": key,
+        "invoiceId": invoice["invoiceId"],
+        "VendorEmail": invoice.get("VendorEmail"),
+        "InvoiceNumber": invoice.get("InvoiceNumber"),
+        "createdAt": datetime.now().isoformat(),
+    }
+
+
+# A key is free, or already held by this same invoice (a redelivery)
+CLAIM_CONDITION = "attribute_not_exists(dedupKey) OR invoiceId = :invoice_id"
+
+
+def put_claimed(invoices_table_name, invoice, dedup_table_name, key):
+    """Store invoice and claim key for it in one transaction.
+
+    Returns False, writing nothing, when another invoice already holds the
+    key; the caller then stores the invoice as a duplicate. Returns None,
+    writing nothing, when an invoice with the same invoiceId is already
+    stored.
+    """
+    try:
+        aws.client("dynamodb").transact_write_items(
+            TransactItems=[
+                {
+                    "Put": {
+                        "TableName": invoices_table_name,
+                        "Item": serialize(invoice),
+                        "ConditionExpression": "attribute_not_exists(invoiceId)",
+                    }
+                },
+                {
+                    "Put": {
+                        "TableName": dedup_table_name,
+                        "Item": serialize(dedup_item(key, invoice)),
+                        "ConditionExpression": CLAIM_CONDITION,
+                        "ExpressionAttributeValues": serialize({":invoice_id": invoice["invoiceId"]}),
+                    }
+                },
+            ]
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "TransactionCanceledException":
+            raise
+        reasons = [reason.get("Code") for reason in e.response.get("CancellationReasons", [])]
+        if reasons and "ConditionalCheckFailed" not in reasons:
+            raise
+        if reasons and reasons[0] == "ConditionalCheckFailed":
+            return None
+        return False
+    return True
+
+
+def claim(dedup_table_name, key, invoice, reclaim=True):
+    """Claim key for invoice unless a different invoice holds it. Returns whether it did.
+
+    With reclaim false, a key the invoice already holds is not claimed again.
+    """
+    condition = {"ConditionExpression": "attribute_not_exists(dedupKey)"}
+    if reclaim:
+        condition = {
+            "ConditionExpression": CLAIM_CONDITION,
+            "ExpressionAttributeValues": {":invoice_id": invoice["invoiceId"]},
+        }
+    try:
+        aws.table(dedup_table_name).put_item(Item=dedup_item(key, invoice), **condition)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return False
+    return True
+
+
+def release(dedup_table_name, key, invoice_id):
+    """Free key if invoice_id still holds it (its invoice was never stored)."""
+    try:
+        aws.table(dedup_table_name).delete_item(
+            Key={"dedupKey": key},
+            ConditionExpression="invoiceId = :invoice_id",
+            ExpressionAttributeValues={":invoice_id": invoice_id},
+        )
+    except Exception as e:
+        print(f"Failed to release dedup key {key}: {e}")
+
+
+def invoice_claim_key(invoice_id):
+    # Upper-case "I", so it never equals a dedup key (those are lower-cased)
+    return f"invoiceId#{invoice_id}"
+
+
+def claim_invoice_id(dedup_table_name, invoice_id, owner, seconds):
+    """Claim invoice_id for owner, the batch about to store it. Returns whether it did.
+
+    Of two batches holding the same invoice, only one can claim its id; the
+    claim lapses after seconds, so one left by a batch that died is taken
+    over by the redelivery. Lapsed claims are removed by the table's TTL.
+    """
+    now = int(time.time())
+    try:
+        aws.table(dedup_table_name).put_item(
+            Item={
+                "dedupKey": invoice_claim_key(invoice_id),
+                "invoiceId": invoice_id,
+                "owner": owner,
+                "expiresAt": now + seconds,
+            },
+            ConditionExpression="attribute_not_exists(dedupKey) OR expiresAt < :now",
+            ExpressionAttributeValues={":now": now},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return False
+    return True
+
+
+def release_invoice_id(dedup_table_name, invoice_id, owner):
+    """Free owner's claim on invoice_id (its invoice was not stored)."""
+    try:
+        aws.table(dedup_table_name).delete_item(
+            Key={"dedupKey": invoice_claim_key(invoice_id)},
+            ConditionExpression="#owner = :owner",
+            ExpressionAttributeNames={"#owner": "owner"},
+            ExpressionAttributeValues={":owner": owner},
+        )
+    except Exception as e:
+        print(f"Failed to release the claim on invoice {invoice_id}: {e}")
+
+
+def serialize(item):
+    return {name: serializer.serialize(value) for name, value in item.items()}
+
+
+def backfill(invoices_table_name, dedup_table_name):
+    """Claim a dedup key for every existing invoice that has none yet.
+
+    Scans the invoices table (following LastEvaluatedKey). Where several
+    stored invoices share a key, whichever is scanned first holds it.
+    Returns the number of keys claimed.
+    """
+    kwargs = {
+        "ProjectionExpression": "invoiceId, VendorEmail, InvoiceNumber",
+    }
+    invoices = aws.table(invoices_table_name)
+    claimed = 0
+    while True:
+        response = invoices.scan(**kwargs)
+        for invoice in response.get("Items", []):
+            key = dedup_key(invoice.get("VendorEmail"), invoice.get("InvoiceNumber"))
+            if key is not None and claim(dedup_table_name, key, invoice, reclaim=False):
+                claimed += 1
+        if "LastEvaluatedKey" not in response:
+            return claimed
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+if __name__ == "__main__":
+    # python -m trustbill.common.dedup <InvoicesTable> <InvoiceDedupTable>
+    print(f"Claimed {backfill(sys.argv[1], sys.argv[2])} invoice dedup keys")
@@ -0,0 +1,284 @@
+import hashlib
+import random
+import re
+import struct
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from trustbill.common import clients as aws
+from trustbill.common import invoicecodec
+from trustbill.common import vendorstats
+
+# Content fingerprints of invoices for near-duplicate detection. An invoice
+# is reduced to shingles of its line items, amounts, month and bank details
+# (not its number or sender, which a resubmitted bill is likely to change),
+# summarized as a MinHash signature and indexed by LSH band. A new invoice
+# reads only the buckets of its own bands, so candidates come from a fixed
+# number of key lookups whatever the number of stored invoices.
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+# Invoices with fewer shingles are too sparse to compare meaningfully
+MIN_SHINGLES = 3
+# Band queries run on threads sharing the container's low-level client
+QUERY_WORKERS = 8
+# Items read per band. A band shared by more invoices than this is too
+# common to tell them apart; the invoice's other bands still find its copies.
+BUCKET_READ_LIMIT = 200
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 32) - 1
+_rng = random.Random(20240607)
+# Fixed, so signatures stay comparable across containers and deploys
+_COEFFICIENTS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+_SIGNATURE_FORMAT = f">{NUM_PERMUTATIONS}I"
+
+
+def _words(text):
+    return " ".join(re.findall(r"[a-z0-9]+", str(text or "").lower()))
+
+
+def _amount(value):
+    amount = vendorstats.parse_amount(value)
+    return f"{amount:.2f}" if amount is not None else None
+
+
+def _identifier(value):
+    return re.sub(r"[^0-9A-Z]", "", str(value or "").upper())
+
+
+def shingles(data):
+    """The set of normalized features of an InvoiceExtracted detail."""
+    features = set()
+    for item in data.get("LineItems") or []:
+        description = _words(item.get("Description"))
+        amount = _amount(item.get("Amount"))
+        if description:
+            features.add(f"desc:{description}")
+        if amount is not None:
+            features.add(f"amount:{amount}")
+        if description and amount is not None:
+            features.add(f"line:{description}|{amount}")
+    for field in ("TotalAmount", "TaxAmount"):
+        amount = _amount(data.get(field))
+        if amount is not None:
+            features.add(f"{field}:{amount}")
+    # A shifted date usually stays within the month
+    month = invoice_month(data.get("InvoiceDate"))
+    if month:
+        features.add(f"month:{month}")
+    for field in ("VendorBankAccount", "VendorIFSCCode", "VendorBankRoutingNumber"):
+        value = _identifier(data.get(field))
+        if value:
+            features.add(f"{field}:{value}")
+    if features and data.get("Currency"):
+        features.add(f"currency:{vendorstats.currency_key(data.get('Currency'))}")
+    return features
+
+
+def invoice_month(invoice_date):
+    """"YYYY-MM" of an ISO invoice date, or None."""
+    text = str(invoice_date or "")
+    return text[:7] if re.match(r"\d{4}-\d{2}", text) else None
+
+
+def _sender(value):
+    return str(value or "").strip().lower()
+
+
+def recurring(data, candidate):
+    """Whether candidate is another bill of the same series as data.
+
+    A monthly subscription repeats its lines, amounts and bank details, so
+    its bills look alike; one from the same sender with another invoice
+    number and another month is not a copy. candidate holds the VendorEmail,
+    InvoiceNumber and InvoiceMonth of an indexed invoice.
+    """
+    vendor_email = _sender(data.get("VendorEmail"))
+    if not vendor_email or vendor_email != _sender(candidate.get("VendorEmail")):
+        return False
+    number, other_number = _identifier(data.get("InvoiceNumber")), _identifier(candidate.get("InvoiceNumber"))
+    month, other_month = invoice_month(data.get("InvoiceDate")), candidate.get("InvoiceMonth")
+    if not (number and other_number and month and other_month):
+        return False
+    return number != other_number and month != other_month
+
+
+def invoice_fields(item):
+    """The detail fields of a stored invoice item, for shingles()."""
+    item = invoicecodec.unpack(item)
+    vendor = item.get("VendorInfo") or {}
+    return {
+        "LineItems": item.get("Items"),
+        "TotalAmount": item.get("TotalAmount"),
+        "TaxAmount": item.get("TaxAmount"),
+        "Currency": item.get("Currency"),
+        "InvoiceDate": item.get("InvoiceDate"),
+        "VendorBankAccount": vendor.get("VendorBankAccount"),
+        "VendorIFSCCode": vendor.get("VendorIFSCCode"),
+        "VendorBankRoutingNumber": vendor.get("VendorBankRoutingNumber"),
+    }
+
+
+def signature(data):
+    """The MinHash signature of data, or None when it has too few shingles."""
+    features = shingles(data)
+    if len(features) < MIN_SHINGLES:
+        return None
+    hashes = [
+        int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "big")
+        for feature in features
+    ]
+    return tuple(min(((a * h + b) % _PRIME) & _MASK for h in hashes) for a, b in _COEFFICIENTS)
+
+
+def similarity(first, second):
+    """Estimated Jaccard similarity of the shingles behind two signatures."""
+    return sum(a == b for a, b in zip(first, second)) / NUM_PERMUTATIONS
+
+
+def band_keys(sig):
+    keys = []
+    for band in range(BANDS):
+        rows = struct.pack(f">{ROWS}I", *sig[band * ROWS : (band + 1) * ROWS])
+        keys.append(f"{band:02d}:{hashlib.blake2b(rows, digest_size=8).hexdigest()}")
+    return keys
+
+
+def pack(sig):
+    return struct.pack(_SIGNATURE_FORMAT, *sig)
+
+
+def unpack(value):
+    return struct.unpack(_SIGNATURE_FORMAT, bytes(value))
+
+
+def series_filter(data):
+    """Query arguments leaving out the other bills of data's series (see recurring).
+
+    Empty when data has no sender, number or month. Items indexed before
+    SenderKey and NumberKey were stored are not filtered; find_similar
+    checks those itself.
+    """
+    sender = _sender(data.get("VendorEmail"))
+    number = _identifier(data.get("InvoiceNumber"))
+    month = invoice_month(data.get("InvoiceDate"))
+    if not (sender and number and month):
+        return {}
+    return {
+        "FilterExpression": (
+            "NOT (SenderKey = :sender AND NumberKey <> :number"
+            " AND attribute_type(InvoiceMonth, :string) AND InvoiceMonth <> :month)"
+        ),
+        "ExpressionAttributeValues": {
+            ":sender": {"S": sender},
+            ":number": {"S": number},
+            ":month": {"S": month},
+            ":string": {"S": "S"},
+        },
+    }
+
+
+def _bucket(table_name, band_key, data=None):
+    """Up to BUCKET_READ_LIMIT items of one band, without data's series."""
+    query = series_filter(data) if data is not None else {}
+    values = dict(query.pop("ExpressionAttributeValues", {}), **{":band": {"S": band_key}})
+    response = aws.client("dynamodb").query(
+        TableName=table_name,
+        KeyConditionExpression="bandKey = :band",
+        ExpressionAttributeValues=values,
+        Limit=BUCKET_READ_LIMIT,
+        **query,
+    )
+    return response.get("Items", [])
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    """The band query pool, started on first use and kept for the process."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="fingerprint")
+        return _executor
+
+
+def _string(attribute):
+    return attribute.get("S") if attribute else None
+
+
+def find_similar(table_name, sig, threshold, exclude=(), data=None):
+    """Indexed invoices sharing a band with sig and at least threshold similar.
+
+    With data, the detail sig was made from, other bills of the same
+    series (see recurring) are left out, by the band queries themselves
+    where the index holds their series keys. Returns
+    [(invoiceId, similarity)], most similar first.
+    """
+    buckets = executor().map(lambda band_key: _bucket(table_name, band_key, data), band_keys(sig))
+    matches, seen = {}, set()
+    for item in (item for bucket in buckets for item in bucket):
+        invoice_id = item["invoiceId"]["S"]
+        if invoice_id in seen or invoice_id in exclude:
+            continue
+        seen.add(invoice_id)
+        score = similarity(sig, unpack(item["signature"]["B"]))
+        if score < threshold:
+            continue
+        candidate = {name: _string(item.get(name)) for name in ("VendorEmail", "InvoiceNumber", "InvoiceMonth")}
+        if data is None or not recurring(data, candidate):
+            matches[invoice_id] = score
+    return sorted(matches.items(), key=lambda match: (-match[1], match[0]))
+
+
+def index(table_name, invoice_id, sig, vendor_email=None, invoice_number=None, invoice_date=None):
+    """Add an invoice's signature to the bucket of each of its bands."""
+    item = {
+        "invoiceId": invoice_id,
+        "signature": pack(sig),
+        "VendorEmail": vendor_email,
+        "InvoiceNumber": invoice_number,
+        "InvoiceMonth": invoice_month(invoice_date),
+        "createdAt": datetime.now().isoformat(),
+    }
+    # Normalized as series_filter compares them; left out when empty
+    series = {"SenderKey": _sender(vendor_email), "NumberKey": _identifier(invoice_number)}
+    item.update((name, value) for name, value in series.items() if value)
+    with aws.table(table_name).batch_writer() as batch:
+        for band_key in band_keys(sig):
+            batch.put_item(Item=dict(item, bandKey=band_key))
+
+
+def backfill(invoices_table_name, fingerprints_table_name):
+    """Index every stored invoice. Returns the number indexed."""
+    table = aws.table(invoices_table_name)
+    indexed = 0
+    kwargs = {}
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get("Items", []):
+            sig = signature(invoice_fields(item))
+            if sig is None:
+                continue
+            index(
+                fingerprints_table_name,
+                item["invoiceId"],
+                sig,
+                item.get("VendorEmail"),
+                item.get("InvoiceNumber"),
+                item.get("InvoiceDate"),
+            )
+            indexed += 1
+        if "LastEvaluatedKey" not in response:
+            return indexed
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+if __name__ == "__main__":
+    # python -m trustbill.common.fingerprint <InvoicesTable> <InvoiceFingerprintsTable>
+    print(f"Indexed {backfill(sys.argv[1], sys.argv[2])} invoice fingerprints")
@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+
+from trustbill.common import clients as aws
+
+# Verify stores each invoice under the InvoiceId extract assigned it, with a
+# write that fails if the id is already stored. A redelivered event is then
+# answered with the stored flags instead of being checked and written again.
+
+
+class ResultCache:
+    """Flags of recently stored invoices by invoiceId, in a per-container LRU.
+
+    Lets a replay in a retry storm skip even the table read. Safe to use
+    from several threads.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, invoice_id):
+        with self._lock:
+            flags = self._entries.get(invoice_id)
+            if flags is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(invoice_id)
+            self.stats["hits"] += 1
+            return dict(flags)
+
+    def put(self, invoice_id, flags):
+        with self._lock:
+            self._entries[invoice_id] = dict(flags)
+            self._entries.move_to_end(invoice_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats = {key: 0 for key in self.stats}
+
+
+def stored_flags(table_name, invoice_id):
+    """The Flags of the stored invoice invoice_id, or None when it is not stored."""
+    item = aws.table(table_name).get_item(
+        Key={"invoiceId": invoice_id},
+        ProjectionExpression="invoiceId, Flags",
+        ConsistentRead=True,
+    ).get("Item")
+    return item.get("Flags", {}) if item else None
@@ -0,0 +1,152 @@
+import json
+import math
+import zlib
+from decimal import Decimal
+
+# Compact storage for the bulky parts of an invoice row. Instead of Items as
+# a list of maps (every attribute name repeated per line item) and a
+# VendorInfo map, the row holds one zlib-compressed binary attribute,
+# Packed, whose first byte is the schema version. Every other attribute is
+# stored as before, so queries, filters and the checks are unaffected.
+
+PACKED_ATTRIBUTE = "Packed"
+PACKED_FIELDS = ("Items", "VendorInfo")
+SCHEMA_VERSION = 1
+# Field order of line item rows and the vendor snapshot, by schema version
+SCHEMAS = {
+    1: {
+        "Items": ("Description", "Quantity", "UnitPrice", "Amount"),
+        "VendorInfo": (
+            "vendorId",
+            "VendorEmail",
+            "VendorName",
+            "VendorAddress",
+            "VendorGSTIN",
+            "VendorBankName",
+            "VendorBankAccount",
+            "VendorIFSCCode",
+            "VendorBankRoutingNumber",
+        ),
+    },
+}
+COMPRESSION_LEVEL = 6
+
+
+class CodecError(Exception):
+    pass
+
+
+def _row(mapping, fields):
+    """The values of mapping in field order, then a map of any other keys.
+
+    A mapping without every field is kept as a map, so absent keys stay absent.
+    """
+    if any(field not in mapping for field in fields):
+        return dict(mapping)
+    row = [mapping[field] for field in fields]
+    extra = {key: value for key, value in mapping.items() if key not in fields}
+    if extra:
+        row.append(extra)
+    return row
+
+
+def _mapping(row, fields):
+    if isinstance(row, dict):
+        return row
+    mapping = dict(zip(fields, row))
+    if len(row) > len(fields):
+        mapping.update(row[len(fields)])
+    return mapping
+
+
+def _default(value):
+    # Amounts read back from DynamoDB are Decimals
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Cannot encode {type(value).__name__}")
+
+
+def encode(items, vendor_info):
+    """Pack line items and a vendor snapshot into bytes."""
+    schema = SCHEMAS[SCHEMA_VERSION]
+    payload = {
+        "i": [_row(item, schema["Items"]) for item in items or []],
+        "v": _row(vendor_info, schema["VendorInfo"]) if vendor_info is not None else None,
+    }
+    body = json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=_default)
+    return bytes([SCHEMA_VERSION]) + zlib.compress(body.encode("utf-8"), COMPRESSION_LEVEL)
+
+
+def decode(blob):
+    """Return (items, vendor_info) from bytes written by encode()."""
+    blob = bytes(blob)
+    if not blob or blob[0] not in SCHEMAS:
+        raise CodecError(f"Unknown packed invoice schema {blob[0] if blob else None}")
+    schema = SCHEMAS[blob[0]]
+    try:
+        payload = json.loads(zlib.decompress(blob[1:]))
+    except (zlib.error, ValueError) as e:
+        raise CodecError(f"Corrupt packed invoice: {e}") from e
+    items = [_mapping(row, schema["Items"]) for row in payload["i"]]
+    vendor_info = _mapping(payload["v"], schema["VendorInfo"]) if payload["v"] is not None else None
+    return items, vendor_info
+
+
+def pack(invoice):
+    """A copy of an invoice item with Items and VendorInfo packed."""
+    packed = {key: value for key, value in invoice.items() if key not in PACKED_FIELDS}
+    packed[PACKED_ATTRIBUTE] = encode(invoice.get("Items"), invoice.get("VendorInfo"))
+    return packed
+
+
+def unpack(item, fields=PACKED_FIELDS):
+    """A copy of a stored invoice item with its packed fields restored.
+
+    Only the packed fields named in fields are decoded; items that were
+    stored unpacked are returned unchanged.
+    """
+    if PACKED_ATTRIBUTE not in item:
+        return item
+    unpacked = {key: value for key, value in item.items() if key != PACKED_ATTRIBUTE}
+    if any(field in PACKED_FIELDS for field in fields):
+        items, vendor_info = decode(item[PACKED_ATTRIBUTE])
+        decoded = {"Items": items, "VendorInfo": vendor_info}
+        for field in fields:
+            if field in decoded:
+                unpacked[field] = decoded[field]
+    return unpacked
+
+
+def value_size(value):
+    """Approximate DynamoDB storage size of an attribute value in bytes."""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (int, float, Decimal)):
+        digits = len(str(abs(value)).replace(".", "").lstrip("0")) or 1
+        return math.ceil(digits / 2) + 1
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if hasattr(value, "value") and isinstance(value.value, bytes):
+        return len(value.value)
+    if isinstance(value, dict):
+        return 3 + sum(len(key.encode("utf-8")) + value_size(v) + 1 for key, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return 3 + sum(value_size(v) + 1 for v in value)
+    return len(str(value).encode("utf-8"))
+
+
+def item_size(item):
+    """Approximate DynamoDB item size: attribute names plus values."""
+    return sum(len(name.encode("utf-8")) + value_size(value) for name, value in item.items())
+
+
+def capacity(item):
+    """Bytes, write units and strongly consistent read units for one item."""
+    size = item_size(item)
+    return {
+        "Bytes": size,
+        "WriteUnits": max(1, math.ceil(size / 1024)),
+        "ReadUnits": max(1, math.ceil(size / 4096)),
+    }
@@ -0,0 +1,45 @@
+import json
+import os
+import time
+
+# Metrics are written as CloudWatch Embedded Metric Format log lines, so they
+# become CloudWatch metrics without any API calls from the hot path.
+
+NAMESPACE = os.getenv("MetricsNamespace", "TrustBill")
+
+
+def unit_for(name):
+    if name.endswith("_ms") or name.endswith("Ms"):
+        return "Milliseconds"
+    if name.endswith("Bytes"):
+        return "Bytes"
+    if name.endswith("Tokens"):
+        return "Count"
+    return "None"
+
+
+def emit(name, metrics, dimensions=None, **properties):
+    """Log one EMF record.
+
+    metrics maps metric names to numbers. dimensions (string values) split
+    the metrics in CloudWatch, always alongside the record name. properties
+    are only searchable in Logs Insights.
+    """
+    dimensions = {"metric": name, **(dimensions or {})}
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [{"Name": key, "Unit": unit_for(key)} for key in metrics],
+                }
+            ],
+        },
+        **properties,
+        **dimensions,
+        **metrics,
+    }
+    print(json.dumps(record, default=str))
+    return record
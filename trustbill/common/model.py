@@ -0,0 +1,396 @@
+import json
+import uuid
+from decimal import Decimal, InvalidOperation
+
+from trustbill.common import invoicecodec
+
+# The invoice as the three functions pass it around, with Decimal amounts
+# whichever form they arrive in: JSON numbers in Bedrock output and the
+# InvoiceExtracted detail, strings in stored invoice items. Each converter
+# is one pass over its input:
+#
+#   Invoice.from_extracted(detail)  Bedrock output or InvoiceExtracted detail -> Invoice
+#   Invoice.to_detail()             Invoice -> InvoiceExtracted detail, with JSON numbers
+#   Invoice.to_item()               Invoice -> Invoices table item
+#   Invoice.from_item(item)         Invoices table item (packed or not) -> Invoice
+#   dumps(value)                    items, records and responses -> API JSON
+#
+# Amounts and line items are kept as they were read and parsed only when
+# read, so an invoice that is just passed from one form to the next costs
+# no more than copying its values. Stored items keep their existing layout:
+# amounts are strings and a null value is "-".
+
+# Stands in for a missing value in stored amounts and line items
+MISSING = "-"
+
+# Numbers in a detail are JSON ints and floats (bools, an int subclass, too)
+_NUMBERS = (int, float)
+
+
+def _from_text(value):
+    text = str(value)
+    if text == MISSING:
+        return None
+    try:
+        number = Decimal(text)
+    except InvalidOperation:
+        return text
+    return number if number.is_finite() else text
+
+
+def _same(value):
+    return value
+
+
+# By exact type, so the common cases cost one dict lookup. Floats go via
+# repr, so 0.1 is Decimal("0.1") and not its binary expansion.
+_AMOUNT_TYPES = {
+    float: lambda value: Decimal(repr(value)),
+    int: Decimal,
+    Decimal: _same,
+    str: _from_text,
+    bool: str,
+    type(None): _same,
+}
+
+
+def amount(value):
+    """value as a Decimal, None for null, or the original string if it is not a number."""
+    return _AMOUNT_TYPES.get(type(value), _from_text)(value)
+
+
+def _number(value):
+    """An amount as the JSON number Bedrock would have produced."""
+    value = amount(value)
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def _json_amount(value):
+    # JSON numbers and nulls as read need no conversion
+    return value if value is None or type(value) in _NUMBERS else _number(value)
+
+
+def _stored(value):
+    return MISSING if value is None else str(value)
+
+
+def _stored_rows(rows):
+    """Copies of detail line items with numbers as strings and nulls as MISSING."""
+    stored = []
+    for row in rows:
+        row = row.copy()
+        for key, value in row.items():
+            if isinstance(value, _NUMBERS):
+                row[key] = str(value)
+            elif value is None:
+                row[key] = MISSING
+        stored.append(row)
+    return stored
+
+
+def _detail_rows(rows):
+    """Copies of stored line items with amounts as JSON numbers and MISSING as null."""
+    detail = []
+    for row in rows:
+        row = row.copy()
+        for key, value in row.items():
+            if value == MISSING:
+                row[key] = None
+            elif key in LineItem.AMOUNTS:
+                row[key] = _number(value)
+        detail.append(row)
+    return detail
+
+
+class LineItem:
+    """A read-only view of one line of an invoice, with Decimal amounts."""
+
+    __slots__ = ("row",)
+
+    AMOUNTS = frozenset(("Quantity", "UnitPrice", "Amount"))
+
+    def __init__(self, row):
+        # As read: detail or stored form, both parse the same way
+        self.row = row
+
+    @property
+    def description(self):
+        value = self.row.get("Description")
+        return None if value == MISSING else value
+
+    @property
+    def quantity(self):
+        return amount(self.row.get("Quantity"))
+
+    @property
+    def unit_price(self):
+        return amount(self.row.get("UnitPrice"))
+
+    @property
+    def amount(self):
+        return amount(self.row.get("Amount"))
+
+
+class VendorSnapshot:
+    """The vendor details an invoice was sent with, stored as its VendorInfo."""
+
+    __slots__ = (
+        "vendor_id",
+        "email",
+        "name",
+        "address",
+        "gstin",
+        "bank_name",
+        "bank_account",
+        "ifsc_code",
+        "routing_number",
+    )
+
+    FIELDS = (
+        ("vendorId", "vendor_id"),
+        ("VendorEmail", "email"),
+        ("VendorName", "name"),
+        ("VendorAddress", "address"),
+        ("VendorGSTIN", "gstin"),
+        ("VendorBankName", "bank_name"),
+        ("VendorBankAccount", "bank_account"),
+        ("VendorIFSCCode", "ifsc_code"),
+        ("VendorBankRoutingNumber", "routing_number"),
+    )
+
+    def __init__(self, mapping, vendor_id=None):
+        get = mapping.get
+        self.vendor_id = get("vendorId") if vendor_id is None else vendor_id
+        self.email = get("VendorEmail")
+        self.name = get("VendorName")
+        self.address = get("VendorAddress")
+        self.gstin = get("VendorGSTIN")
+        self.bank_name = get("VendorBankName")
+        self.bank_account = get("VendorBankAccount")
+        self.ifsc_code = get("VendorIFSCCode")
+        self.routing_number = get("VendorBankRoutingNumber")
+
+    def to_item(self):
+        return {
+            "vendorId": self.vendor_id,
+            "VendorEmail": self.email,
+            "VendorName": self.name,
+            "VendorAddress": self.address,
+            "VendorGSTIN": self.gstin,
+            "VendorBankName": self.bank_name,
+            "VendorBankAccount": self.bank_account,
+            "VendorIFSCCode": self.ifsc_code,
+            "VendorBankRoutingNumber": self.routing_number,
+        }
+
+
+class Invoice:
+    __slots__ = (
+        "invoice_id",
+        "vendor_email",
+        "invoice_number",
+        "invoice_date",
+        "due_date",
+        "currency",
+        "_total_amount",
+        "_tax_amount",
+        "_rows",
+        "_stored",
+        "notes",
+        "terms",
+        "file_url",
+        "flags",
+        "vendor",
+        "resolution",
+        "_extra",
+        "_source",
+    )
+
+    # Detail keys held in their own attributes; any other key is kept in extra
+    DETAIL_KEYS = frozenset(
+        ("InvoiceId", "VendorEmail", "InvoiceNumber", "InvoiceDate", "DueDate", "Currency", "TotalAmount",
+         "TaxAmount", "LineItems", "Notes", "TermsAndConditions", "FileURL")
+    ) | frozenset(key for key, _ in VendorSnapshot.FIELDS)
+    ITEM_KEYS = frozenset(
+        ("invoiceId", "VendorEmail", "InvoiceNumber", "InvoiceDate", "DueDate", "Currency", "TotalAmount",
+         "TaxAmount", "Items", "Notes", "TermsAndConditions", "FileURL", "Flags", "VendorInfo",
+         "VendorResolution")
+    )
+
+    def __init__(self, invoice_id=None, vendor_email=None, invoice_number=None, invoice_date=None,
+                 due_date=None, currency=None, total_amount=None, tax_amount=None, items=(),
+                 notes=None, terms=None, file_url=None, flags=None, vendor=None, resolution=None,
+                 extra=None, stored=False, source=None):
+        self.invoice_id = invoice_id
+        self.vendor_email = vendor_email
+        self.invoice_number = invoice_number
+        self.invoice_date = invoice_date
+        self.due_date = due_date
+        self.currency = currency
+        self._total_amount = total_amount
+        self._tax_amount = tax_amount
+        # Line item rows as read; stored says they are in the stored form
+        self._rows = items
+        self._stored = stored
+        self.notes = notes
+        self.terms = terms
+        self.file_url = file_url
+        self.flags = flags
+        self.vendor = vendor
+        # The vendorindex resolution, as stored in VendorResolution
+        self.resolution = resolution
+        # Fields the model does not know, passed through as they are. For a
+        # detail they are picked from source when first needed.
+        self._extra = extra
+        self._source = source
+
+    @property
+    def extra(self):
+        if self._extra is None and self._source is not None:
+            keys = self.DETAIL_KEYS
+            self._extra = {key: value for key, value in self._source.items() if key not in keys}
+            self._source = None
+        return self._extra or None
+
+    @extra.setter
+    def extra(self, value):
+        self._extra = value
+        self._source = None
+
+    @property
+    def total_amount(self):
+        return amount(self._total_amount)
+
+    @total_amount.setter
+    def total_amount(self, value):
+        self._total_amount = value
+
+    @property
+    def tax_amount(self):
+        return amount(self._tax_amount)
+
+    @tax_amount.setter
+    def tax_amount(self, value):
+        self._tax_amount = value
+
+    @property
+    def items(self):
+        return [LineItem(row) for row in self._rows]
+
+    @classmethod
+    def from_extracted(cls, detail, flags=None):
+        """An Invoice from Bedrock output or an InvoiceExtracted detail.
+
+        The detail is not modified. Redeliveries of the event carry the same
+        InvoiceId; a detail without one gets a fresh id. The vendor snapshot
+        always gets a fresh vendorId.
+        """
+        get = detail.get
+        return cls(
+            invoice_id=get("InvoiceId") or str(uuid.uuid4()),
+            vendor_email=get("VendorEmail"),
+            invoice_number=get("InvoiceNumber"),
+            invoice_date=get("InvoiceDate"),
+            due_date=get("DueDate"),
+            currency=get("Currency"),
+            total_amount=get("TotalAmount"),
+            tax_amount=get("TaxAmount"),
+            items=get("LineItems") or (),
+            notes=get("Notes"),
+            terms=get("TermsAndConditions"),
+            file_url=get("FileURL"),
+            flags=flags,
+            vendor=VendorSnapshot(detail, vendor_id=str(uuid.uuid4())),
+            source=detail,
+        )
+
+    @classmethod
+    def from_item(cls, item):
+        """An Invoice from an Invoices table item, packed or not."""
+        item = invoicecodec.unpack(item)
+        get = item.get
+        vendor_info = get("VendorInfo")
+        keys = cls.ITEM_KEYS
+        return cls(
+            invoice_id=get("invoiceId"),
+            vendor_email=get("VendorEmail"),
+            invoice_number=get("InvoiceNumber"),
+            invoice_date=get("InvoiceDate"),
+            due_date=get("DueDate"),
+            currency=get("Currency"),
+            total_amount=get("TotalAmount"),
+            tax_amount=get("TaxAmount"),
+            items=get("Items") or (),
+            notes=get("Notes"),
+            terms=get("TermsAndConditions"),
+            file_url=get("FileURL"),
+            flags=get("Flags"),
+            vendor=VendorSnapshot(vendor_info) if vendor_info is not None else None,
+            resolution=get("VendorResolution"),
+            extra={key: value for key, value in item.items() if key not in keys} or None,
+            stored=True,
+        )
+
+    def to_item(self):
+        """The Invoices table item, unpacked."""
+        item = {
+            "invoiceId": self.invoice_id,
+            "VendorEmail": self.vendor_email,
+            "InvoiceNumber": self.invoice_number,
+            "InvoiceDate": self.invoice_date,
+            "DueDate": self.due_date,
+            "Currency": self.currency,
+            "TotalAmount": _stored(self._total_amount),
+            "TaxAmount": _stored(self._tax_amount),
+            "Items": [row.copy() for row in self._rows] if self._stored else _stored_rows(self._rows),
+            "Notes": self.notes,
+            "TermsAndConditions": self.terms,
+            "FileURL": self.file_url,
+            "Flags": self.flags,
+            "VendorInfo": self.vendor.to_item() if self.vendor is not None else None,
+        }
+        if self.resolution is not None:
+            item["VendorResolution"] = self.resolution
+        if self._stored and self._extra:
+            item.update(self._extra)
+        return item
+
+    def to_detail(self):
+        """The InvoiceExtracted detail, with JSON numbers."""
+        extra = None if self._stored else self.extra
+        detail = dict(extra) if extra else {}
+        detail.update(
+            InvoiceId=self.invoice_id,
+            VendorEmail=self.vendor_email,
+            InvoiceNumber=self.invoice_number,
+            InvoiceDate=self.invoice_date,
+            DueDate=self.due_date,
+            Currency=self.currency,
+            TotalAmount=_json_amount(self._total_amount),
+            TaxAmount=_json_amount(self._tax_amount),
+            LineItems=_detail_rows(self._rows) if self._stored else [row.copy() for row in self._rows],
+            Notes=self.notes,
+            TermsAndConditions=self.terms,
+            FileURL=self.file_url,
+        )
+        if self.vendor is not None:
+            for key, attribute in VendorSnapshot.FIELDS[2:]:
+                detail[key] = getattr(self.vendor, attribute)
+        return detail
+
+
+def json_default(value):
+    """JSON form of the DynamoDB types json.dumps does not handle."""
+    if isinstance(value, Decimal):
+        # Amounts keep their exact digits
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    return str(value)
+
+
+def dumps(value):
+    """Serialize items, records and responses for the API in one pass."""
+    return json.dumps(value, default=json_default)
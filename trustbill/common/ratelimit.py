@@ -0,0 +1,176 @@
+import random
+import time
+
+from botocore.exceptions import ClientError, ConnectionClosedError, EndpointConnectionError
+
+from trustbill.common import clients as aws
+
+# Keeps concurrent invocations under a shared quota (Bedrock requests and
+# tokens per minute) instead of letting each one discover the limit through
+# throttling errors.
+
+# Errors that mean "try again later" rather than "this request is bad"
+THROTTLE_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+}
+
+
+class RateLimited(Exception):
+    """No capacity became free within the limiter's max_wait_seconds."""
+
+
+class DeadlineExceeded(RateLimited):
+    """No capacity would become free before the caller's deadline."""
+
+
+class TokenBucket:
+    """Requests and tokens per minute, shared through a DynamoDB table.
+
+    The bucket refills every window_seconds. Each window has one counter item,
+    and acquire() charges it with a single conditional ADD that fails once
+    either budget is spent, so callers never race on read-modify-write.
+    Callers that miss wait for the next window plus jitter, so a backlog
+    drains at the quota rate instead of stampeding the window boundary.
+    Counter items expire through TTL on expiresAt.
+
+    If the table cannot be reached the limiter fails open: the throttling
+    backoff still protects Bedrock, and an outage never blocks extraction.
+    """
+
+    def __init__(
+        self,
+        table_name,
+        name,
+        requests_per_minute,
+        tokens_per_minute,
+        window_seconds=10,
+        max_wait_seconds=60,
+        clock=time.time,
+        sleep=time.sleep,
+    ):
+        self.table_name = table_name
+        self.name = name
+        self.window_seconds = window_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.request_capacity = max(1, int(requests_per_minute * window_seconds / 60))
+        self.token_capacity = max(1, int(tokens_per_minute * window_seconds / 60))
+        self.clock = clock
+        self.sleep = sleep
+
+    def window(self, now):
+        return int(now // self.window_seconds) * self.window_seconds
+
+    def try_acquire(self, window, tokens):
+        """Charge one request and tokens to window. Returns False when full."""
+        try:
+            aws.client("dynamodb").update_item(
+                TableName=self.table_name,
+                Key={"bucketKey": {"S": f"{self.name}#{window}"}},
+                UpdateExpression="ADD requests :one, tokens :tokens SET expiresAt = :expires",
+                ConditionExpression=(
+                    "attribute_not_exists(requests) OR "
+                    "(requests <= :request_limit AND tokens <= :token_limit)"
+                ),
+                ExpressionAttributeValues={
+                    ":one": {"N": "1"},
+                    ":tokens": {"N": str(tokens)},
+                    ":expires": {"N": str(window + 10 * self.window_seconds)},
+                    ":request_limit": {"N": str(self.request_capacity - 1)},
+                    ":token_limit": {"N": str(self.token_capacity - tokens)},
+                },
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def acquire(self, tokens, deadline=None):
+        """Block until a request costing tokens fits the budget.
+
+        Returns a reservation for settle(), holding the window charged and
+        the time spent waiting. Raises RateLimited after max_wait_seconds,
+        or as soon as the next wait would end after deadline (a time.time()
+        value).
+        """
+        # A request bigger than a whole window may still run, alone
+        tokens = max(0, min(int(tokens), self.token_capacity))
+        started = self.clock()
+        denied = 0
+        while True:
+            now = self.clock()
+            window = self.window(now)
+            try:
+                acquired = self.try_acquire(window, tokens)
+            except Exception as e:
+                print(f"Rate limiter unavailable, continuing without it: {e}")
+                return {"window": None, "tokens": tokens, "wait_ms": 0, "denied": denied}
+            if acquired:
+                wait_ms = round((self.clock() - started) * 1000, 2)
+                return {"window": window, "tokens": tokens, "wait_ms": wait_ms, "denied": denied}
+            denied += 1
+            delay = window + self.window_seconds - now
+            delay += random.uniform(0, self.window_seconds / 4)
+            if self.clock() + delay - started > self.max_wait_seconds:
+                raise RateLimited(
+                    f"{self.name}: no capacity within {self.max_wait_seconds}s"
+                )
+            if deadline is not None and self.clock() + delay > deadline:
+                raise DeadlineExceeded(f"{self.name}: no capacity before the deadline")
+            self.sleep(delay)
+
+    def settle(self, reservation, tokens):
+        """Correct the window's token count once actual usage is known."""
+        if reservation is None or reservation["window"] is None:
+            return
+        delta = int(tokens) - reservation["tokens"]
+        if not delta:
+            return
+        try:
+            aws.client("dynamodb").update_item(
+                TableName=self.table_name,
+                Key={"bucketKey": {"S": f"{self.name}#{reservation['window']}"}},
+                UpdateExpression="ADD tokens :delta",
+                ExpressionAttributeValues={":delta": {"N": str(delta)}},
+            )
+        except Exception as e:
+            print(f"Failed to settle rate limiter tokens: {e}")
+
+
+def is_throttle(error):
+    if isinstance(error, (EndpointConnectionError, ConnectionClosedError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in THROTTLE_CODES
+    return False
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """Full-jitter exponential backoff: uniform over [0, base * 2^attempt]."""
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+def retry_throttled(fn, stats, max_attempts=6, base_delay=1.0, max_delay=20.0, deadline=None):
+    """Call fn(), retrying throttling errors with jittered exponential backoff.
+
+    Adds the throttles seen and the time slept to stats["throttles"] and
+    stats["backoff_ms"]. Other errors, and the last throttle, are raised;
+    so is a throttle whose backoff would end after deadline (a time.time()
+    value), rather than sleeping into the caller's timeout.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if not is_throttle(e) or attempt == max_attempts - 1:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            if deadline is not None and time.time() + delay > deadline:
+                stats["deadline_exceeded"] = stats.get("deadline_exceeded", 0) + 1
+                raise
+            stats["throttles"] = stats.get("throttles", 0) + 1
+            stats["backoff_ms"] = round(stats.get("backoff_ms", 0) + delay * 1000, 2)
+            time.sleep(delay)
@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+
+from trustbill.common import clients as aws
+
+# Per-container cache of trusted vendor records, so verify does not query
+# the TrustedVendors table for every invoice. The data function bumps a
+# version counter whenever it adds or changes a vendor; caches that see a
+# new version drop everything they hold.
+
+TRUSTED_VENDORS = "trusted-vendors"
+
+
+def bump_version(table_name, name=TRUSTED_VENDORS):
+    """Increment the version of name, invalidating every container's cache."""
+    response = aws.table(table_name).update_item(
+        Key={"cacheName": name},
+        UpdateExpression="ADD #version :one",
+        ExpressionAttributeNames={"#version": "version"},
+        ExpressionAttributeValues={":one": 1},
+        ReturnValues="UPDATED_NEW",
+    )
+    return int(response["Attributes"]["version"])
+
+
+def read_version(table_name, name=TRUSTED_VENDORS):
+    item = aws.table(table_name).get_item(Key={"cacheName": name}).get("Item")
+    return int(item["version"]) if item else 0
+
+
+class VendorCache:
+    """TTL-bounded LRU of vendor records by VendorEmail.
+
+    Unknown senders are cached too (as an empty list), for
+    negative_ttl_seconds. The version in version_table is re-read at most
+    every version_check_seconds, so after a change through the data API a
+    container serves the old records for at most that long; an entry is
+    never served more than ttl_seconds after it was loaded, even if the
+    version cannot be read. get() reports the age of what it returns.
+    """
+
+    def __init__(
+        self,
+        max_entries=1024,
+        ttl_seconds=300,
+        negative_ttl_seconds=60,
+        version_table=None,
+        version_check_seconds=30,
+        clock=time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.version_table = version_table
+        self.version_check_seconds = version_check_seconds
+        self.clock = clock
+        self.version = None
+        self.version_checked_at = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "negative_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def check_version(self, now):
+        if self.version_table is None:
+            return
+        if self.version_checked_at is not None and now - self.version_checked_at < self.version_check_seconds:
+            return
+        try:
+            version = read_version(self.version_table)
+        except Exception as e:
+            # Entries still expire on their TTL
+            print(f"Vendor cache version check failed: {e}")
+            return
+        with self._lock:
+            self.version_checked_at = now
+            if self.version is not None and version != self.version:
+                self._entries.clear()
+                self.stats["invalidations"] += 1
+            self.version = version
+
+    def get(self, vendor_email, load):
+        """Return (records, age in seconds) for vendor_email.
+
+        load() fetches the records on a miss; an empty list marks an unknown
+        sender. The age is None when the records were just loaded.
+        """
+        now = self.clock()
+        self.check_version(now)
+        with self._lock:
+            entry = self._entries.get(vendor_email)
+            if entry is not None:
+                loaded_at, records = entry
+                ttl = self.ttl_seconds if records else self.negative_ttl_seconds
+                if now - loaded_at < ttl:
+                    self._entries.move_to_end(vendor_email)
+                    self.stats["hits" if records else "negative_hits"] += 1
+                    return records, now - loaded_at
+                del self._entries[vendor_email]
+            self.stats["misses"] += 1
+
+        records = load()
+        with self._lock:
+            self._entries[vendor_email] = (now, records)
+            self._entries.move_to_end(vendor_email)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return records, None
+
+    @property
+    def hit_rate(self):
+        hits = self.stats["hits"] + self.stats["negative_hits"]
+        total = hits + self.stats["misses"]
+        return round(hits / total, 4) if total else 0.0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.version = None
+            self.version_checked_at = None
+            self.stats = {key: 0 for key in self.stats}
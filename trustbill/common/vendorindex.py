@@ -0,0 +1,164 @@
+import hashlib
+import re
+import sys
+
+from trustbill.common import clients as aws
+
+# Lookup keys for resolving an invoice to a trusted vendor by more than its
+# sender address: GSTIN, bank account (hashed with its IFSC or routing
+# number) and a blocked form of the vendor name, besides the email. Each key
+# is one item holding the set of vendorIds that have it, so resolving an
+# invoice is a single BatchGetItem of at most a handful of keys, and "this
+# bank account belongs to another vendor" falls out of the same read.
+
+# How much a matched key says about a candidate being the sender's vendor
+KEY_WEIGHTS = {"email": 0.4, "gstin": 0.35, "bank": 0.3, "name": 0.15}
+# Resolutions below this score are reported without a vendorId
+MIN_SCORE = 0.3
+# Dropped when blocking names, so "Acme Traders Pvt. Ltd." is "acme traders"
+NAME_STOPWORDS = {
+    "the", "and", "co", "company", "corp", "corporation", "inc", "incorporated", "llc", "llp",
+    "ltd", "limited", "pvt", "private", "plc", "gmbh", "enterprises",
+}
+MAX_GET_ATTEMPTS = 5
+
+
+def normalize_name(name):
+    """The blocking form of a vendor name: significant words, sorted."""
+    words = re.findall(r"[a-z0-9]+", str(name or "").lower())
+    return " ".join(sorted({word for word in words if word not in NAME_STOPWORDS}))
+
+
+def _identifier(value):
+    return re.sub(r"[^0-9A-Z]", "", str(value or "").upper())
+
+
+def bank_key(account, code):
+    """Hash of a normalized bank account and its IFSC or routing number."""
+    account, code = _identifier(account), _identifier(code)
+    if not account or not code:
+        return None
+    return "bank:" + hashlib.sha256(f"{account}|{code}".encode()).hexdigest()[:32]
+
+
+def lookup_keys(vendor):
+    """[(kind, lookupKey)] for a vendor record or InvoiceExtracted detail."""
+    keys = []
+    email = str(vendor.get("VendorEmail") or "").strip().lower()
+    if email:
+        keys.append(("email", f"email:{email}"))
+    gstin = _identifier(vendor.get("VendorGSTIN"))
+    if gstin:
+        keys.append(("gstin", f"gstin:{gstin}"))
+    for code_field in ("VendorIFSCCode", "VendorBankRoutingNumber"):
+        key = bank_key(vendor.get("VendorBankAccount"), vendor.get(code_field))
+        if key is not None:
+            keys.append(("bank", key))
+    name = normalize_name(vendor.get("VendorName"))
+    if name:
+        keys.append(("name", f"name:{name}"))
+    return keys
+
+
+def index_vendor(table_name, vendor, previous=None):
+    """Add vendor's vendorId to each of its lookup keys.
+
+    previous is the vendor's record before this change, if any; the keys it
+    no longer has are released.
+    """
+    table = aws.table(table_name)
+    vendor_id = vendor["vendorId"]
+    keys = dict((key, kind) for kind, key in lookup_keys(vendor))
+    for key, kind in keys.items():
+        table.update_item(
+            Key={"lookupKey": key},
+            UpdateExpression="ADD vendorIds :ids SET #kind = :kind",
+            ExpressionAttributeNames={"#kind": "kind"},
+            ExpressionAttributeValues={":ids": {vendor_id}, ":kind": kind},
+        )
+    for _, key in lookup_keys(previous or {}):
+        if key not in keys:
+            table.update_item(
+                Key={"lookupKey": key},
+                UpdateExpression="DELETE vendorIds :ids",
+                ExpressionAttributeValues={":ids": {vendor_id}},
+            )
+    return len(keys)
+
+
+class Resolution:
+    """The best-matching trusted vendor for an invoice, if any.
+
+    matches maps each candidate vendorId to the kinds of key it shares with
+    the invoice. bank_owners are the vendors holding the invoice's bank
+    account; bank_conflict is true when none of them is the vendor the
+    invoice otherwise identifies by email, GSTIN or name.
+    """
+
+    def __init__(self, matches, bank_owners):
+        self.matches = matches
+        self.bank_owners = bank_owners
+        self.scores = {
+            vendor_id: round(min(1.0, sum(KEY_WEIGHTS[kind] for kind in kinds)), 4)
+            for vendor_id, kinds in matches.items()
+        }
+        best = max(self.scores, key=lambda vendor_id: (self.scores[vendor_id], vendor_id), default=None)
+        self.vendor_id = best if best is not None and self.scores[best] >= MIN_SCORE else None
+        self.score = self.scores.get(self.vendor_id, 0.0)
+        identified = {vendor_id for vendor_id, kinds in matches.items() if kinds - {"bank"}}
+        self.bank_conflict = bool(bank_owners) and not (bank_owners & identified)
+
+    def to_item(self):
+        return {
+            "vendorId": self.vendor_id,
+            "score": str(self.score),
+            "matched": sorted(self.matches.get(self.vendor_id, ())),
+            "bankOwners": sorted(self.bank_owners),
+        }
+
+
+def _batch_get(table_name, keys):
+    dynamodb = aws.resource("dynamodb")
+    request = {table_name: {"Keys": [{"lookupKey": key} for key in keys]}}
+    items = []
+    for _ in range(MAX_GET_ATTEMPTS):
+        response = dynamodb.batch_get_item(RequestItems=request)
+        items.extend(response.get("Responses", {}).get(table_name, []))
+        request = response.get("UnprocessedKeys") or {}
+        if not request:
+            return items
+    raise RuntimeError(f"Could not read vendor lookup keys from {table_name}")
+
+
+def resolve(table_name, data):
+    """Resolve an InvoiceExtracted detail against the lookup keys in one read."""
+    keys = dict((key, kind) for kind, key in lookup_keys(data))
+    matches, bank_owners = {}, set()
+    if keys:
+        for item in _batch_get(table_name, list(keys)):
+            kind = keys[item["lookupKey"]]
+            for vendor_id in item.get("vendorIds", ()):
+                matches.setdefault(vendor_id, set()).add(kind)
+                if kind == "bank":
+                    bank_owners.add(vendor_id)
+    return Resolution(matches, bank_owners)
+
+
+def backfill(vendors_table_name, keys_table_name):
+    """Index the lookup keys of every trusted vendor. Returns the vendors indexed."""
+    table = aws.table(vendors_table_name)
+    indexed = 0
+    kwargs = {}
+    while True:
+        response = table.scan(**kwargs)
+        for vendor in response.get("Items", []):
+            index_vendor(keys_table_name, vendor)
+            indexed += 1
+        if "LastEvaluatedKey" not in response:
+            return indexed
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+if __name__ == "__main__":
+    # python -m trustbill.common.vendorindex <TrustedVendorsTable> <VendorKeysTable>
+    print(f"Indexed the lookup keys of {backfill(sys.argv[1], sys.argv[2])} vendors")
@@ -0,0 +1,256 @@
+import math
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from trustbill.common import clients as aws
+
+# Running amount statistics per vendor and currency, so the unusual-amount
+# check reads one small item instead of the vendor's whole invoice history.
+
+EWMA_ALPHA = 0.1
+# Quantiles read from the sketch are within 2% of the true value
+SKETCH_RELATIVE_ACCURACY = 0.02
+SKETCH_MAX_BUCKETS = 256
+MAX_UPDATE_ATTEMPTS = 8
+UNKNOWN_CURRENCY = "UNKNOWN"
+
+
+def currency_key(currency):
+    return (currency or "").strip().upper() or UNKNOWN_CURRENCY
+
+
+def parse_amount(value):
+    """The amount as a Decimal, or None when it is missing or not a number."""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        amount = Decimal(str(value).replace(",", "").strip())
+    except ArithmeticError:
+        return None
+    return amount if amount.is_finite() else None
+
+
+class QuantileSketch:
+    """Log-bucketed histogram with bounded relative error (as in DDSketch).
+
+    A positive amount x lands in bucket ceil(log(x) / log(gamma)); the rest
+    are only counted. When there are more than max_buckets, the lowest
+    buckets are merged, so only the small quantiles lose accuracy.
+    """
+
+    def __init__(self, buckets=None, relative_accuracy=SKETCH_RELATIVE_ACCURACY,
+                 max_buckets=SKETCH_MAX_BUCKETS):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.max_buckets = max_buckets
+        buckets = dict(buckets or {})
+        self.non_positive = int(buckets.pop("zero", 0))
+        self.buckets = {int(k): int(v) for k, v in buckets.items()}
+
+    def add(self, amount):
+        amount = float(amount)
+        if amount <= 0:
+            self.non_positive += 1
+            return
+        index = math.ceil(math.log(amount) / math.log(self.gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            lowest, second = sorted(self.buckets)[:2]
+            self.buckets[second] += self.buckets.pop(lowest)
+
+    def quantile(self, q):
+        """The approximate q-quantile (0 <= q <= 1), or None when empty."""
+        total = self.non_positive + sum(self.buckets.values())
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = self.non_positive
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * self.gamma**index / (1 + self.gamma)
+        return None
+
+    def to_item(self):
+        # DynamoDB map keys must be strings
+        item = {str(k): v for k, v in self.buckets.items()}
+        if self.non_positive:
+            item["zero"] = self.non_positive
+        return item
+
+
+class AmountStats:
+    """One vendor's running statistics for one currency."""
+
+    def __init__(self, item=None):
+        item = item or {}
+        self.count = int(item.get("count", 0))
+        self.total = Decimal(item.get("total", 0))
+        self.sum_squares = Decimal(item.get("sumSquares", 0))
+        self.ewma = Decimal(item["ewma"]) if "ewma" in item else None
+        self.sketch = QuantileSketch(item.get("sketch"))
+        self.version = int(item.get("version", 0))
+
+    def add(self, amount):
+        amount = Decimal(amount)
+        self.count += 1
+        self.total += amount
+        self.sum_squares += amount * amount
+        self.add_estimate(amount)
+
+    def add_estimate(self, amount):
+        """Update only the EWMA and the sketch with amount."""
+        amount = Decimal(amount)
+        if self.ewma is None:
+            self.ewma = amount
+        else:
+            self.ewma += Decimal(str(EWMA_ALPHA)) * (amount - self.ewma)
+        self.sketch.add(amount)
+
+    @property
+    def mean(self):
+        return float(self.total / self.count) if self.count else None
+
+    @property
+    def stddev(self):
+        if self.count < 2:
+            return None
+        variance = (self.sum_squares - self.total * self.total / self.count) / (self.count - 1)
+        return math.sqrt(max(float(variance), 0.0))
+
+    def to_item(self, vendor_email, currency):
+        return {
+            "VendorEmail": vendor_email,
+            "Currency": currency,
+            "count": self.count,
+            "total": self.total,
+            "sumSquares": self.sum_squares,
+            "ewma": self.ewma if self.ewma is not None else Decimal(0),
+            "sketch": self.sketch.to_item(),
+            "version": self.version,
+            "updatedAt": datetime.now().isoformat(),
+        }
+
+
+def get(table_name, vendor_email, currency):
+    """The vendor's AmountStats for currency, or None when there is no record."""
+    item = aws.table(table_name).get_item(
+        Key={"VendorEmail": vendor_email, "Currency": currency_key(currency)},
+        ConsistentRead=True,
+    ).get("Item")
+    return AmountStats(item) if item else None
+
+
+def record(table_name, vendor_email, currency, amount):
+    """Add one invoice amount to the vendor's statistics."""
+    return record_many(table_name, vendor_email, currency, [amount])
+
+
+def record_many(table_name, vendor_email, currency, amounts):
+    """Add invoice amounts to the vendor's statistics.
+
+    Amounts that are not numbers are skipped. count, total and sumSquares
+    are added with a single ADD update, which concurrent writers cannot
+    conflict on, so the mean and deviation never lose an amount. The EWMA
+    and the sketch depend on the previous value, so they are rewritten only
+    if the item's version is unchanged since it was read; a writer that
+    loses the race re-reads and tries again, and after MAX_UPDATE_ATTEMPTS
+    leaves these estimates without its amounts.
+    """
+    amounts = [amount for amount in map(parse_amount, amounts) if amount is not None]
+    if not amounts or not vendor_email:
+        return None
+    currency = currency_key(currency)
+    table = aws.table(table_name)
+    key = {"VendorEmail": vendor_email, "Currency": currency}
+    table.update_item(
+        Key=key,
+        UpdateExpression="ADD #count :count, #total :total, #sumSquares :sumSquares SET #updatedAt = :now",
+        ExpressionAttributeNames={
+            "#count": "count",
+            "#total": "total",
+            "#sumSquares": "sumSquares",
+            "#updatedAt": "updatedAt",
+        },
+        ExpressionAttributeValues={
+            ":count": len(amounts),
+            ":total": sum(amounts),
+            ":sumSquares": sum(amount * amount for amount in amounts),
+            ":now": datetime.now().isoformat(),
+        },
+    )
+    stats = None
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        stats = get(table_name, vendor_email, currency)
+        expected = stats.version
+        for amount in amounts:
+            stats.add_estimate(amount)
+        stats.version += 1
+        try:
+            table.update_item(
+                Key=key,
+                UpdateExpression="SET #ewma = :ewma, #sketch = :sketch, #version = :version",
+                ConditionExpression="attribute_not_exists(#version) OR #version = :expected",
+                ExpressionAttributeNames={"#ewma": "ewma", "#sketch": "sketch", "#version": "version"},
+                ExpressionAttributeValues={
+                    ":ewma": stats.ewma,
+                    ":sketch": stats.sketch.to_item(),
+                    ":version": stats.version,
+                    ":expected": expected,
+                },
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            time.sleep(0.01 * 2**attempt)
+            continue
+        return stats
+    # The exact sums are recorded; only the approximate estimates miss these amounts
+    print(f"Could not update the amount estimates for {vendor_email} {currency}")
+    return stats
+
+
+def backfill(invoices_table_name, stats_table_name):
+    """Rebuild every vendor's statistics from the invoices table.
+
+    Scans the whole table (following LastEvaluatedKey) and overwrites the
+    statistics items. Run it once after deploying, before relying on the
+    records, or to repair them. Returns the number of records written.
+    """
+    stats = {}
+    kwargs = {
+        "ProjectionExpression": "#email, #currency, #amount",
+        "ExpressionAttributeNames": {
+            "#email": "VendorEmail",
+            "#currency": "Currency",
+            "#amount": "TotalAmount",
+        },
+    }
+    table = aws.table(invoices_table_name)
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get("Items", []):
+            amount = parse_amount(item.get("TotalAmount"))
+            if amount is None or not item.get("VendorEmail"):
+                continue
+            key = (item["VendorEmail"], currency_key(item.get("Currency")))
+            stats.setdefault(key, AmountStats()).add(amount)
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    with aws.table(stats_table_name).batch_writer() as batch:
+        for (vendor_email, currency), vendor_stats in stats.items():
+            vendor_stats.version = 1
+            batch.put_item(Item=vendor_stats.to_item(vendor_email, currency))
+    return len(stats)
+
+
+if __name__ == "__main__":
+    # python -m trustbill.common.vendorstats <InvoicesTable> <VendorStatsTable>
+    print(f"Wrote {backfill(sys.argv[1], sys.argv[2])} vendor statistics records")
@@ -2,29 +2,54 @@ import json
 import os
 import re
 
-import boto3
+from trustbill.common import clients as aws
+from trustbill.common import invoicecodec
+from trustbill.common import model
+from trustbill.common import vendorcache
+from trustbill.common import vendorindex
 
-# Initialize DynamoDB resources (lazy-loaded to support testing)
 VENDORS_TABLE = os.getenv("TrustedVendorsTable")
 INVOICES_TABLE = os.getenv("InvoicesTable")
-dynamodb = boto3.resource("dynamodb")
+# Bumped on every vendor change so verify drops its cached vendor records
+CACHE_VERSIONS_TABLE = os.getenv("CacheVersionsTable")
+# Lookup keys by GSTIN, bank account and name, for vendor resolution in verify
+VENDOR_KEYS_TABLE = os.getenv("VendorKeysTable")
+
 
 def get_tables():
     """Get DynamoDB tables. Lazy loading to support testing."""
     return {
-        "vendors": dynamodb.Table(VENDORS_TABLE),
-        "invoices": dynamodb.Table(INVOICES_TABLE)
+        "vendors": aws.table(VENDORS_TABLE),
+        "invoices": aws.table(INVOICES_TABLE)
     }
 
 
-def get_all_data():
-    """Get all vendors and invoices data"""
+def get_all_data(fields=None):
+    """Get all vendors and invoices data
+
+    fields limits the invoice attributes returned. Packed line items and
+    vendor snapshots are read and decoded only when Items or VendorInfo is
+    among them (or fields is not given).
+    """
     tables = get_tables()
     # Get all vendors
     vendor_response = tables["vendors"].scan()
     vendors = vendor_response.get("Items", [])    # Get all invoices
-    invoice_response = tables["invoices"].scan()
-    invoices = invoice_response.get("Items", [])
+    scan_kwargs = {}
+    if fields:
+        projected = set(fields) | {"invoiceId"}
+        if projected & set(invoicecodec.PACKED_FIELDS):
+            projected.add(invoicecodec.PACKED_ATTRIBUTE)
+        names = {f"#f{i}": name for i, name in enumerate(sorted(projected))}
+        scan_kwargs = {
+            "ProjectionExpression": ", ".join(names),
+            "ExpressionAttributeNames": names,
+        }
+    invoice_response = tables["invoices"].scan(**scan_kwargs)
+    invoices = [
+        invoicecodec.unpack(item, fields or invoicecodec.PACKED_FIELDS)
+        for item in invoice_response.get("Items", [])
+    ]
 
     # Combine the data
     return {"vendors": vendors, "invoices": invoices}
@@ -52,13 +77,35 @@ def unflag_invoice(invoice_id):
         return {
             "success": True,
             "message": f"Invoice {invoice_id} has been unflagged",
-            "invoice": invoice,
+            "invoice": invoicecodec.unpack(invoice),
         }
 
     except Exception as e:
         return {"success": False, "message": str(e)}
 
 
+def invalidate_vendor_caches():
+    """Tell every verify container that trusted vendor records changed."""
+    if not CACHE_VERSIONS_TABLE:
+        return
+    try:
+        vendorcache.bump_version(CACHE_VERSIONS_TABLE)
+    except Exception as e:
+        # Cached records still expire on their TTL
+        print(f"Failed to bump the trusted vendors version: {e}")
+
+
+def index_vendor_keys(vendor, previous=None):
+    """Point the vendor's lookup keys at it, releasing the ones it no longer has."""
+    if not VENDOR_KEYS_TABLE or "vendorId" not in vendor:
+        return
+    try:
+        vendorindex.index_vendor(VENDOR_KEYS_TABLE, vendor, previous)
+    except Exception as e:
+        # Rerun the vendorindex backfill to repair
+        print(f"Failed to index vendor lookup keys: {e}")
+
+
 def lambda_handler(event, context):
     """Handle API Gateway requests"""
     # Extract path and method from the event
@@ -79,11 +126,13 @@ def lambda_handler(event, context):
 
     # Handle GET /all request
     if http_method == "GET" and path == "/invoices":
-        data = get_all_data()
+        # ?fields=invoiceId,Flags skips decoding packed line items
+        fields = ((event.get("queryStringParameters") or {}).get("fields") or "").split(",")
+        data = get_all_data([field.strip() for field in fields if field.strip()] or None)
         return {
             "statusCode": 200,
             "headers": headers,
-            "body": json.dumps(data, default=str),
+            "body": model.dumps(data),
         }
 
     # Handle PUT /invoices/{invoiceId} request
@@ -95,7 +144,7 @@ def lambda_handler(event, context):
             return {
                 "statusCode": status_code,
                 "headers": headers,
-                "body": json.dumps(result, default=str),
+                "body": model.dumps(result),
             }
         else:
             return {
@@ -115,7 +164,12 @@ def lambda_handler(event, context):
                     "body": json.dumps({"message": "Invalid request body"}),
                 }
             tables = get_tables()
+            previous = None
+            if VENDOR_KEYS_TABLE and "vendorId" in body:
+                previous = tables["vendors"].get_item(Key={"vendorId": body["vendorId"]}).get("Item")
             tables["vendors"].put_item(Item=body)
+            index_vendor_keys(body, previous)
+            invalidate_vendor_caches()
             return {
                 "statusCode": 201,
                 "headers": headers,
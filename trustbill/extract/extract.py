@@ -1,12 +1,36 @@
-import base64
+import binascii
+import hashlib
 import json
 import os
 import re
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
+from decimal import Decimal
+from io import BytesIO, RawIOBase
 
-import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+from trustbill.common import claimcheck
+from trustbill.common import clients as aws
+from trustbill.common import metrics
+from trustbill.common import model
+from trustbill.common import ratelimit
+from trustbill.common import vendorcache
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:  # optional: without it every invoice goes to Bedrock as received
+    PdfReader = PdfWriter = None
+
+try:
+    from PIL import Image
+except ImportError:  # optional: embedded images are then left at full resolution
+    Image = None
 
 BUCKET_NAME = "serverless-trustbill-invoices"
 system_prompt = """
@@ -102,6 +126,11 @@ system_prompt = """
     }
 """
 MODEL_ID = "us.amazon.nova-premier-v1:0"
+# Models tried in order, cheapest first. Each answer is scored and only a
+# failing or low-confidence one goes on to the next tier; the last tier's
+# answer is always used.
+MODEL_TIERS = [m.strip() for m in os.getenv("ModelTiers", MODEL_ID).split(",") if m.strip()]
+MODEL_ROUTE = "+".join(MODEL_TIERS)
 prompt = """
     ## Task
     Process the provided invoice. 
@@ -111,10 +140,1773 @@ prompt = """
 
     Provide your response immediately without any preamble or additional information
 """
+repair_prompt = """
+    Some fields in your previous answer are missing or do not match the schema:
+    {problems}
 
+    Re-read the invoice and return a JSON object containing only these fields. Use null for a field that is not present in the document.
 
-def lambda_handler(event, context):
-    body = json.loads(event.get("body", "{}") or "{}")
+    Provide your response immediately without any preamble or additional information
+"""
+# The JSON schema embedded in the system prompt, parsed once per container.
+INVOICE_SCHEMA = json.loads(system_prompt[system_prompt.index("{") : system_prompt.rindex("}") + 1])
+REQUIRED_FIELDS = frozenset(INVOICE_SCHEMA["required"])
+
+
+def compact_system_prompt(schema):
+    """A shorter system prompt listing the schema's fields instead of embedding it."""
+
+    def describe(name, field):
+        types = field.get("type", [])
+        types = [types] if isinstance(types, str) else types
+        if "array" in types:
+            columns = ", ".join(field["items"]["properties"])
+            return f"{name}: list of {{{columns}}}"
+        if field.get("format") == "date":
+            return f"{name}: YYYY-MM-DD"
+        return f"{name}: {'number' if 'number' in types else 'string'}"
+
+    listing = "\n".join(
+        f"    - {describe(name, field)}" for name, field in schema["properties"].items()
+    )
+    return f"""
+    You are an AI invoice parser. Return only a JSON object with exactly these keys, using null for any field not in the document:
+{listing}
+"""
+
+
+PROMPT_VARIANT = os.getenv("PromptVariant", "full")
+SYSTEM_PROMPT = (
+    compact_system_prompt(INVOICE_SCHEMA) if PROMPT_VARIANT == "compact" else system_prompt
+)
+# Changes whenever the prompt or embedded schema changes, so stale cache
+# entries produced by an older prompt are never served.
+PROMPT_VERSION = hashlib.sha256((SYSTEM_PROMPT + prompt).encode()).hexdigest()[:16]
+
+PROMPT_CACHING = os.getenv("PromptCaching", "true").lower() == "true"
+# Model families whose Converse API accepts cachePoint blocks
+PROMPT_CACHE_MODELS = (
+    "amazon.nova-",
+    "anthropic.claude-3-7-",
+    "anthropic.claude-sonnet-4",
+    "anthropic.claude-opus-4",
+)
+
+EXTRACTION_CACHE_TABLE = os.getenv("ExtractionCacheTable")
+EXTRACTION_CACHE_TTL_SECONDS = int(os.getenv("ExtractionCacheTtlSeconds", str(30 * 24 * 3600)))
+EXTRACTION_CACHE_SIZE = int(os.getenv("ExtractionCacheSize", "128"))
+MAX_ATTACHMENT_WORKERS = int(os.getenv("MaxAttachmentWorkers", "8"))
+EXTRACTION_STREAMING = os.getenv("ExtractionStreaming", "false").lower() == "true"
+EXTRACTION_REPAIR = os.getenv("ExtractionRepair", "true").lower() == "true"
+REPAIR_MAX_TOKENS = int(os.getenv("RepairMaxTokens", "1024"))
+VENDOR_TEMPLATES_TABLE = os.getenv("VendorTemplatesTable")
+TEMPLATE_FAST_PATH = os.getenv("TemplateFastPath", "true").lower() == "true"
+TEMPLATE_MIN_CONFIDENCE = float(os.getenv("TemplateMinConfidence", "1.0"))
+TEMPLATE_CACHE_SECONDS = int(os.getenv("TemplateCacheSeconds", "300"))
+TEMPLATE_MAX_PAGES = int(os.getenv("TemplateMaxPages", "5"))
+# Lowest score_extraction confidence at which a cheaper tier's answer is kept
+ROUTING_MIN_CONFIDENCE = float(os.getenv("RoutingMinConfidence", "0.9"))
+TRUSTED_VENDORS_TABLE = os.getenv("TrustedVendorsTable")
+VENDOR_PROFILE_CACHE_SECONDS = int(os.getenv("VendorProfileCacheSeconds", "300"))
+# The data function bumps the trusted-vendors version here on every change
+CACHE_VERSIONS_TABLE = os.getenv("CacheVersionsTable")
+VENDOR_CACHE_VERSION_CHECK_SECONDS = int(os.getenv("VendorCacheVersionCheckSeconds", "30"))
+# "sync" extracts inside the webhook request; "async" queues it and returns 202
+INGEST_MODE = os.getenv("IngestMode", "sync")
+INGEST_QUEUE_URL = os.getenv("IngestQueueUrl")
+INGEST_JOBS_TABLE = os.getenv("IngestJobsTable")
+INGEST_JOB_TTL_SECONDS = int(os.getenv("IngestJobTtlSeconds", str(14 * 24 * 3600)))
+INGEST_PREFIX = "ingest/"
+QUEUE_WORKER_CONCURRENCY = int(os.getenv("QueueWorkerConcurrency", "4"))
+PREPROCESS_DOCUMENTS = os.getenv("PreprocessDocuments", "true").lower() == "true"
+PREPROCESS_MAX_PAGES = int(os.getenv("PreprocessMaxPages", "5"))
+# Bedrock rejects documents over 4.5 MB
+PREPROCESS_MAX_BYTES = int(os.getenv("PreprocessMaxBytes", str(4 * 1024 * 1024)))
+PREPROCESS_IMAGE_MAX_SIDE = int(os.getenv("PreprocessImageMaxSide", "1600"))
+PREPROCESS_IMAGE_QUALITY = int(os.getenv("PreprocessImageQuality", "70"))
+# EventBridge accepts at most 10 entries per PutEvents request
+PUT_EVENTS_BATCH_SIZE = 10
+# Publish InvoiceExtracted events as pointers to the full detail in S3
+CLAIM_CHECK_EVENTS = os.getenv("ClaimCheckEvents", "false").lower() == "true"
+CLAIM_CHECK_COMPRESSION = os.getenv("ClaimCheckCompression", "true").lower() == "true"
+CLAIM_CHECK_PREFIX = "extractions/"
+# Shared Bedrock quota across every concurrent invocation; set these to the
+# account's requests and tokens per minute (applied to each model tier)
+RATE_LIMIT_TABLE = os.getenv("RateLimitTable")
+BEDROCK_REQUESTS_PER_MINUTE = int(os.getenv("BedrockRequestsPerMinute", "50"))
+BEDROCK_TOKENS_PER_MINUTE = int(os.getenv("BedrockTokensPerMinute", "400000"))
+# Tokens charged up front per call, corrected once the call reports usage
+BEDROCK_TOKEN_ESTIMATE = int(os.getenv("BedrockTokenEstimate", "6000"))
+RATE_LIMIT_WINDOW_SECONDS = int(os.getenv("RateLimitWindowSeconds", "10"))
+RATE_LIMIT_MAX_WAIT_SECONDS = int(os.getenv("RateLimitMaxWaitSeconds", "60"))
+BEDROCK_MAX_ATTEMPTS = int(os.getenv("BedrockMaxAttempts", "6"))
+BEDROCK_BACKOFF_BASE_SECONDS = float(os.getenv("BedrockBackoffBaseSeconds", "1"))
+BEDROCK_BACKOFF_MAX_SECONDS = float(os.getenv("BedrockBackoffMaxSeconds", "20"))
+# Waits for Bedrock capacity end this long before the invocation times out,
+# leaving time to clean up and report the attachment as failed
+BEDROCK_DEADLINE_MARGIN_SECONDS = float(os.getenv("BedrockDeadlineMarginSeconds", "10"))
+# Attachments at least this large are uploaded part by part while decoding
+MULTIPART_UPLOAD_THRESHOLD = int(os.getenv("MultipartUploadThreshold", str(16 * 1024 * 1024)))
+# S3 requires every part except the last to be at least 5 MiB
+UPLOAD_PART_SIZE = max(int(os.getenv("UploadPartSize", str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+# Base64 characters decoded per step (a multiple of 4, 768 KiB decoded)
+DECODE_CHUNK_CHARS = 1024 * 1024
+
+
+class ExtractionCache:
+    """Content-addressed cache of Bedrock extractions.
+
+    A small in-memory LRU serves warm containers; the DynamoDB table (when
+    configured) is shared by every container and expires entries with TTL.
+    Safe to use from the attachment worker threads.
+    """
+
+    def __init__(self, table_name=None, max_entries=128, ttl_seconds=30 * 24 * 3600):
+        self.table_name = table_name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "table_hits": 0, "misses": 0}
+
+    def client(self):
+        # Low-level clients are thread-safe, unlike dynamodb.Table resources
+        return aws.client("dynamodb") if self.table_name else None
+
+    def get(self, key):
+        """Return the cached extraction for key, or None on a miss."""
+        with self._lock:
+            serialized = self._entries.get(key)
+            if serialized is not None:
+                self._entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return json.loads(serialized)
+
+        item = None
+        if self.client() is not None:
+            try:
+                item = self.client().get_item(
+                    TableName=self.table_name, Key={"cacheKey": {"S": key}}
+                ).get("Item")
+            except Exception as e:
+                print(f"Extraction cache lookup failed: {e}")
+            # DynamoDB TTL deletion is lazy, so honour the expiry ourselves
+            if item and int(item.get("expiresAt", {}).get("N", 0)) < time.time():
+                item = None
+
+        with self._lock:
+            if item is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["table_hits"] += 1
+            self._remember(key, item["extraction"]["S"])
+        return json.loads(item["extraction"]["S"])
+
+    def put(self, key, extraction):
+        serialized = json.dumps(extraction)
+        with self._lock:
+            self._remember(key, serialized)
+        if self.client() is None:
+            return
+        try:
+            self.client().put_item(
+                TableName=self.table_name,
+                Item={
+                    "cacheKey": {"S": key},
+                    "extraction": {"S": serialized},
+                    "modelId": {"S": MODEL_ROUTE},
+                    "promptVersion": {"S": PROMPT_VERSION},
+                    "expiresAt": {"N": str(int(time.time()) + self.ttl_seconds)},
+                },
+            )
+        except Exception as e:
+            print(f"Extraction cache write failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for k in self.stats:
+                self.stats[k] = 0
+
+    def _remember(self, key, serialized):
+        self._entries[key] = serialized
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def extraction_cache_key(document_bytes, digest=None):
+    """Cache key for a document: its SHA-256 plus the model tiers and prompt version.
+
+    Pass digest when the SHA-256 is already known (decode_attachment computes
+    it while decoding) to avoid hashing the document twice.
+    """
+    digest = digest or hashlib.sha256(document_bytes).hexdigest()
+    return f"{MODEL_ROUTE}#{PROMPT_VERSION}#{digest}"
+
+
+extraction_cache = ExtractionCache(
+    EXTRACTION_CACHE_TABLE, EXTRACTION_CACHE_SIZE, EXTRACTION_CACHE_TTL_SECONDS
+)
+
+
+# Bedrock quotas are per model, so each model gets its own bucket
+bedrock_limiters = {}
+bedrock_limiters_lock = threading.Lock()
+
+
+def bedrock_limiter(model_id):
+    if not RATE_LIMIT_TABLE:
+        return None
+    with bedrock_limiters_lock:
+        if model_id not in bedrock_limiters:
+            bedrock_limiters[model_id] = ratelimit.TokenBucket(
+                RATE_LIMIT_TABLE,
+                f"bedrock#{model_id}",
+                BEDROCK_REQUESTS_PER_MINUTE,
+                BEDROCK_TOKENS_PER_MINUTE,
+                window_seconds=RATE_LIMIT_WINDOW_SECONDS,
+                max_wait_seconds=RATE_LIMIT_MAX_WAIT_SECONDS,
+            )
+        return bedrock_limiters[model_id]
+
+
+# When the running invocation's waits for Bedrock must end, as a time.time()
+# value, or None when there is no limit. Lambda runs one invocation per
+# container at a time, so its worker threads can share a module-level value.
+invocation = {"deadline": None}
+
+
+def start_invocation(context):
+    """Set the Bedrock deadline from the Lambda context's remaining time."""
+    remaining_ms = getattr(context, "get_remaining_time_in_millis", None)
+    invocation["deadline"] = None
+    if remaining_ms is not None:
+        invocation["deadline"] = time.time() + remaining_ms() / 1000 - BEDROCK_DEADLINE_MARGIN_SECONDS
+
+
+def call_bedrock(call, fn, model_id=None):
+    """Run fn() within the shared Bedrock quota, backing off on throttles.
+
+    Every attempt first takes capacity from the model's limiter (when
+    configured); throttling errors are retried with jittered exponential
+    backoff. No wait runs past the invocation's deadline: the call fails
+    instead. Returns (response, reservation); hand the reservation to
+    settle_usage() once the call's token usage is known. Attempts that
+    failed have their reservations refunded here.
+    """
+    model_id = model_id or MODEL_ID
+    limiter = bedrock_limiter(model_id)
+    deadline = invocation["deadline"]
+    stats = {"throttles": 0, "backoff_ms": 0, "wait_ms": 0, "denied": 0, "deadline_exceeded": 0}
+    reservations = []
+
+    def attempt():
+        if limiter is None:
+            return fn()
+        try:
+            reservation = limiter.acquire(BEDROCK_TOKEN_ESTIMATE, deadline)
+        except ratelimit.DeadlineExceeded:
+            stats["deadline_exceeded"] += 1
+            raise
+        stats["wait_ms"] += reservation["wait_ms"]
+        stats["denied"] += reservation["denied"]
+        try:
+            response = fn()
+        except Exception:
+            # A rejected call used no tokens
+            limiter.settle(reservation, 0)
+            raise
+        reservations.append(reservation)
+        return response
+
+    try:
+        response = ratelimit.retry_throttled(
+            attempt,
+            stats,
+            max_attempts=BEDROCK_MAX_ATTEMPTS,
+            base_delay=BEDROCK_BACKOFF_BASE_SECONDS,
+            max_delay=BEDROCK_BACKOFF_MAX_SECONDS,
+            deadline=deadline,
+        )
+    finally:
+        metrics.emit(
+            "BedrockThrottling",
+            {
+                "Throttles": stats["throttles"],
+                "BackoffMs": stats["backoff_ms"],
+                "LimiterWaitMs": round(stats["wait_ms"], 2),
+                "LimiterDenied": stats["denied"],
+                "DeadlineExceeded": stats["deadline_exceeded"],
+            },
+            dimensions={"ModelId": model_id, "Call": call},
+        )
+    return response, reservations[-1] if reservations else None
+
+
+def settle_usage(reservation, usage, model_id=None):
+    limiter = bedrock_limiter(model_id or MODEL_ID)
+    if limiter is not None and usage:
+        used = usage.get("inputTokens", 0) + usage.get("outputTokens", 0)
+        limiter.settle(reservation, used)
+
+
+def invoice_messages(document_bytes):
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "document": {
+                        "format": "pdf",
+                        "name": "invoice",
+                        "source": {
+                            "bytes": document_bytes,
+                        },
+                    },
+                },
+                {"text": prompt},
+            ],
+        },
+    ]
+
+
+def supports_prompt_cache(model_id):
+    # Ignore cross-region inference prefixes such as "us."
+    prefix, _, rest = model_id.partition(".")
+    base = rest if prefix in ("us", "eu", "apac") else model_id
+    return base.startswith(PROMPT_CACHE_MODELS)
+
+
+def system_blocks(model_id=None):
+    """The static system prompt, followed by a cache point where supported."""
+    blocks = [{"text": SYSTEM_PROMPT}]
+    if PROMPT_CACHING and supports_prompt_cache(model_id or MODEL_ID):
+        blocks.append({"cachePoint": {"type": "default"}})
+    return blocks
+
+
+def record_usage(call, usage, latency_ms, model_id=None):
+    """Emit token counts and latency for one Bedrock call.
+
+    usage is None when a stream was abandoned before its metadata arrived,
+    in which case only the latency is recorded.
+    """
+    values = {}
+    if usage is not None:
+        values = {
+            "InputTokens": usage.get("inputTokens", 0),
+            "OutputTokens": usage.get("outputTokens", 0),
+            "CacheReadInputTokens": usage.get("cacheReadInputTokens", 0),
+            "CacheWriteInputTokens": usage.get("cacheWriteInputTokens", 0),
+        }
+    values["latency_ms"] = latency_ms
+    return metrics.emit(
+        "BedrockUsage",
+        values,
+        dimensions={"ModelId": model_id or MODEL_ID, "Call": call},
+        promptVariant=PROMPT_VARIANT,
+    )
+
+
+def converse(bedrock_client, call, messages, model_id=None, **kwargs):
+    """Call Converse with the shared system prompt and meter the call."""
+    model_id = model_id or MODEL_ID
+    started = time.perf_counter()
+    response, reservation = call_bedrock(
+        call,
+        lambda: bedrock_client.converse(
+            modelId=model_id,
+            messages=messages,
+            system=system_blocks(model_id),
+            **kwargs,
+        ),
+        model_id,
+    )
+    latency_ms = response.get("metrics", {}).get("latencyMs")
+    if latency_ms is None:
+        latency_ms = round((time.perf_counter() - started) * 1000, 2)
+    record_usage(call, response.get("usage") or {}, latency_ms, model_id)
+    settle_usage(reservation, response.get("usage"), model_id)
+    return response
+
+
+def extract_invoice(bedrock_client, document_bytes, model_id=None):
+    """Run the Bedrock extraction and return the raw model output text."""
+    response = converse(
+        bedrock_client, "extract", invoice_messages(document_bytes), model_id
+    )
+    return response["output"]["message"]["content"][0]["text"]
+
+
+class MalformedOutput(ValueError):
+    """The model output cannot become a valid JSON object.
+
+    fields holds whatever members were parsed before the output went wrong.
+    """
+
+    def __init__(self, message, fields=None):
+        super().__init__(message)
+        self.fields = fields or {}
+
+
+class IncrementalJSONParser:
+    """Parse a streamed JSON object, yielding top-level members as they close.
+
+    Tolerates a leading markdown fence (```json). Raises MalformedOutput as
+    soon as the text can no longer be a JSON object, rather than after the
+    whole generation has arrived.
+    """
+
+    _CLOSERS = {"}": "{", "]": "["}
+
+    def __init__(self):
+        self.fields = {}
+        self.done = False
+        self._buf = []
+        self._started = False
+        self._prefix = ""
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text):
+        """Consume a chunk of text and return the members completed by it."""
+        completed = []
+        for char in text:
+            if self.done:
+                break
+            if not self._started:
+                self._skip_prefix(char)
+                continue
+            if self._in_string:
+                self._buf.append(char)
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._stack.append(char)
+            elif char in "}]":
+                if not self._stack or self._stack[-1] != self._CLOSERS[char]:
+                    raise MalformedOutput(f"unbalanced {char!r}")
+                if len(self._stack) == 1:
+                    completed.extend(self._close_member())
+                    self._stack.pop()
+                    self.done = True
+                    continue
+                self._stack.pop()
+            elif char == "," and len(self._stack) == 1:
+                completed.extend(self._close_member())
+                continue
+            self._buf.append(char)
+        return completed
+
+    def _skip_prefix(self, char):
+        if char == "{":
+            self._started = True
+            self._stack.append("{")
+            return
+        self._prefix += char
+        text = self._prefix.lstrip().lower()
+        if "```json".startswith(text):
+            return
+        for fence in ("```json", "```"):
+            if text.startswith(fence) and not text[len(fence) :].strip():
+                return
+        raise MalformedOutput(f"output does not start with a JSON object: {text[:40]!r}")
+
+    def _close_member(self):
+        member = "".join(self._buf).strip()
+        self._buf = []
+        if not member:
+            return []
+        try:
+            parsed = json.loads("{" + member + "}")
+        except json.JSONDecodeError as e:
+            raise MalformedOutput(f"invalid member {member[:40]!r}: {e}")
+        self.fields.update(parsed)
+        return list(parsed.items())
+
+
+def extract_invoice_streaming(bedrock_client, document_bytes, timings=None, model_id=None):
+    """Stream the Bedrock extraction and return the parsed invoice fields.
+
+    Stops reading as soon as every required field has arrived, and raises
+    MalformedOutput early when the output goes wrong.
+    """
+    model_id = model_id or MODEL_ID
+    started = time.perf_counter()
+    response, reservation = call_bedrock(
+        "stream",
+        lambda: bedrock_client.converse_stream(
+            modelId=model_id,
+            messages=invoice_messages(document_bytes),
+            system=system_blocks(model_id),
+        ),
+        model_id,
+    )
+    stream = response["stream"]
+    parser = IncrementalJSONParser()
+    usage = None
+    try:
+        for event in stream:
+            if "contentBlockDelta" in event:
+                try:
+                    parser.feed(event["contentBlockDelta"]["delta"].get("text", ""))
+                except MalformedOutput as e:
+                    raise MalformedOutput(str(e), dict(parser.fields))
+                if parser.fields and timings is not None and "first_field_ms" not in timings:
+                    timings["first_field_ms"] = round((time.perf_counter() - started) * 1000, 2)
+                if REQUIRED_FIELDS <= parser.fields.keys():
+                    break
+            elif "metadata" in event:
+                usage = event["metadata"].get("usage")
+                break
+            else:
+                for key, value in event.items():
+                    if key.endswith("Exception"):
+                        # Raised as Converse raises them, so a throttlingException
+                        # is a ThrottlingException to the callers
+                        raise ClientError(
+                            {"Error": {"Code": key[0].upper() + key[1:], "Message": value.get("message", "")}},
+                            "ConverseStream",
+                        )
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+        record_usage(
+            "stream", usage, round((time.perf_counter() - started) * 1000, 2), model_id
+        )
+        settle_usage(reservation, usage, model_id)
+    if not parser.fields and not parser.done:
+        raise MalformedOutput("stream ended before a JSON object was produced")
+    return parser.fields
+
+
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+# Amounts safe to read without asking the model: an optional currency code or
+# symbol, then digits with comma thousands separators and a decimal point.
+# Anything else ("1.200,50", "3 x 4") is sent back for repair.
+PLAIN_AMOUNT = re.compile(
+    r"^\s*(?:[A-Z]{3}|Rs\.?|₹|\$)?\s*(-?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?)\s*$"
+)
+# Unambiguous layouts that can be normalised to ISO dates without asking the model
+DATE_FORMATS = ("%Y/%m/%d", "%d %B %Y", "%d %b %Y", "%B %d, %Y", "%b %d, %Y", "%d-%b-%Y")
+
+JSON_TYPES = {
+    "string": lambda v: isinstance(v, str),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "null": lambda v: v is None,
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+}
+
+
+def compile_validator(schema):
+    """Compile the JSON Schema subset used by INVOICE_SCHEMA.
+
+    Supports type, format: date, properties, required and items. Returns a
+    function mapping a value to a list of error messages.
+    """
+    types = schema.get("type", [])
+    types = [types] if isinstance(types, str) else types
+    type_checks = [JSON_TYPES[t] for t in types]
+    is_date = schema.get("format") == "date"
+    properties = {
+        name: compile_validator(sub) for name, sub in schema.get("properties", {}).items()
+    }
+    required = schema.get("required", [])
+    items = compile_validator(schema["items"]) if "items" in schema else None
+
+    def validate(value):
+        if type_checks and not any(check(value) for check in type_checks):
+            return [f"expected {' or '.join(types)}"]
+        if is_date and isinstance(value, str) and not ISO_DATE.match(value):
+            return ["expected a YYYY-MM-DD date"]
+        errors = []
+        if isinstance(value, dict):
+            errors += [f"{name}: missing" for name in required if name not in value]
+            for name, validator in properties.items():
+                if name in value:
+                    errors += [f"{name}: {e}" for e in validator(value[name])]
+        if isinstance(value, list) and items is not None:
+            for i, item in enumerate(value):
+                errors += [f"[{i}].{e}" for e in items(item)]
+        return errors
+
+    return validate
+
+
+FIELD_VALIDATORS = {
+    name: compile_validator(schema) for name, schema in INVOICE_SCHEMA["properties"].items()
+}
+
+
+def invalid_fields(fields):
+    """Map each missing or schema-violating top-level field to its problem."""
+    problems = {}
+    for name in INVOICE_SCHEMA["required"]:
+        if name not in fields:
+            problems[name] = "missing"
+    for name, validate in FIELD_VALIDATORS.items():
+        if name in fields:
+            errors = validate(fields[name])
+            if errors:
+                problems[name] = "; ".join(errors)
+    return problems
+
+
+def coerce_value(value, schema):
+    """Fix values the model got trivially wrong, e.g. "1,200.50" for a number."""
+    types = schema.get("type", [])
+    types = [types] if isinstance(types, str) else types
+    if "number" in types and isinstance(value, str):
+        match = PLAIN_AMOUNT.match(value)
+        if match is None:
+            return value
+        cleaned = match.group(1).replace(",", "")
+        return float(cleaned) if "." in cleaned else int(cleaned)
+    if schema.get("format") == "date" and isinstance(value, str) and not ISO_DATE.match(value):
+        for date_format in DATE_FORMATS:
+            try:
+                return datetime.strptime(value.strip(), date_format).date().isoformat()
+            except ValueError:
+                continue
+        return value
+    if isinstance(value, list) and "items" in schema:
+        return [coerce_value(item, schema["items"]) for item in value]
+    if isinstance(value, dict) and "properties" in schema:
+        return {
+            k: coerce_value(v, schema["properties"][k]) if k in schema["properties"] else v
+            for k, v in value.items()
+        }
+    return value
+
+
+def coerce_fields(fields):
+    for name, schema in INVOICE_SCHEMA["properties"].items():
+        if name in fields:
+            fields[name] = coerce_value(fields[name], schema)
+    return fields
+
+
+def repair_json_syntax(text):
+    """Best-effort local fix for damaged JSON output.
+
+    Drops any prose or fences around the object, trailing commas, and - if
+    the output was cut off - the last incomplete member, so only that field
+    has to be asked for again.
+    """
+    start = text.find("{")
+    if start == -1:
+        raise MalformedOutput("no JSON object in output")
+    depth = 0
+    in_string = escape = False
+    boundary = start + 1
+    end = None
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                end = i + 1
+                break
+        elif char == "," and depth == 1:
+            boundary = i
+    body = text[start:end] if end is not None else text[start:boundary] + "}"
+    return re.sub(r",\s*([}\]])", r"\1", body)
+
+
+def parse_output(output):
+    """Parse model output, returning (fields, repaired_locally)."""
+    cleaned_output = output.strip("```").strip("json").strip()
+    try:
+        fields = json.loads(cleaned_output)
+        if isinstance(fields, dict):
+            return fields, False
+    except json.JSONDecodeError as e:
+        print(f"JSON decoding error: {e}")
+    try:
+        fields = json.loads(repair_json_syntax(output))
+        if isinstance(fields, dict):
+            return fields, True
+    except (json.JSONDecodeError, MalformedOutput) as e:
+        print(f"Local JSON repair failed: {e}")
+    return {}, False
+
+
+def request_repair(bedrock_client, document_bytes, previous_output, problems, model_id=None):
+    """Ask the model again for only the fields listed in problems."""
+    listing = "\n".join(f"    - {name}: {problem}" for name, problem in problems.items())
+    response = converse(
+        bedrock_client,
+        "repair",
+        invoice_messages(document_bytes)
+        + [
+            {"role": "assistant", "content": [{"text": previous_output.strip() or "{}"}]},
+            {"role": "user", "content": [{"text": repair_prompt.format(problems=listing)}]},
+        ],
+        model_id,
+        inferenceConfig={"maxTokens": REPAIR_MAX_TOKENS},
+    )
+    fields, _ = parse_output(response["output"]["message"]["content"][0]["text"])
+    return {name: value for name, value in fields.items() if name in problems}
+
+
+class RepairStats:
+    """Per-container counts of how each extraction's output was obtained."""
+
+    OUTCOMES = ("valid", "repaired_locally", "repaired_remote", "repair_failed")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys(self.OUTCOMES, 0)
+
+    def record(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+            total = sum(self.counts.values())
+            return {
+                **self.counts,
+                "failure_rate": round(self.counts["repair_failed"] / total, 4),
+                "repair_rate": round(
+                    (self.counts["repaired_locally"] + self.counts["repaired_remote"]) / total, 4
+                ),
+            }
+
+    def clear(self):
+        with self._lock:
+            self.counts = dict.fromkeys(self.OUTCOMES, 0)
+
+
+repair_stats = RepairStats()
+
+
+def parse_and_repair(bedrock_client, document_bytes, output, fields=None, model_id=None):
+    """Turn model output into schema-valid fields with as little re-work as possible.
+
+    Syntax damage and trivially wrong values are fixed locally; only fields
+    that are still missing or invalid are sent back to the model. Returns
+    (fields, problems) where problems lists anything left unresolved.
+    """
+    repaired_locally = False
+    if fields is None:
+        fields, repaired_locally = parse_output(output)
+    coerce_fields(fields)
+    problems = invalid_fields(fields)
+    if not problems:
+        outcome = "repaired_locally" if repaired_locally else "valid"
+    else:
+        if EXTRACTION_REPAIR:
+            try:
+                patch = coerce_fields(
+                    request_repair(bedrock_client, document_bytes, output, problems, model_id)
+                )
+                fields.update(patch)
+                problems = invalid_fields(fields)
+            except Exception as e:
+                print(f"Extraction repair request failed: {e}")
+        outcome = "repair_failed" if problems else "repaired_remote"
+    metrics.emit(
+        "ExtractionRepair",
+        {
+            "Repaired": int(outcome in ("repaired_locally", "repaired_remote")),
+            "RepairFailed": int(outcome == "repair_failed"),
+        },
+        outcome=outcome,
+        problems=sorted(problems),
+        **repair_stats.record(outcome),
+    )
+    return fields, problems
+
+
+# Fields an answer must have to be worth keeping without a second opinion
+ROUTING_KEY_FIELDS = (
+    "InvoiceNumber",
+    "InvoiceDate",
+    "Currency",
+    "TotalAmount",
+    "VendorName",
+    "LineItems",
+)
+IFSC_PATTERN = re.compile(r"^[A-Z]{4}0[A-Z0-9]{6}$")
+
+
+def routing_number_valid(number):
+    """ABA routing number: nine digits with a weighted checksum of 0 mod 10."""
+    if not re.fullmatch(r"\d{9}", number):
+        return False
+    digits = [int(d) for d in number]
+    checksum = 3 * sum(digits[0::3]) + 7 * sum(digits[1::3]) + sum(digits[2::3])
+    return checksum % 10 == 0
+
+
+def compact(value):
+    return re.sub(r"[\s-]+", "", str(value)).upper()
+
+
+def matches_vendor_profile(fields, profile):
+    """Whether the answer agrees with any of the vendor's trusted records.
+
+    Only fields present on both sides are compared. A mismatch is not a
+    verdict (verify decides that); it means the read is worth a second one.
+    """
+    for record in profile:
+        agrees = True
+        for name in ("VendorBankAccount", "VendorIFSCCode", "VendorBankRoutingNumber"):
+            if fields.get(name) and record.get(name):
+                agrees = agrees and compact(fields[name]) == compact(record[name])
+        if fields.get("VendorName") and record.get("VendorName"):
+            agrees = agrees and normalize_text(fields["VendorName"]) == normalize_text(
+                record["VendorName"]
+            )
+        if agrees:
+            return True
+    return False
+
+
+def score_extraction(fields, problems, profile=None):
+    """Score an answer for model routing. Returns (confidence, failed checks).
+
+    Each applicable check scores 1 or 0, except completeness which is the
+    share of ROUTING_KEY_FIELDS present; confidence is the weakest score, so
+    a mostly-empty answer cannot be carried by its passing checks. Any
+    failed check escalates regardless of confidence.
+    """
+    present = [name for name in ROUTING_KEY_FIELDS if fields.get(name) not in (None, "", [])]
+    checks = {
+        "schema": not problems,
+        "completeness": len(present) / len(ROUTING_KEY_FIELDS),
+        "line_items": line_items_add_up(fields),
+    }
+    if fields.get("VendorIFSCCode"):
+        checks["ifsc"] = bool(IFSC_PATTERN.match(compact(fields["VendorIFSCCode"])))
+    if fields.get("VendorBankRoutingNumber"):
+        checks["routing_number"] = routing_number_valid(compact(fields["VendorBankRoutingNumber"]))
+    if profile:
+        checks["vendor_profile"] = matches_vendor_profile(fields, profile)
+    confidence = round(min(float(value) for value in checks.values()), 4)
+    failed = sorted(name for name, value in checks.items() if value is False)
+    return confidence, failed
+
+
+def load_vendor_profile(vendor_email):
+    response = aws.table(TRUSTED_VENDORS_TABLE).query(
+        IndexName="VendorEmailIndex",
+        KeyConditionExpression=Key("VendorEmail").eq(vendor_email),
+    )
+    return response.get("Items", [])
+
+
+def vendor_profile(vendor_email):
+    """The vendor's trusted records (possibly empty), or None when unknown.
+
+    Cached per container as verify caches them, so a change through the
+    data API reaches routing within VendorCacheVersionCheckSeconds.
+    """
+    if not TRUSTED_VENDORS_TABLE:
+        return None
+    try:
+        profile, _ = vendor_cache.get(vendor_email, lambda: load_vendor_profile(vendor_email))
+    except Exception as e:
+        print(f"Vendor profile lookup failed: {e}")
+        return None
+    return profile
+
+
+vendor_cache = vendorcache.VendorCache(
+    ttl_seconds=VENDOR_PROFILE_CACHE_SECONDS,
+    version_table=CACHE_VERSIONS_TABLE,
+    version_check_seconds=VENDOR_CACHE_VERSION_CHECK_SECONDS,
+)
+
+
+def extract_with_model(bedrock_client, document_bytes, model_id, timings):
+    """One model's answer as (raw output, fields parsed while streaming or None)."""
+    if not EXTRACTION_STREAMING:
+        return extract_invoice(bedrock_client, document_bytes, model_id), None
+    try:
+        fields = extract_invoice_streaming(bedrock_client, document_bytes, timings, model_id)
+    except MalformedOutput as e:
+        print(f"JSON decoding error: {e}")
+        fields = e.fields
+    return json.dumps(fields), fields
+
+
+def run_extraction(bedrock_client, document_bytes, timings, vendor_email=None):
+    """Extract one document with Bedrock and return (fields, problems).
+
+    Walks MODEL_TIERS cheapest first, stopping at the first answer that
+    score_extraction accepts. Only the last tier asks the model to repair
+    what is still invalid; earlier tiers escalate instead.
+    """
+    document_bytes, stats = timed(timings, "preprocess_ms", preprocess_document, document_bytes)
+    metrics.emit("DocumentPreprocess", stats)
+    profile = None
+    if len(MODEL_TIERS) > 1 and vendor_email:
+        profile = vendor_profile(vendor_email)
+    decisions = []
+    extract_ms = 0
+    try:
+        for tier, model_id in enumerate(MODEL_TIERS):
+            final = tier == len(MODEL_TIERS) - 1
+            started = time.perf_counter()
+            try:
+                output, fields = extract_with_model(bedrock_client, document_bytes, model_id, timings)
+            except Exception as e:
+                if final:
+                    raise
+                print(f"Extraction with {model_id} failed, escalating: {e}")
+                failure = e
+            else:
+                failure = None
+            finally:
+                latency_ms = round((time.perf_counter() - started) * 1000, 2)
+                extract_ms += latency_ms
+            if failure is not None:
+                decisions.append({"model": model_id, "latency_ms": latency_ms, "error": str(failure)})
+                continue
+            if final:
+                fields, problems = timed(
+                    timings,
+                    "repair_ms",
+                    parse_and_repair,
+                    bedrock_client,
+                    document_bytes,
+                    output,
+                    fields,
+                    model_id,
+                )
+            else:
+                if fields is None:
+                    fields, _ = parse_output(output)
+                coerce_fields(fields)
+                problems = invalid_fields(fields)
+            if len(MODEL_TIERS) == 1:
+                break
+            confidence, failed = score_extraction(fields, problems, profile)
+            accepted = final or (not failed and confidence >= ROUTING_MIN_CONFIDENCE)
+            decisions.append(
+                {
+                    "model": model_id,
+                    "latency_ms": latency_ms,
+                    "confidence": confidence,
+                    "failed": failed,
+                    "accepted": accepted,
+                }
+            )
+            metrics.emit(
+                "ModelTier",
+                {"latency_ms": latency_ms, "Confidence": confidence, "Accepted": int(accepted)},
+                dimensions={"ModelId": model_id, "Tier": str(tier)},
+                failed=failed,
+            )
+            if accepted:
+                break
+    finally:
+        timings["extract_ms"] = round(extract_ms, 2)
+    if len(MODEL_TIERS) > 1:
+        metrics.emit(
+            "ModelRouting",
+            {"Escalations": len(decisions) - 1, "routing_ms": timings["extract_ms"]},
+            dimensions={"ModelId": decisions[-1]["model"]},
+            decisions=decisions,
+            vendorProfile=bool(profile),
+        )
+    return fields, problems
+
+
+# The fraud checks compare these, so a template must always read them from
+# the document and never fill them in from an earlier invoice.
+BANK_FIELDS = ("VendorBankAccount", "VendorIFSCCode", "VendorBankRoutingNumber")
+LINE_ITEM_COLUMNS = ("Quantity", "UnitPrice", "Amount")
+NUMBER_PATTERN = r"-?\d[\d,]*(?:\.\d+)?"
+TEMPLATE_DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%d/%m/%Y",
+    "%m/%d/%Y",
+    "%d-%m-%Y",
+    "%d.%m.%Y",
+    "%Y/%m/%d",
+    "%B %d, %Y",
+    "%b %d, %Y",
+    "%d %B %Y",
+    "%d %b %Y",
+)
+
+
+def pdf_text(document_bytes):
+    """Return the PDF's text layer, or None for scanned or unreadable PDFs."""
+    if PdfReader is None:
+        return None
+    try:
+        reader = PdfReader(BufferReader(document_bytes))
+        text = "\n".join(
+            page.extract_text() or "" for page in reader.pages[:TEMPLATE_MAX_PAGES]
+        )
+    except Exception as e:
+        print(f"PDF text extraction failed: {e}")
+        return None
+    return text if len(text.strip()) >= 50 else None
+
+
+def normalize_text(text):
+    return re.sub(r"[\s,]+", " ", text).strip().lower()
+
+
+def parse_number(token):
+    cleaned = token.replace(",", "")
+    return float(cleaned) if "." in cleaned else int(cleaned)
+
+
+def same_value(a, b):
+    if JSON_TYPES["number"](a) and JSON_TYPES["number"](b):
+        return abs(a - b) < 0.005
+    return a == b
+
+
+def label_before(line, index):
+    """The field label to the left of a value, e.g. "Invoice No:"."""
+    prefix = line[:index].rstrip()
+    # Columns in extracted text are separated by runs of spaces
+    label = re.split(r"\s{2,}", prefix)[-1].strip() if prefix else ""
+    return label if re.search(r"[A-Za-z]", label) else ""
+
+
+def learn_field(lines, name, value, schema):
+    """Learn how to find one field's value in a vendor's text layout."""
+    if value is None:
+        # Nothing in the text says where the field would be; a rule reporting
+        # null would hide it on every later invoice that has it
+        return None
+    types = schema.get("type", [])
+    candidates = []  # (line number, start, end, type, date format)
+    for line_no, line in enumerate(lines):
+        if "number" in types and JSON_TYPES["number"](value):
+            for match in re.finditer(NUMBER_PATTERN, line):
+                if same_value(parse_number(match.group()), value):
+                    candidates.append((line_no, match.start(), match.end(), "number", None))
+        elif schema.get("format") == "date":
+            try:
+                date = datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                break
+            for date_format in TEMPLATE_DATE_FORMATS:
+                index = line.find(date.strftime(date_format))
+                if index != -1:
+                    end = index + len(date.strftime(date_format))
+                    candidates.append((line_no, index, end, "date", date_format))
+                    break
+        elif isinstance(value, str) and value.strip():
+            index = line.find(value.strip())
+            if index != -1:
+                candidates.append((line_no, index, index + len(value.strip()), "string", None))
+
+    for line_no, start, end, value_type, date_format in candidates:
+        line = lines[line_no]
+        label = label_before(line, start)
+        if label:
+            # Anchored at a word start so "Total:" never matches "Subtotal:"
+            pattern = r"(?:^|(?<=\s))" + re.escape(label) + r"[ \t]*"
+        elif not line[:start].strip() and line_no > 0 and re.search(r"[A-Za-z]", lines[line_no - 1]):
+            # Value on its own line, under its label
+            pattern = re.escape(lines[line_no - 1].strip()) + r"[ \t]*\n[ \t]*"
+        else:
+            continue
+        if value_type == "number":
+            pattern += f"({NUMBER_PATTERN})"
+        else:
+            following = line[end:].split()
+            pattern += r"(.+?)" + (
+                r"[ \t]+" + re.escape(following[0]) if following else r"[ \t]*$"
+            )
+        return {"kind": "pattern", "pattern": pattern, "type": value_type, "format": date_format}
+
+    if isinstance(value, str) and "format" not in schema and name not in BANK_FIELDS:
+        # Vendor/customer details usually never change; trusted only when the
+        # same text is found in the document being processed.
+        return {"kind": "constant", "value": value}
+    return None
+
+
+def line_item_pattern(columns):
+    return re.compile(
+        r"^(.*?\S)" + rf"\s+({NUMBER_PATTERN})" * len(columns) + r"\s*$"
+    )
+
+
+def learn_line_items(lines, items):
+    if not items:
+        return {"kind": "empty"}
+    description = (items[0].get("Description") or "").strip()
+    for line_no, line in enumerate(lines):
+        if not description or not line.strip().startswith(description) or line_no == 0:
+            continue
+        numbers = re.findall(NUMBER_PATTERN, line[line.find(description) + len(description) :])
+        columns = []
+        for token in numbers:
+            column = next(
+                (
+                    c
+                    for c in LINE_ITEM_COLUMNS
+                    if c not in columns and same_value(parse_number(token), items[0].get(c))
+                ),
+                None,
+            )
+            columns.append(column)
+        if "Amount" not in columns:
+            continue
+        header = lines[line_no - 1].strip()
+        if re.search(r"[A-Za-z]", header):
+            return {"kind": "rows", "header": header, "columns": columns}
+    return None
+
+
+def apply_line_items(rule, lines):
+    stripped = [line.strip() for line in lines]
+    if rule["header"] not in stripped:
+        return None
+    row = line_item_pattern(rule["columns"])
+    items = []
+    for line in stripped[stripped.index(rule["header"]) + 1 :]:
+        match = row.match(line)
+        if not match:
+            break
+        item = {"Description": match.group(1), "Quantity": None, "UnitPrice": None, "Amount": None}
+        for column, token in zip(rule["columns"], match.groups()[1:]):
+            if column:
+                item[column] = parse_number(token)
+        items.append(item)
+    return items or None
+
+
+def apply_field(rule, text, lines):
+    """Return (found, value) for one template rule applied to a document."""
+    kind = rule["kind"]
+    if kind == "null":
+        # Learned by earlier versions; the field is unknown, so Bedrock reads it
+        return False, None
+    if kind == "empty":
+        return True, []
+    if kind == "constant":
+        return normalize_text(rule["value"]) in normalize_text(text), rule["value"]
+    if kind == "rows":
+        items = apply_line_items(rule, lines)
+        return items is not None, items
+    match = re.search(rule["pattern"], text, re.MULTILINE)
+    if not match:
+        return False, None
+    raw = match.group(1).strip()
+    try:
+        if rule["type"] == "number":
+            return True, parse_number(raw)
+        if rule["type"] == "date":
+            return True, datetime.strptime(raw, rule["format"]).date().isoformat()
+    except ValueError:
+        return False, None
+    return True, raw
+
+
+def apply_template(template, text):
+    """Apply a vendor template; returns (fields, confidence)."""
+    lines = text.splitlines()
+    fields = {}
+    for name, rule in template.items():
+        found, value = apply_field(rule, text, lines)
+        if found:
+            fields[name] = value
+    return fields, len(fields) / max(len(INVOICE_SCHEMA["properties"]), 1)
+
+
+def line_items_add_up(fields):
+    """Whether line items sum to the total, with or without tax."""
+    amounts = [item.get("Amount") or 0 for item in fields.get("LineItems") or []]
+    total = fields.get("TotalAmount")
+    if not amounts or not JSON_TYPES["number"](total):
+        return True
+    subtotal = sum(amounts)
+    tolerance = max(0.01, abs(total) * 0.005)
+    tax = fields.get("TaxAmount") or 0
+    return abs(subtotal - total) <= tolerance or abs(subtotal + tax - total) <= tolerance
+
+
+def learn_template(text, fields):
+    """Build a template reproducing fields from text, or None if it cannot."""
+    lines = text.splitlines()
+    template = {}
+    for name, schema in INVOICE_SCHEMA["properties"].items():
+        if name == "LineItems":
+            rule = learn_line_items(lines, fields.get(name) or [])
+        else:
+            rule = learn_field(lines, name, fields.get(name), schema)
+        if rule is None:
+            return None
+        # Keep only rules that reproduce what the model read
+        found, value = apply_field(rule, text, lines)
+        if not found or not same_value(value, fields.get(name)):
+            return None
+        template[name] = rule
+    return template
+
+
+class TemplateStore:
+    """Per-vendor extraction templates.
+
+    Kept in memory for TEMPLATE_CACHE_SECONDS in front of the DynamoDB table
+    (when configured), so updates learned elsewhere are picked up quickly.
+    """
+
+    def __init__(self, table_name=None, cache_seconds=300):
+        self.table_name = table_name
+        self.cache_seconds = cache_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def client(self):
+        return aws.client("dynamodb") if self.table_name else None
+
+    def get(self, vendor_email):
+        with self._lock:
+            entry = self._entries.get(vendor_email)
+        if entry and time.time() - entry[0] < self.cache_seconds:
+            return entry[1]
+        template = entry[1] if entry else None
+        if self.client() is not None:
+            try:
+                item = self.client().get_item(
+                    TableName=self.table_name, Key={"VendorEmail": {"S": vendor_email}}
+                ).get("Item")
+                template = json.loads(item["template"]["S"]) if item else None
+            except Exception as e:
+                print(f"Template lookup failed: {e}")
+        with self._lock:
+            self._entries[vendor_email] = (time.time(), template)
+        return template
+
+    def put(self, vendor_email, template):
+        with self._lock:
+            self._entries[vendor_email] = (time.time(), template)
+        if self.client() is None:
+            return
+        try:
+            self.client().put_item(
+                TableName=self.table_name,
+                Item={
+                    "VendorEmail": {"S": vendor_email},
+                    "template": {"S": json.dumps(template)},
+                    "promptVersion": {"S": PROMPT_VERSION},
+                    "updatedAt": {"S": datetime.now().isoformat()},
+                },
+            )
+        except Exception as e:
+            print(f"Template write failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+template_store = TemplateStore(VENDOR_TEMPLATES_TABLE, TEMPLATE_CACHE_SECONDS)
+
+
+def template_extraction(vendor_email, text):
+    """Try the vendor's learned template; returns fields or None to use Bedrock."""
+    template = template_store.get(vendor_email)
+    if template is None:
+        outcome, confidence, fields = "no_template", 0.0, None
+    else:
+        fields, confidence = apply_template(template, text)
+        coerce_fields(fields)
+        if confidence < TEMPLATE_MIN_CONFIDENCE:
+            outcome = "low_confidence"
+        elif invalid_fields(fields):
+            outcome = "invalid"
+        elif not line_items_add_up(fields):
+            outcome = "totals_mismatch"
+        else:
+            outcome = "hit"
+    metrics.emit(
+        "TemplateFastPath",
+        {"TemplateHit": int(outcome == "hit"), "Confidence": round(confidence, 3)},
+        outcome=outcome,
+    )
+    return fields if outcome == "hit" else None
+
+
+INVOICE_PAGE_KEYWORDS = (
+    "invoice",
+    "total",
+    "amount",
+    "tax",
+    "gst",
+    "due",
+    "bill to",
+    "qty",
+    "quantity",
+    "unit price",
+    "account",
+    "ifsc",
+    "routing",
+    "bank",
+)
+
+
+def select_pages(pages, max_pages):
+    """Indexes of the pages most likely to carry invoice data, in order.
+
+    Pages are ranked by invoice keywords in their text layer. Pages without
+    text (scans) rank by position, and the first page is always kept.
+    """
+    scores = []
+    for index, page in enumerate(pages):
+        try:
+            text = (page.extract_text() or "").lower()
+        except Exception:
+            text = ""
+        scores.append((sum(text.count(k) for k in INVOICE_PAGE_KEYWORDS), -index))
+    ranked = sorted(range(1, len(pages)), key=lambda i: scores[i], reverse=True)
+    return sorted([0] + ranked[: max_pages - 1])
+
+
+def downsample_images(page):
+    for image in page.images:
+        picture = image.image
+        if max(picture.size) <= PREPROCESS_IMAGE_MAX_SIDE:
+            continue
+        picture = picture.copy()
+        picture.thumbnail((PREPROCESS_IMAGE_MAX_SIDE, PREPROCESS_IMAGE_MAX_SIDE))
+        if picture.mode not in ("RGB", "L"):
+            picture = picture.convert("RGB")
+        image.replace(picture, quality=PREPROCESS_IMAGE_QUALITY)
+
+
+def preprocess_document(document_bytes):
+    """Shrink a PDF before it is sent to Bedrock.
+
+    Documents within the page and size budgets are returned untouched.
+    Otherwise only the likeliest invoice pages are kept, large images are
+    downsampled and unused objects dropped. The original is what gets
+    uploaded to S3. Returns (bytes to send, stats).
+    """
+    stats = {"OriginalBytes": len(document_bytes), "SentBytes": len(document_bytes)}
+    if not PREPROCESS_DOCUMENTS or PdfReader is None:
+        return document_bytes, stats
+    try:
+        reader = PdfReader(BufferReader(document_bytes))
+        stats["OriginalPages"] = stats["SentPages"] = len(reader.pages)
+        if len(reader.pages) <= PREPROCESS_MAX_PAGES and len(document_bytes) <= PREPROCESS_MAX_BYTES:
+            return document_bytes, stats
+
+        writer = PdfWriter()
+        for index in select_pages(reader.pages, PREPROCESS_MAX_PAGES):
+            writer.add_page(reader.pages[index])
+        for page in writer.pages:
+            if Image is not None:
+                downsample_images(page)
+            page.compress_content_streams()
+        writer.compress_identical_objects(remove_orphans=True)
+        output = BytesIO()
+        writer.write(output)
+    except Exception as e:
+        print(f"PDF pre-processing failed, sending original: {e}")
+        return document_bytes, stats
+
+    processed = output.getvalue()
+    if len(processed) >= len(document_bytes):
+        return document_bytes, stats
+    stats.update(SentBytes=len(processed), SentPages=len(writer.pages))
+    return processed, stats
+
+
+class AttachmentError(Exception):
+    """Processing of a single attachment failed; message is user-facing."""
+
+
+def is_pdf_attachment(attachment):
+    content_type = (attachment.get("ContentType") or "").lower()
+    name = (attachment.get("Name") or "").lower()
+    return content_type == "application/pdf" or name.endswith(".pdf")
+
+
+class BufferReader(RawIOBase):
+    """Seekable, read-only file object over a bytes-like buffer, without copying it."""
+
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast("B")
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, target):
+        count = max(0, min(len(target), len(self.view) - self.position))
+        target[:count] = self.view[self.position : self.position + count]
+        self.position += count
+        return count
+
+    def seek(self, offset, whence=0):
+        base = {0: 0, 1: self.position, 2: len(self.view)}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+def decoded_size(content):
+    """Exact size of the decoded base64 content, without decoding it."""
+    whitespace = sum(content.count(c) for c in " \t\r\n")
+    tail = "".join(content[-16:].split())
+    padding = len(tail) - len(tail.rstrip("="))
+    return (len(content) - whitespace) // 4 * 3 - padding
+
+
+def decode_attachment(content, upload=None):
+    """Decode base64 attachment content in chunks, hashing as it goes.
+
+    The document is decoded into a single buffer allocated up front, so no
+    full-size intermediate copies are made. When upload (a MultipartUpload)
+    is given it is fed each decoded stretch, so parts go to S3 while the
+    rest of the attachment is still decoding. Returns (document, sha256
+    hex digest).
+    """
+    digest = hashlib.sha256()
+    document = bytearray(decoded_size(content))
+    view = memoryview(document)
+    wrapped = any(c in content for c in " \t\r\n")
+    size = 0
+    carry = ""
+    for start in range(0, len(content), DECODE_CHUNK_CHARS):
+        chunk = content[start : start + DECODE_CHUNK_CHARS]
+        if wrapped:
+            chunk = carry + "".join(chunk.split())
+            usable = len(chunk) - len(chunk) % 4
+            chunk, carry = chunk[:usable], chunk[usable:]
+        decoded = binascii.a2b_base64(chunk)
+        if size + len(decoded) > len(document):
+            raise binascii.Error("Decoded attachment is larger than its encoded length allows")
+        view[size : size + len(decoded)] = decoded
+        digest.update(decoded)
+        size += len(decoded)
+        del chunk, decoded
+        if upload is not None:
+            upload.feed(view, size)
+    if carry:
+        raise binascii.Error("Incorrect padding")
+    if size != len(document):
+        # Only when the content held characters outside the base64 alphabet
+        document = document[:size]
+        view = memoryview(document)
+    if upload is not None:
+        upload.close(view, size)
+    return document, digest.hexdigest()
+
+
+def upload_args(sender_email):
+    return {
+        "ContentType": "application/pdf",
+        "ACL": "public-read",
+        "Metadata": {
+            "sender_email": sender_email,
+            "timestamp": datetime.now().isoformat(),
+        },
+    }
+
+
+def upload_document(s3, document_bytes, file_key, sender_email):
+    s3.upload_fileobj(
+        BufferReader(document_bytes),
+        BUCKET_NAME,
+        file_key,
+        ExtraArgs=upload_args(sender_email),
+    )
+
+
+class MultipartUpload:
+    """S3 multipart upload fed by decode_attachment as the attachment decodes.
+
+    Full parts are sent on upload_pool straight away. result() waits for the
+    parts and completes the upload; cancel() aborts it unless it completed.
+    Together they stand in for the upload future used for smaller attachments.
+    """
+
+    def __init__(self, s3, file_key, sender_email, upload_pool, timings):
+        self.s3 = s3
+        self.file_key = file_key
+        self.upload_pool = upload_pool
+        self.timings = timings
+        self.started = time.perf_counter()
+        self.upload_id = s3.create_multipart_upload(
+            Bucket=BUCKET_NAME, Key=file_key, **upload_args(sender_email)
+        )["UploadId"]
+        self.parts = []
+        self.offset = 0
+        self.completed = False
+
+    def upload_part(self, number, part):
+        response = self.s3.upload_part(
+            Bucket=BUCKET_NAME,
+            Key=self.file_key,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=BufferReader(part),
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def send(self, part):
+        self.parts.append(self.upload_pool.submit(self.upload_part, len(self.parts) + 1, part))
+
+    def feed(self, view, size):
+        """view[:size] is decoded; send every full part in it."""
+        while size - self.offset >= UPLOAD_PART_SIZE:
+            self.send(view[self.offset : self.offset + UPLOAD_PART_SIZE])
+            self.offset += UPLOAD_PART_SIZE
+
+    def close(self, view, size):
+        self.feed(view, size)
+        if size > self.offset or not self.parts:
+            self.send(view[self.offset : size])
+            self.offset = size
+
+    def result(self):
+        if self.completed:
+            return
+        try:
+            parts = [part.result() for part in self.parts]
+            self.s3.complete_multipart_upload(
+                Bucket=BUCKET_NAME,
+                Key=self.file_key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+            self.completed = True
+        except Exception:
+            self.cancel()
+            raise
+        finally:
+            self.timings["upload_ms"] = round((time.perf_counter() - self.started) * 1000, 2)
+
+    def cancel(self):
+        """Abort the upload once no part is in flight.
+
+        Returns False, like a finished future, once result() has completed
+        the upload: the object exists and has to be deleted instead.
+        """
+        if self.completed:
+            return False
+        for part in self.parts:
+            part.cancel()
+        for part in self.parts:
+            try:
+                part.result()
+            except Exception:
+                pass
+        try:
+            self.s3.abort_multipart_upload(
+                Bucket=BUCKET_NAME, Key=self.file_key, UploadId=self.upload_id
+            )
+        except Exception as e:
+            print(f"Failed to abort upload of s3://{BUCKET_NAME}/{self.file_key}: {e}")
+        return True
+
+
+def discard_upload(s3, upload_future, file_key):
+    """Cancel a pending upload, or delete the object if it already landed."""
+    if upload_future.cancel():
+        return
+    try:
+        upload_future.result()
+    except Exception:
+        return
+    try:
+        s3.delete_object(Bucket=BUCKET_NAME, Key=file_key)
+    except Exception as e:
+        print(f"Failed to clean up s3://{BUCKET_NAME}/{file_key}: {e}")
+
+
+def timed(timings, stage, fn, *args):
+    """Call fn(*args), recording its wall-clock duration in timings[stage]."""
+    started = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        timings[stage] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def process_attachment(attachment, clients, sender_email, email_text, upload_pool, timings, invoice_id=None):
+    """Extract one PDF attachment and upload it to S3.
+
+    The upload does not depend on the model output, so it runs on
+    upload_pool while Bedrock extracts. Stage durations in milliseconds are
+    written to timings. Returns the InvoiceExtracted detail for the
+    attachment, or a claim check pointing at it when CLAIM_CHECK_EVENTS is
+    set. Raises AttachmentError when extraction or an upload fails; in
+    either case the PDF is not left behind in S3. invoice_id defaults to a
+    fresh id; the PDF is stored under it, so a retry overwrites its upload.
+    """
+    invoice_id = invoice_id or str(uuid.uuid4())
+    file_key = f"invoice-{invoice_id}.pdf"
+    # Drop the body's reference to the base64 text so it can be freed once decoded
+    content = attachment.pop("Content")
+    upload_future = None
+    if decoded_size(content) >= MULTIPART_UPLOAD_THRESHOLD:
+        upload_future = MultipartUpload(clients["s3"], file_key, sender_email, upload_pool, timings)
+    try:
+        document_bytes, digest = timed(
+            timings, "decode_ms", decode_attachment, content, upload_future
+        )
+    except Exception:
+        if upload_future is not None:
+            upload_future.cancel()
+        raise
+    del content
+    if upload_future is None:
+        upload_future = upload_pool.submit(
+            timed,
+            timings,
+            "upload_ms",
+            upload_document,
+            clients["s3"],
+            document_bytes,
+            file_key,
+            sender_email,
+        )
+
+    cache_key = extraction_cache_key(document_bytes, digest)
+    cached_extraction = extraction_cache.get(cache_key)
+    text = templated_extraction = None
+    if cached_extraction is None and TEMPLATE_FAST_PATH:
+        text = timed(timings, "text_ms", pdf_text, document_bytes)
+        if text:
+            templated_extraction = timed(
+                timings, "template_ms", template_extraction, sender_email, text
+            )
+
+    if cached_extraction is not None:
+        json_output = cached_extraction
+    elif templated_extraction is not None:
+        json_output = templated_extraction
+    else:
+        try:
+            json_output, problems = run_extraction(
+                clients["bedrock"], document_bytes, timings, sender_email
+            )
+        except Exception as e:
+            discard_upload(clients["s3"], upload_future, file_key)
+            raise AttachmentError(f"Error processing file with error: {e}")
+        if problems:
+            # Even the repair left fields missing or invalid; publishing what
+            # is there would send verify an empty or partial invoice
+            discard_upload(clients["s3"], upload_future, file_key)
+            raise AttachmentError(
+                f"Extraction failed validation: {', '.join(sorted(problems))}"
+            )
+        extraction_cache.put(cache_key, json_output)
+        if text:
+            template = learn_template(text, json_output)
+            if template is not None:
+                template_store.put(sender_email, template)
+    metrics.emit(
+        "ExtractionCache", {"CacheHit": int(cached_extraction is not None)}, **extraction_cache.stats
+    )
+
+    try:
+        upload_future.result()
+    except Exception as e:
+        print(e)
+        raise AttachmentError(f"Error uploading file to S3 with error: {e}")
+    file_url = f"https://{BUCKET_NAME}.s3.us-east-1.amazonaws.com/{file_key}"
+
+    # A fresh detail, so the cached extraction or template output is left as it was
+    invoice = model.Invoice.from_extracted(json_output)
+    invoice.invoice_id = invoice_id
+    invoice.vendor_email = sender_email
+    invoice.file_url = file_url
+    json_output = invoice.to_detail()
+    json_output["TextBody"] = email_text
+    if CLAIM_CHECK_EVENTS:
+        try:
+            json_output = timed(timings, "claim_check_ms", check_in_detail, clients["s3"], json_output)
+        except Exception as e:
+            discard_upload(clients["s3"], upload_future, file_key)
+            raise AttachmentError(f"Error storing extraction in S3 with error: {e}")
+    return json_output
+
+
+def check_in_detail(s3, detail):
+    """Store the full detail in S3 and return the event detail that points at it."""
+    key = f"{CLAIM_CHECK_PREFIX}{detail['InvoiceId']}.json"
+    event_detail = claimcheck.check_in(
+        s3, detail, BUCKET_NAME, key, compress=CLAIM_CHECK_COMPRESSION
+    )
+    metrics.emit(
+        "ClaimCheck",
+        {
+            "DetailBytes": len(json.dumps(detail)),
+            "StoredBytes": event_detail["ClaimCheck"]["Bytes"],
+            "EventBytes": len(json.dumps(event_detail)),
+        },
+    )
+    return event_detail
+
+
+def publish_invoices(eventbridge, details):
+    """Send InvoiceExtracted events in PutEvents batches.
+
+    Returns one error string (or None on success) per detail, in order.
+    """
+    errors = []
+    for start in range(0, len(details), PUT_EVENTS_BATCH_SIZE):
+        batch = details[start : start + PUT_EVENTS_BATCH_SIZE]
+        entries = [
+            {
+                "Source": "trustbill.extract",
+                "DetailType": "InvoiceExtracted",
+                "Detail": json.dumps(detail),
+                "Time": datetime.now(),
+            }
+            for detail in batch
+        ]
+        try:
+            response = eventbridge.put_events(Entries=entries)
+        except Exception as e:
+            errors.extend([f"Failed to send event to EventBridge: {e}"] * len(batch))
+            continue
+        results = response.get("Entries") or [{}] * len(batch)
+        for result in results:
+            if result.get("ErrorCode"):
+                errors.append(
+                    f"Failed to send event to EventBridge: "
+                    f"{result['ErrorCode']} {result.get('ErrorMessage', '')}".strip()
+                )
+            else:
+                errors.append(None)
+    return errors
+
+
+def validate_webhook(body):
+    """Return a 400 response for an unusable webhook body, or None."""
     if not body:
         return {
             "statusCode": 400,
@@ -125,10 +1917,25 @@ def lambda_handler(event, context):
             "statusCode": 400,
             "body": json.dumps({"message": "Missing required fields in request body"}),
         }
+    if not any(is_pdf_attachment(a) for a in body["Attachments"]):
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"message": "No PDF attachments in request body"}),
+        }
+    return None
+
+
+def job_invoice_id(tracking_id, index):
+    """InvoiceId of the index-th PDF of a queued job, the same on every redelivery."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"trustbill:ingest:{tracking_id}:{index}"))
 
-    s3 = boto3.client("s3")
-    eventbridge = boto3.client("events")
 
+def process_webhook(body, tracking_id=None):
+    """Extract and publish every PDF attachment of a validated webhook body.
+
+    Attachments of a queued job (tracking_id) get InvoiceIds derived from
+    the job, so verify recognizes a redelivered job's invoices as replays.
+    """
     regexbody = re.search(r"From:.*?<([^<>]+@[^<>]+)>", body["TextBody"])
     if regexbody:
         sender_email = regexbody.group(1)
@@ -136,89 +1943,204 @@ def lambda_handler(event, context):
         sender_email = body["From"]
 
     email_text = body["TextBody"]
-    document_bytes = base64.b64decode(body["Attachments"][0]["Content"])
-    file_key = f"invoice-{uuid.uuid4()}.pdf"
-    bedrock_client = boto3.client("bedrock-runtime", "us-east-1")
+    attachments = [a for a in body["Attachments"] if is_pdf_attachment(a)]
+
+    clients = {
+        "s3": aws.client("s3"),
+        "bedrock": aws.client("bedrock-runtime", "us-east-1"),
+    }
+    eventbridge = aws.client("events")
+
+    results = [
+        {"Name": attachment.get("Name"), "status": "failed", "timings": {}}
+        for attachment in attachments
+    ]
+    workers = max(1, min(MAX_ATTACHMENT_WORKERS, len(attachments)))
+    with ThreadPoolExecutor(max_workers=workers) as executor, ThreadPoolExecutor(
+        max_workers=workers
+    ) as upload_pool:
+        futures = [
+            executor.submit(
+                process_attachment,
+                attachment,
+                clients,
+                sender_email,
+                email_text,
+                upload_pool,
+                result["timings"],
+                job_invoice_id(tracking_id, index) if tracking_id else None,
+            )
+            for index, (attachment, result) in enumerate(zip(attachments, results))
+        ]
+        details = []
+        for result, future in zip(results, futures):
+            try:
+                detail = future.result()
+            except AttachmentError as e:
+                result["error"] = str(e)
+            except Exception as e:
+                result["error"] = f"Error processing file with error: {e}"
+            else:
+                result["InvoiceId"] = detail["InvoiceId"]
+                details.append((result, detail))
+
+    publish_timings = {}
+    errors = timed(
+        publish_timings,
+        "publish_ms",
+        publish_invoices,
+        eventbridge,
+        [detail for _, detail in details],
+    )
+    for (result, _), error in zip(details, errors):
+        result["timings"].update(publish_timings)
+        if error:
+            result["error"] = error
+        else:
+            result["status"] = "processed"
+    for result in results:
+        metrics.emit("ExtractStageTimings", result["timings"], Name=result["Name"])
+
+    failed = [result for result in results if result["status"] == "failed"]
+    if not failed:
+        status_code, message = 200, "file processed"
+    elif len(failed) == len(results):
+        status_code, message = 500, failed[0]["error"]
+    else:
+        status_code, message = 207, "some attachments failed"
+    return {
+        "statusCode": status_code,
+        "body": json.dumps({"message": message, "attachments": results}),
+    }
+
+
+def enqueue_webhook(raw_body):
+    """Persist the raw webhook payload, queue it for extraction and return 202."""
+    tracking_id = str(uuid.uuid4())
+    payload_key = f"{INGEST_PREFIX}{tracking_id}.json"
+    now = datetime.now()
     try:
-        response = bedrock_client.converse(
-            modelId=MODEL_ID,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "document": {
-                                "format": "pdf",
-                                "name": "invoice",
-                                "source": {
-                                    "bytes": document_bytes,
-                                },
-                            },
-                        },
-                        {"text": prompt},
-                    ],
-                },
-            ],
-            system=[{"text": system_prompt}],
+        aws.client("s3").put_object(
+            Bucket=BUCKET_NAME,
+            Key=payload_key,
+            Body=raw_body.encode(),
+            ContentType="application/json",
         )
-    except Exception as e:
-        return {
-            "statusCode": 500,
-            "body": json.dumps({"message": f"Error processing file with error: {e}"}),
-        }
-    output = response["output"]["message"]["content"][0]["text"]
-    cleaned_output = output.strip("```").strip("json").strip()
-    try:
-        s3.upload_fileobj(
-            BytesIO(document_bytes),
-            BUCKET_NAME,
-            file_key,
-            ExtraArgs={
-                "ContentType": "application/pdf",
-                "ACL": "public-read",
-                "Metadata": {
-                    "sender_email": sender_email,
-                    "timestamp": datetime.now().isoformat(),
-                },
-            },
+        aws.table(INGEST_JOBS_TABLE).put_item(
+            Item={
+                "trackingId": tracking_id,
+                "status": "queued",
+                "payloadKey": payload_key,
+                "createdAt": now.isoformat(),
+                "updatedAt": now.isoformat(),
+                "expiresAt": int(now.timestamp()) + INGEST_JOB_TTL_SECONDS,
+            }
+        )
+        aws.client("sqs").send_message(
+            QueueUrl=INGEST_QUEUE_URL,
+            MessageBody=json.dumps({"trackingId": tracking_id, "payloadKey": payload_key}),
         )
     except Exception as e:
-        print(e)
         return {
             "statusCode": 500,
-            "body": json.dumps(
-                {"message": f"Error uploading file to S3 with error: {e}"}
-            ),
+            "body": json.dumps({"message": f"Error queueing invoice with error: {e}"}),
         }
-    file_url = f"https://{BUCKET_NAME}.s3.us-east-1.amazonaws.com/{file_key}"
+    return {
+        "statusCode": 202,
+        "body": json.dumps(
+            {
+                "message": "invoice accepted",
+                "trackingId": tracking_id,
+                "statusPath": f"/webhook/jobs/{tracking_id}",
+            }
+        ),
+    }
 
-    try:
-        json_output = json.loads(cleaned_output)
-    except json.JSONDecodeError as e:
-        print(f"JSON decoding error: {e}")
-        json_output = {}
 
-    json_output["VendorEmail"] = sender_email
-    json_output["FileURL"] = file_url
-    json_output["InvoiceId"] = str(uuid.uuid4())
-    json_output["TextBody"] = email_text
-    try:
-        eventbridge_response = eventbridge.put_events(
-            Entries=[
-                {
-                    "Source": "trustbill.extract",
-                    "DetailType": "InvoiceExtracted",
-                    "Detail": json.dumps(json_output),
-                    "Time": datetime.now(),
-                }
-            ]
-        )
-    except Exception as e:
+def update_job(tracking_id, status, **attributes):
+    names = {"#status": "status", "#updatedAt": "updatedAt"}
+    values = {":status": status, ":updatedAt": datetime.now().isoformat()}
+    assignments = ["#status = :status", "#updatedAt = :updatedAt"]
+    for key, value in attributes.items():
+        names[f"#{key}"] = key
+        # DynamoDB rejects floats, so nested results go in as Decimals.
+        values[f":{key}"] = json.loads(json.dumps(value), parse_float=Decimal)
+        assignments.append(f"#{key} = :{key}")
+    aws.table(INGEST_JOBS_TABLE).update_item(
+        Key={"trackingId": tracking_id},
+        UpdateExpression="SET " + ", ".join(assignments),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
+    )
+
+
+def job_status(tracking_id):
+    """Handle GET /webhook/jobs/{trackingId}."""
+    item = aws.table(INGEST_JOBS_TABLE).get_item(Key={"trackingId": tracking_id}).get("Item")
+    if item is None:
         return {
-            "statusCode": 500,
-            "body": json.dumps(
-                {"message": "Failed to send event to EventBridge", "error": str(e)}
-            ),
+            "statusCode": 404,
+            "body": json.dumps({"message": f"Job {tracking_id} not found"}),
         }
+    item.pop("expiresAt", None)
+    return {"statusCode": 200, "body": json.dumps(item, default=json_number)}
+
 
-    return {"statusCode": 200, "body": "file processed"}
+def json_number(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return str(value)
+
+
+# Outcome of a processed webhook, by the status code process_webhook returns
+JOB_STATUS = {200: "completed", 207: "partially_completed", 400: "rejected"}
+
+
+def process_job(message):
+    """Run one queued webhook. Returns True when SQS should redeliver it."""
+    job = json.loads(message["body"])
+    tracking_id = job["trackingId"]
+    update_job(tracking_id, "processing")
+    payload = aws.client("s3").get_object(Bucket=BUCKET_NAME, Key=job["payloadKey"])
+    body = json.loads(payload["Body"].read() or "{}")
+    response = validate_webhook(body) or process_webhook(body, tracking_id)
+    result = json.loads(response["body"])
+    status = JOB_STATUS.get(response["statusCode"], "failed")
+    update_job(tracking_id, status, result=result)
+    # Only retry when nothing was published; a redelivered partial success
+    # would publish its invoices twice.
+    return status == "failed"
+
+
+def queue_handler(event, context):
+    """SQS worker for async ingest, reporting partial batch failures."""
+    start_invocation(context)
+    records = event.get("Records", [])
+    failures = []
+    workers = max(1, min(QUEUE_WORKER_CONCURRENCY, len(records)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_job, record) for record in records]
+        for record, future in zip(records, futures):
+            try:
+                retry = future.result()
+            except Exception as e:
+                print(f"Job in message {record['messageId']} failed: {e}")
+                retry = True
+            if retry:
+                failures.append({"itemIdentifier": record["messageId"]})
+    metrics.emit("IngestBatch", {"Jobs": len(records), "FailedJobs": len(failures)})
+    return {"batchItemFailures": failures}
+
+
+def lambda_handler(event, context):
+    start_invocation(context)
+    if event.get("httpMethod") == "GET" and event.get("resource") == "/webhook/jobs/{trackingId}":
+        return job_status((event.get("pathParameters") or {}).get("trackingId", ""))
+
+    body = json.loads(event.get("body", "{}") or "{}")
+    error = validate_webhook(body)
+    if error:
+        return error
+    if INGEST_MODE == "async":
+        return enqueue_webhook(event["body"])
+    return process_webhook(body)
@@ -1,31 +1,221 @@
 import json
 import os
+import threading
+import time
 import uuid
+from concurrent.futures import Future
 
-import boto3
-from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+from trustbill.common import checks
+from trustbill.common import claimcheck
+from trustbill.common import clients as aws
+from trustbill.common import dedup
+from trustbill.common import fingerprint
+from trustbill.common import idempotency
+from trustbill.common import invoicecodec
+from trustbill.common import metrics
+from trustbill.common import model
+from trustbill.common import ratelimit
+from trustbill.common import vendorcache
+from trustbill.common import vendorindex
+from trustbill.common import vendorstats
 
 VENDORS_TABLE = os.getenv("TrustedVendorsTable", None)
 INVOICES_TABLE = os.getenv("InvoicesTable", None)
-dynamodb = boto3.resource("dynamodb")
+# Running per-vendor amount statistics; without it unusual_amounts reads the
+# vendor's whole invoice history
+VENDOR_STATS_TABLE = os.getenv("VendorStatsTable", None)
+# One item per vendor and invoice number; without it duplicate_invoice reads
+# the vendor's whole invoice history
+INVOICE_DEDUP_TABLE = os.getenv("InvoiceDedupTable", None)
+# LSH index of invoice content fingerprints; without it NearDuplicate is null
+INVOICE_FINGERPRINTS_TABLE = os.getenv("InvoiceFingerprintsTable", None)
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NearDuplicateThreshold", "0.8"))
+# Vendor lookup keys by GSTIN, bank account and name; without it vendors are
+# resolved by sender email only and BankAccountOfOtherVendor is null
+VENDOR_KEYS_TABLE = os.getenv("VendorKeysTable", None)
+CLAIM_CHECK_CACHE_ENTRIES = int(os.getenv("ClaimCheckCacheEntries", "64"))
+# Store Items and VendorInfo as one compressed binary attribute
+PACK_INVOICES = os.getenv("PackInvoiceDetails", "false").lower() == "true"
+# Flags of recently stored invoices, answered without a read on replay
+RESULT_CACHE_ENTRIES = int(os.getenv("VerifyResultCacheEntries", "1024"))
+# Trusted vendor records are cached per container. Changes made through the
+# data API reach every container within VendorCacheVersionCheckSeconds when
+# CacheVersionsTable is set, and within VendorCacheSeconds regardless.
+VENDOR_CACHE_ENTRIES = int(os.getenv("VendorCacheEntries", "1024"))
+VENDOR_CACHE_SECONDS = int(os.getenv("VendorCacheSeconds", "300"))
+VENDOR_CACHE_NEGATIVE_SECONDS = int(os.getenv("VendorCacheNegativeSeconds", "60"))
+VENDOR_CACHE_VERSION_CHECK_SECONDS = int(os.getenv("VendorCacheVersionCheckSeconds", "30"))
+CACHE_VERSIONS_TABLE = os.getenv("CacheVersionsTable", None)
+# DynamoDB limits per BatchGetItem and BatchWriteItem request
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+BATCH_MAX_ATTEMPTS = int(os.getenv("VerifyBatchMaxAttempts", "5"))
+BATCH_BACKOFF_SECONDS = float(os.getenv("VerifyBatchBackoffSeconds", "0.1"))
+# How long a batch's claim on an invoice id holds. Twice the function timeout,
+# so no delivery still running can have missed the invoice being stored.
+INVOICE_CLAIM_SECONDS = int(os.getenv("VerifyInvoiceClaimSeconds", "360"))
+# Threads per invoice for fetching check data and running independent checks
+CHECK_WORKERS = int(os.getenv("VerifyCheckWorkers", "4"))
+
+# Extract may publish a pointer to the detail in S3 instead of the detail itself
+detail_cache = claimcheck.DetailCache(CLAIM_CHECK_CACHE_ENTRIES)
+result_cache = idempotency.ResultCache(RESULT_CACHE_ENTRIES)
+vendor_cache = vendorcache.VendorCache(
+    max_entries=VENDOR_CACHE_ENTRIES,
+    ttl_seconds=VENDOR_CACHE_SECONDS,
+    negative_ttl_seconds=VENDOR_CACHE_NEGATIVE_SECONDS,
+    version_table=CACHE_VERSIONS_TABLE,
+    version_check_seconds=VENDOR_CACHE_VERSION_CHECK_SECONDS,
+)
+
 
 def get_tables():
     """Get DynamoDB tables. Lazy loading to support testing."""
     return {
-        "vendors": dynamodb.Table(VENDORS_TABLE),
-        "invoices": dynamodb.Table(INVOICES_TABLE)
+        "vendors": aws.table(VENDORS_TABLE),
+        "invoices": aws.table(INVOICES_TABLE)
     }
 
 
-def incorrect_vendor_info(current_invoice_data):
-    tables = get_tables()
-    response = tables["vendors"].query(
-        IndexName="VendorEmailIndex",
-        KeyConditionExpression=Key("VendorEmail").eq(
-            current_invoice_data.get("VendorEmail")
-        ),
-    )
-    vendor_data = response.get("Items", [])
+def query_all(table, **kwargs):
+    """Run a DynamoDB query, following LastEvaluatedKey. Returns (items, pages)."""
+    items, pages = [], 0
+    while True:
+        response = table.query(**kwargs)
+        items.extend(response.get("Items", []))
+        pages += 1
+        if "LastEvaluatedKey" not in response:
+            return items, pages
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+class VerificationContext:
+    """Everything the checks read for one vendor, fetched at most once.
+
+    The vendor's trusted records and its invoice history are each loaded on
+    first use with a single paginated query, so the checks share one read
+    of the invoices VendorEmailIndex partition instead of querying it each.
+    Checks may run in several threads; without explicit tables each thread
+    uses its own Table objects. Per-key lookups are memoized as futures, so
+    threads asking for the same key at once share one read.
+    """
+
+    def __init__(self, vendor_email, tables=None):
+        self.vendor_email = vendor_email
+        self._tables = tables
+        self._lock = threading.Lock()
+        self._vendor_records_lock = threading.Lock()
+        self._invoices_lock = threading.Lock()
+        self._vendor_records = None
+        self._invoices = None
+        self._amount_stats = {}
+        self._dedup_claims = {}
+        self._similar_invoices = {}
+        self._resolutions = {}
+        self.pages = 0
+        self.vendor_records_cached = False
+        # Age in seconds of cached vendor records; stale reads are bounded by
+        # vendor_cache's TTL and version check interval
+        self.vendor_records_age = None
+
+    @property
+    def tables(self):
+        return self._tables or get_tables()
+
+    def _query(self, table):
+        items, pages = query_all(
+            table,
+            IndexName="VendorEmailIndex",
+            KeyConditionExpression=Key("VendorEmail").eq(self.vendor_email),
+        )
+        with self._lock:
+            self.pages += pages
+        return items
+
+    @property
+    def vendor_records(self):
+        with self._vendor_records_lock:
+            if self._vendor_records is None:
+                self._vendor_records, self.vendor_records_age = vendor_cache.get(
+                    self.vendor_email, lambda: self._query(self.tables["vendors"])
+                )
+                self.vendor_records_cached = self.vendor_records_age is not None
+        return self._vendor_records
+
+    @property
+    def invoices(self):
+        with self._invoices_lock:
+            if self._invoices is None:
+                self._invoices = self._query(self.tables["invoices"])
+        return self._invoices
+
+    def _once(self, memo, key, load):
+        """load() for key, called at most once however many threads ask.
+
+        The first caller loads without holding the lock; the others wait
+        for its result. A failed load is not remembered.
+        """
+        with self._lock:
+            future = memo.get(key)
+            loading = future is None
+            if loading:
+                future = memo[key] = Future()
+        if loading:
+            try:
+                future.set_result(load())
+            except Exception as e:
+                with self._lock:
+                    del memo[key]
+                future.set_exception(e)
+        return future.result()
+
+    def _remember(self, memo, key, value):
+        """Record a value read ahead of the checks (see prefetch)."""
+        future = Future()
+        future.set_result(value)
+        with self._lock:
+            memo[key] = future
+
+    def amount_stats(self, currency):
+        """The vendor's AmountStats for currency, or None without a record."""
+        if not VENDOR_STATS_TABLE:
+            return None
+        currency = vendorstats.currency_key(currency)
+        return self._once(
+            self._amount_stats,
+            currency,
+            lambda: vendorstats.get(VENDOR_STATS_TABLE, self.vendor_email, currency),
+        )
+
+    def dedup_claim(self, key):
+        """The dedup item holding key, or None when the key is free."""
+        return self._once(self._dedup_claims, key, lambda: dedup.lookup(INVOICE_DEDUP_TABLE, key))
+
+    def vendor_resolution(self, data):
+        """The vendorindex.Resolution of an invoice detail, or None without a keys table."""
+        if not VENDOR_KEYS_TABLE:
+            return None
+        keys = tuple(vendorindex.lookup_keys(data))
+        return self._once(self._resolutions, keys, lambda: vendorindex.resolve(VENDOR_KEYS_TABLE, data))
+
+    def similar_invoices(self, data, sig):
+        """[(invoiceId, similarity)] of indexed invoices near data, whose signature is sig."""
+        key = (sig, data.get("VendorEmail"), data.get("InvoiceNumber"), data.get("InvoiceDate"))
+        return self._once(
+            self._similar_invoices,
+            key,
+            lambda: fingerprint.find_similar(
+                INVOICE_FINGERPRINTS_TABLE, sig, NEAR_DUPLICATE_THRESHOLD, data=data
+            ),
+        )
+
+
+def incorrect_vendor_info(current_invoice_data, context=None):
+    context = context or VerificationContext(current_invoice_data.get("VendorEmail"))
+    vendor_data = context.vendor_records
     if not vendor_data:
         return True
 
@@ -56,105 +246,556 @@ def changed_bank_details(vendor_data, current_invoice_data):
     return not any(matched) 
 
 
-def duplicate_invoice(vendor_email, current_invoice_data):
-
-    tables = get_tables()
-    response = tables["invoices"].query(
-        IndexName="VendorEmailIndex",
-        KeyConditionExpression=Key("VendorEmail").eq(vendor_email),
-        FilterExpression=Attr("InvoiceNumber").eq(current_invoice_data.get("InvoiceNumber"))
+def duplicate_invoice(vendor_email, current_invoice_data, context=None):
+    context = context or VerificationContext(vendor_email)
+    invoice_number = current_invoice_data.get("InvoiceNumber")
+    # A redelivery of this same invoice is not a duplicate of itself
+    invoice_id = current_invoice_data.get("InvoiceId")
+    if INVOICE_DEDUP_TABLE:
+        key = dedup.dedup_key(vendor_email, invoice_number)
+        claim = context.dedup_claim(key) if key is not None else None
+        return claim is not None and (invoice_id is None or claim["invoiceId"] != invoice_id)
+    # Any earlier invoice with the same vendor email and invoice number is a duplicate
+    return any(
+        item.get("InvoiceNumber") == invoice_number
+        and (invoice_id is None or item.get("invoiceId") != invoice_id)
+        for item in context.invoices
     )
-    # If we find any items with the same vendor email and invoice number, it's a duplicate
-    if response.get("Items") and len(response.get("Items")) > 0:
-        return True
+
+
+def unusual_amounts(current_invoice_data, context=None):
+    context = context or VerificationContext(current_invoice_data.get("VendorEmail"))
+    stats = context.amount_stats(current_invoice_data.get("Currency"))
+    if stats is not None:
+        return deviates(current_invoice_data, stats.mean)
+    # No statistics record yet (or no table): fall back to the full history
+    # Null totals are stored as "-" (or "None" in older rows) and are skipped
+    amounts = [vendorstats.parse_amount(item.get("TotalAmount")) for item in context.invoices]
+    amounts = [amount for amount in amounts if amount is not None]
+    if amounts:
+        return deviates(current_invoice_data, float(sum(amounts)) / len(amounts))
     return False
 
 
-def unusual_amounts(current_invoice_data):
-    tables = get_tables()
-    response = tables["invoices"].query(
-        IndexName="VendorEmailIndex",
-        KeyConditionExpression=Key("VendorEmail").eq(
-            current_invoice_data.get("VendorEmail")
-        ),
-    )
-    items = response.get("Items", [])
-    if items:
-        amounts = [
-            float(item.get("TotalAmount", 0))
-            for item in items
-            if item.get("TotalAmount")
-        ]
-        if amounts:
-            avg_amount = sum(amounts) / len(amounts)
-            current_amount = float(current_invoice_data.get("TotalAmount", 0))
-            if avg_amount > 0:
-                deviation = abs(current_amount - avg_amount) / avg_amount * 100
-                if deviation > 30:
-                    return True
+def bank_account_of_other_vendor(current_invoice_data, context=None):
+    """Whether the invoice's bank account belongs only to vendors it does not otherwise match.
+
+    None without a vendor keys table.
+    """
+    context = context or VerificationContext(current_invoice_data.get("VendorEmail"))
+    resolution = context.vendor_resolution(current_invoice_data)
+    return None if resolution is None else resolution.bank_conflict
+
+
+def near_duplicates(current_invoice_data, context=None):
+    """Ids of stored invoices from any sender whose content nearly matches.
+
+    Earlier bills of the same series (same sender, another number and
+    month) are not counted. None without a fingerprints table.
+    """
+    if not INVOICE_FINGERPRINTS_TABLE:
+        return None
+    sig = fingerprint.signature(current_invoice_data)
+    if sig is None:
+        return []
+    context = context or VerificationContext(current_invoice_data.get("VendorEmail"))
+    return [invoice_id for invoice_id, _ in context.similar_invoices(current_invoice_data, sig)]
+
+
+def near_duplicate(current_invoice_data, context=None):
+    """Whether a stored invoice from any sender nearly matches. None without a fingerprints table."""
+    invoice_ids = near_duplicates(current_invoice_data, context)
+    return None if invoice_ids is None else bool(invoice_ids)
+
+
+def deviates(current_invoice_data, avg_amount):
+    """Whether the invoice total is more than 30% away from the vendor's mean."""
+    if not avg_amount or avg_amount <= 0:
+        return False
+    current_amount = float(current_invoice_data.get("TotalAmount", 0))
+    deviation = abs(current_amount - avg_amount) / avg_amount * 100
+    return deviation > 30
+
+
+# The Flags of every stored invoice, in this order. A check gated on
+# IncorrectVendorInfo is skipped (its flag left None) for unknown or
+# changed vendors, since the invoice is flagged regardless.
+fraud_checks = checks.CheckRegistry(max_workers=CHECK_WORKERS)
+
+
+@fraud_checks.loader("VendorRecords")
+def load_vendor_records(data, context):
+    return context.vendor_records
+
+
+@fraud_checks.loader("DuplicateHistory")
+def load_duplicate_history(data, context):
+    if INVOICE_DEDUP_TABLE:
+        key = dedup.dedup_key(data.get("VendorEmail"), data.get("InvoiceNumber"))
+        return context.dedup_claim(key) if key is not None else None
+    return context.invoices
+
+
+@fraud_checks.loader("AmountHistory")
+def load_amount_history(data, context):
+    stats = context.amount_stats(data.get("Currency"))
+    return stats if stats is not None else context.invoices
+
+
+@fraud_checks.loader("SimilarInvoices")
+def load_similar_invoices(data, context):
+    return near_duplicates(data, context)
+
+
+@fraud_checks.loader("VendorResolution")
+def load_vendor_resolution(data, context):
+    return context.vendor_resolution(data)
+
+
+@fraud_checks.check("IncorrectVendorInfo", needs=["VendorRecords"], cost=1)
+def check_vendor_info(data, context):
+    return incorrect_vendor_info(data, context)
+
+
+@fraud_checks.check(
+    "DuplicateInvoice", needs=["DuplicateHistory"], cost=2, requires={"IncorrectVendorInfo": False}
+)
+def check_duplicate(data, context):
+    return duplicate_invoice(data.get("VendorEmail"), data, context)
+
+
+@fraud_checks.check(
+    "UnusualAmounts", needs=["AmountHistory"], cost=2, requires={"IncorrectVendorInfo": False}
+)
+def check_amounts(data, context):
+    return unusual_amounts(data, context)
+
+
+@fraud_checks.check("ItemizedInvoice", cost=0)
+def check_itemized(data, context):
+    # Flags invoices without line items
+    return len(data.get("LineItems", [])) == 0
+
+
+@fraud_checks.check("BankAccountOfOtherVendor", needs=["VendorResolution"], cost=1)
+def check_bank_owner(data, context):
+    return bank_account_of_other_vendor(data, context)
+
+
+# Not gated on the vendor checks: resubmissions from lookalike senders are
+# what it is for
+@fraud_checks.check("NearDuplicate", needs=["SimilarInvoices"], cost=3)
+def check_near_duplicate(data, context):
+    return near_duplicate(data, context)
+
+
+def storage_item(invoice):
+    """The invoice as written to the invoices table."""
+    return invoicecodec.pack(invoice) if PACK_INVOICES else invoice
+
+
+def store_invoice(tables, invoice, flags):
+    """Write the invoice, claiming its dedup key when it is not a known duplicate.
+
+    If a concurrent verification claimed the key first, the invoice is
+    stored flagged as a duplicate instead. Returns False, writing nothing,
+    when an invoice with the same invoiceId is already stored.
+    """
+    key = None
+    if INVOICE_DEDUP_TABLE and not flags["DuplicateInvoice"]:
+        key = dedup.dedup_key(invoice.get("VendorEmail"), invoice.get("InvoiceNumber"))
+    if key is not None:
+        claimed = dedup.put_claimed(INVOICES_TABLE, storage_item(invoice), INVOICE_DEDUP_TABLE, key)
+        if claimed is None:
             return False
-    else:
+        if claimed:
+            return True
+        if flags["DuplicateInvoice"] is not None:
+            flags["DuplicateInvoice"] = True
+    try:
+        tables["invoices"].put_item(Item=storage_item(invoice), ConditionExpression="attribute_not_exists(invoiceId)")
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
         return False
+    return True
 
-def lambda_handler(event, context):
-    data = event.get("detail")
-    vendorInfo = {
-        "vendorId": str(uuid.uuid4()),
-        "VendorEmail": data.get("VendorEmail"),
-        "VendorName": data.get("VendorName"),
-        "VendorAddress": data.get("VendorAddress"),
-        "VendorGSTIN": data.get("VendorGSTIN"),
-        "VendorBankName": data.get("VendorBankName"),
-        "VendorBankAccount": data.get("VendorBankAccount"),
-        "VendorIFSCCode": data.get("VendorIFSCCode"),
-        "VendorBankRoutingNumber": data.get("VendorBankRoutingNumber"),
-    }
-    flags = {
-        "IncorrectVendorInfo": False,
-        "DuplicateInvoice": None,
-        "UnusualAmounts": None,
-        "ItemizedInvoice": False,
-    }
 
-    flags["IncorrectVendorInfo"] = incorrect_vendor_info(data)
-    if not flags["IncorrectVendorInfo"]:
-        flags["DuplicateInvoice"] = duplicate_invoice(data.get("VendorEmail"), data)
-        flags["UnusualAmounts"] = unusual_amounts(data)
-    if len(data.get("LineItems", [])) == 0:
-        flags["ItemizedInvoice"] = True
+def replayed_flags(invoice_id):
+    """The Flags stored for invoice_id by an earlier delivery, or None."""
+    if not invoice_id:
+        return None
+    flags = result_cache.get(invoice_id)
+    if flags is None:
+        flags = idempotency.stored_flags(INVOICES_TABLE, invoice_id)
+        if flags is not None:
+            result_cache.put(invoice_id, flags)
+    return flags
 
-    tables = get_tables()
-    data["TotalAmount"] = str(data.get("TotalAmount", "-"))
-    data["TaxAmount"] = str(data.get("TaxAmount", "-"))
-    
-    for item in data.get("LineItems", []):
-        for k, v in item.items():
-            if isinstance(v, (int, float)):
-                item[k] = str(v)
-            elif v is None:
-                item[k] = "-"
-
-    tables["invoices"].put_item(
-        Item={
-            "invoiceId": str(uuid.uuid4()),
-            "VendorEmail":data.get("VendorEmail"),
-            "InvoiceNumber":data.get("InvoiceNumber"),
-            "InvoiceDate":data.get("InvoiceDate"),
-            "DueDate":data.get("DueDate"),
-            "Currency":data.get("Currency"),
-            "TotalAmount":data.get("TotalAmount"),
-            "TaxAmount":data.get("TaxAmount"),
-            "Items": data.get("LineItems", []),
-            "Notes": data.get("Notes"),
-            "TermsAndConditions": data.get("TermsAndConditions"),
-            "FileURL": data.get("FileURL"),
-            "Flags": flags,
-            "VendorInfo": vendorInfo,
-        }
+
+def verify_invoice(data, verification):
+    """Run the checks on one InvoiceExtracted detail and return the item to store."""
+    results, timings, skipped = fraud_checks.evaluate(data, verification)
+    flags = {name: results[name] for name in fraud_checks.checks}
+    metrics.emit(
+        "FraudChecks",
+        {f"{name.replace('load:', 'Load')}Ms": ms for name, ms in timings.items()},
+        Skipped=skipped,
     )
+    invoice = model.Invoice.from_extracted(data, flags)
+    resolution = verification.vendor_resolution(data)
+    if resolution is not None:
+        invoice.resolution = resolution.to_item()
+    item = invoice.to_item()
+    if flags.get("NearDuplicate"):
+        # Flags stay booleans; the matches are kept beside them
+        item["NearDuplicateOf"] = near_duplicates(data, verification)
+    return item
+
+
+def emit_verification_metrics(verification):
+    metrics.emit("VerificationReads", {"QueryPages": verification.pages})
+    metrics.emit(
+        "VendorCache",
+        {
+            "CacheHit": int(verification.vendor_records_cached),
+            "HitRate": vendor_cache.hit_rate,
+            "VendorDataAgeMs": round((verification.vendor_records_age or 0) * 1000, 2),
+        },
+        **vendor_cache.stats,
+    )
+
+
+def record_amounts(vendor_email, currency, amounts):
+    if not VENDOR_STATS_TABLE:
+        return
+    try:
+        vendorstats.record_many(VENDOR_STATS_TABLE, vendor_email, currency, amounts)
+    except Exception as e:
+        # The invoices are stored; a backfill repairs the statistics
+        print(f"Failed to update vendor amount statistics: {e}")
+
+
+def index_fingerprint(invoice):
+    if not INVOICE_FINGERPRINTS_TABLE:
+        return
+    sig = fingerprint.signature(fingerprint.invoice_fields(invoice))
+    if sig is None:
+        return
+    try:
+        fingerprint.index(
+            INVOICE_FINGERPRINTS_TABLE,
+            invoice["invoiceId"],
+            sig,
+            invoice["VendorEmail"],
+            invoice["InvoiceNumber"],
+            invoice["InvoiceDate"],
+        )
+    except Exception as e:
+        # The invoice is stored; a backfill indexes it
+        print(f"Failed to index invoice fingerprint: {e}")
+
+
+def batch_near_duplicates(invoice, sig, earlier):
+    """Ids of invoices earlier in the batch whose content nearly matches invoice.
+
+    earlier holds (invoice, signature) pairs; those invoices are not indexed
+    until the batch is stored, so find_similar cannot see them. Bills of
+    the same series are left out as find_similar leaves them out.
+    """
+    return [
+        other["invoiceId"]
+        for other, other_sig in earlier
+        if fingerprint.similarity(sig, other_sig) >= NEAR_DUPLICATE_THRESHOLD
+        and not fingerprint.recurring(
+            invoice,
+            {
+                "VendorEmail": other["VendorEmail"],
+                "InvoiceNumber": other["InvoiceNumber"],
+                "InvoiceMonth": fingerprint.invoice_month(other["InvoiceDate"]),
+            },
+        )
+    ]
+
+
+def lambda_handler(event, context):
+    data = detail_cache.resolve(event.get("detail"))
+    flags = replayed_flags(data.get("InvoiceId"))
+    replayed = flags is not None
+    if not replayed:
+        tables = get_tables()
+        verification = VerificationContext(data.get("VendorEmail"))
+        invoice = verify_invoice(data, verification)
+        emit_verification_metrics(verification)
+        flags = invoice["Flags"]
+        if store_invoice(tables, invoice, flags):
+            result_cache.put(invoice["invoiceId"], flags)
+            record_amounts(invoice["VendorEmail"], invoice["Currency"], [invoice["TotalAmount"]])
+            index_fingerprint(invoice)
+        else:
+            # A concurrent delivery of the same event stored it first
+            flags = replayed_flags(invoice["invoiceId"])
+            replayed = True
+    metrics.emit("VerifyIdempotency", {"Replayed": int(replayed)}, **result_cache.stats)
     return {
         "statusCode": 200,
-        "body": json.dumps(
-            {"message": "Invoice verification completed", "flags": flags}
-        ),
+        "body": model.dumps({"message": "Invoice verification completed", "flags": flags, "replayed": replayed}),
     }
+
+
+def batch_get(table_name, keys, projection=None):
+    """BatchGetItem keys from table_name, retrying UnprocessedKeys.
+
+    Returns (items found, keys still unprocessed after the last attempt).
+    """
+    dynamodb = aws.resource("dynamodb")
+    found, unprocessed = [], []
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {table_name: {"Keys": keys[start : start + BATCH_GET_SIZE], "ConsistentRead": True}}
+        if projection:
+            request[table_name]["ProjectionExpression"] = projection
+        for attempt in range(BATCH_MAX_ATTEMPTS):
+            response = dynamodb.batch_get_item(RequestItems=request)
+            found.extend(response.get("Responses", {}).get(table_name, []))
+            request = response.get("UnprocessedKeys") or {}
+            if not request:
+                break
+            time.sleep(ratelimit.backoff_delay(attempt, BATCH_BACKOFF_SECONDS, 5))
+        if request:
+            unprocessed.extend(request[table_name]["Keys"])
+    return found, unprocessed
+
+
+def batch_write(table_name, items, key_name):
+    """BatchWriteItem puts for items, retrying UnprocessedItems.
+
+    Returns the key_name values of the items that could not be written.
+    """
+    dynamodb = aws.resource("dynamodb")
+    failed = []
+    for start in range(0, len(items), BATCH_WRITE_SIZE):
+        request = {
+            table_name: [{"PutRequest": {"Item": item}} for item in items[start : start + BATCH_WRITE_SIZE]]
+        }
+        for attempt in range(BATCH_MAX_ATTEMPTS):
+            try:
+                response = dynamodb.batch_write_item(RequestItems=request)
+            except Exception as e:
+                print(f"Batch write to {table_name} failed: {e}")
+                if attempt == BATCH_MAX_ATTEMPTS - 1:
+                    break
+                response = {"UnprocessedItems": request}
+            request = response.get("UnprocessedItems") or {}
+            if not request:
+                break
+            time.sleep(ratelimit.backoff_delay(attempt, BATCH_BACKOFF_SECONDS, 5))
+        if request:
+            failed.extend(entry["PutRequest"]["Item"][key_name] for entry in request[table_name])
+    return failed
+
+
+def prefetch(contexts, invoices):
+    """Load the dedup items and amount statistics of a whole batch with BatchGetItem."""
+    if INVOICE_DEDUP_TABLE:
+        owners = {}
+        for data in invoices:
+            key = dedup.dedup_key(data.get("VendorEmail"), data.get("InvoiceNumber"))
+            if key is not None:
+                owners[key] = data.get("VendorEmail")
+        found, unprocessed = batch_get(INVOICE_DEDUP_TABLE, [{"dedupKey": key} for key in owners])
+        claims = {item["dedupKey"]: item for item in found}
+        for item in unprocessed:
+            owners.pop(item["dedupKey"])
+        for key, vendor_email in owners.items():
+            context = contexts[vendor_email]
+            context._remember(context._dedup_claims, key, claims.get(key))
+    if VENDOR_STATS_TABLE:
+        keys = {
+            (data.get("VendorEmail"), vendorstats.currency_key(data.get("Currency")))
+            for data in invoices
+            if data.get("VendorEmail")
+        }
+        found, unprocessed = batch_get(
+            VENDOR_STATS_TABLE,
+            [{"VendorEmail": email, "Currency": currency} for email, currency in keys],
+        )
+        stats = {(item["VendorEmail"], item["Currency"]): item for item in found}
+        unprocessed = {(item["VendorEmail"], item["Currency"]) for item in unprocessed}
+        for vendor_email, currency in keys - unprocessed:
+            item = stats.get((vendor_email, currency))
+            context = contexts[vendor_email]
+            context._remember(context._amount_stats, currency, vendorstats.AmountStats(item) if item else None)
+
+
+def drop_replays(pending):
+    """Drop messages whose invoice is already stored or earlier in the batch.
+
+    Returns (the messages left to verify, the number dropped). They succeed
+    without being checked or written again.
+    """
+    remaining, seen = [], set()
+    unknown = set()
+    for message_id, data in pending:
+        invoice_id = data.get("InvoiceId")
+        if invoice_id and (invoice_id in seen or result_cache.get(invoice_id) is not None):
+            seen.add(invoice_id)
+            continue
+        if invoice_id:
+            seen.add(invoice_id)
+            unknown.add(invoice_id)
+        remaining.append((message_id, data))
+    stored = set()
+    if unknown:
+        try:
+            found, _ = batch_get(
+                INVOICES_TABLE, [{"invoiceId": invoice_id} for invoice_id in unknown], "invoiceId, Flags"
+            )
+        except Exception as e:
+            # Verified again; store_invoice still writes each id only once
+            print(f"Replay lookup failed: {e}")
+            found = []
+        for item in found:
+            stored.add(item["invoiceId"])
+            result_cache.put(item["invoiceId"], item.get("Flags", {}))
+    remaining = [(message_id, data) for message_id, data in remaining if data.get("InvoiceId") not in stored]
+    return remaining, len(pending) - len(remaining)
+
+
+def store_batch(verified):
+    """Store the verified invoices of a batch.
+
+    Returns (the ids that could not be written, the ids another delivery
+    already stored). With a dedup table the batch has claimed each id, so
+    the invoices are written with BatchWriteItem; without one, each is
+    written with a conditional put.
+    """
+    if INVOICE_DEDUP_TABLE:
+        return batch_write(INVOICES_TABLE, [storage_item(invoice) for _, invoice in verified], "invoiceId"), []
+    tables = get_tables()
+    failed, stored_elsewhere = [], []
+    for _, invoice in verified:
+        try:
+            if not store_invoice(tables, invoice, invoice["Flags"]):
+                stored_elsewhere.append(invoice["invoiceId"])
+        except Exception as e:
+            print(f"Storing invoice {invoice['invoiceId']} failed: {e}")
+            failed.append(invoice["invoiceId"])
+    return failed, stored_elsewhere
+
+
+def queue_handler(event, context):
+    """Verify a batch of InvoiceExtracted events from the verify queue.
+
+    Invoices are grouped by vendor so each vendor's records and history are
+    read once per batch; dedup items and amount statistics are fetched with
+    BatchGetItem and the invoices stored with BatchWriteItem, each once its
+    id is claimed. Messages that fail are reported back to SQS individually.
+    """
+    records = event.get("Records", [])
+    failures = []
+    pending = []
+    for record in records:
+        try:
+            detail = json.loads(record["body"]).get("detail")
+            pending.append((record["messageId"], detail_cache.resolve(detail)))
+        except Exception as e:
+            print(f"Message {record['messageId']} could not be read: {e}")
+            failures.append(record["messageId"])
+    pending, replays = drop_replays(pending)
+
+    groups = {}
+    for message_id, data in pending:
+        groups.setdefault(data.get("VendorEmail"), []).append((message_id, data))
+    contexts = {email: VerificationContext(email) for email in groups}
+    try:
+        prefetch(contexts, [data for _, data in pending])
+    except Exception as e:
+        # The checks look up whatever was not prefetched themselves
+        print(f"Batch prefetch failed: {e}")
+
+    verified = []
+    # Owns this batch's claims on invoice ids (ids) and dedup keys (claimed)
+    batch_id = str(uuid.uuid4())
+    ids = set()
+    claimed = {}
+    seen = set()
+    signatures = []
+    for vendor_email, verification in contexts.items():
+        for message_id, data in groups[vendor_email]:
+            invoice = None
+            try:
+                invoice = verify_invoice(data, verification)
+                if INVOICE_DEDUP_TABLE:
+                    if not dedup.claim_invoice_id(
+                        INVOICE_DEDUP_TABLE, invoice["invoiceId"], batch_id, INVOICE_CLAIM_SECONDS
+                    ):
+                        # Another batch is storing it; once it has, the redelivery is dropped as a replay
+                        print(f"Invoice {invoice['invoiceId']} is being stored by another batch")
+                        failures.append(message_id)
+                        continue
+                    ids.add(invoice["invoiceId"])
+                flags = invoice["Flags"]
+                key = dedup.dedup_key(invoice["VendorEmail"], invoice["InvoiceNumber"])
+                # An earlier copy in this same batch is not in the table yet
+                if key in seen and flags["DuplicateInvoice"] is False:
+                    flags["DuplicateInvoice"] = True
+                if key is not None:
+                    seen.add(key)
+                sig = None
+                if flags.get("NearDuplicate") is not None:
+                    sig = fingerprint.signature(fingerprint.invoice_fields(invoice))
+                if sig is not None:
+                    # Likewise for near-duplicates, which are not indexed yet
+                    matches = batch_near_duplicates(invoice, sig, signatures)
+                    if matches:
+                        flags["NearDuplicate"] = True
+                        invoice["NearDuplicateOf"] = invoice.get("NearDuplicateOf", []) + matches
+                if key is not None and INVOICE_DEDUP_TABLE and not flags["DuplicateInvoice"]:
+                    if dedup.claim(INVOICE_DEDUP_TABLE, key, invoice):
+                        claimed[invoice["invoiceId"]] = key
+                    elif flags["DuplicateInvoice"] is not None:
+                        flags["DuplicateInvoice"] = True
+            except Exception as e:
+                print(f"Verification of message {message_id} failed: {e}")
+                failures.append(message_id)
+                if invoice is not None and invoice["invoiceId"] in ids:
+                    dedup.release_invoice_id(INVOICE_DEDUP_TABLE, invoice["invoiceId"], batch_id)
+                continue
+            verified.append((message_id, invoice))
+            if sig is not None:
+                signatures.append((invoice, sig))
+        emit_verification_metrics(verification)
+
+    failed_ids, stored_elsewhere = store_batch(verified)
+    failed_ids, stored_elsewhere = set(failed_ids), set(stored_elsewhere)
+    amounts = {}
+    for message_id, invoice in verified:
+        if invoice["invoiceId"] in stored_elsewhere:
+            replays += 1
+            continue
+        if invoice["invoiceId"] in failed_ids:
+            failures.append(message_id)
+            if INVOICE_DEDUP_TABLE:
+                # Free the keys so the redelivered message can claim them
+                dedup.release_invoice_id(INVOICE_DEDUP_TABLE, invoice["invoiceId"], batch_id)
+                if invoice["invoiceId"] in claimed:
+                    dedup.release(INVOICE_DEDUP_TABLE, claimed[invoice["invoiceId"]], invoice["invoiceId"])
+            continue
+        # So a redelivery of the message is answered without a table read
+        result_cache.put(invoice["invoiceId"], invoice["Flags"])
+        key = (invoice["VendorEmail"], vendorstats.currency_key(invoice["Currency"]))
+        amounts.setdefault(key, []).append(invoice["TotalAmount"])
+        index_fingerprint(invoice)
+    for (vendor_email, currency), vendor_amounts in amounts.items():
+        record_amounts(vendor_email, currency, vendor_amounts)
+
+    metrics.emit(
+        "VerifyBatch",
+        {
+            "Invoices": len(records),
+            "Vendors": len(contexts),
+            "FailedInvoices": len(failures),
+            "Replays": replays,
+        },
+    )
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures]}